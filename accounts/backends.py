@@ -0,0 +1,14 @@
+from django.contrib.auth.backends import ModelBackend
+
+from . import user_cache
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ログイン(authenticate)はModelBackendと同じ。
+    ログイン中のユーザの取得(get_user)はリクエストごとに呼ばれるので、accounts/user_cache.pyのキャッシュから行う。
+    """
+
+    def get_user(self, user_id):
+        user = user_cache.get_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
@@ -0,0 +1,251 @@
+from array import array
+from bisect import bisect_left, insort
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+
+from .models import FriendShip
+
+# フォロー関係をプロセス内のメモリに持ち、フォロー済みかどうか・フォロー数・相互フォローをSQLなしで答える。
+# settings.FOLLOW_INDEX_ENABLEDがTrueのときだけ使い、使えないときは呼び出し側でDBに問い合わせる。
+# 他のプロセスの変更は最大FOLLOW_INDEX_CHECK_INTERVAL秒遅れて取り込むので、表示にだけ使い、
+# 書き込むかどうかの判断(すでにフォローしているかなど)には使わない。
+#
+# 全プロセスで共有するバージョン番号をFOLLOW_INDEX_CACHE_ALIASのキャッシュに置き、
+# フォロー関係が変わるたび(トランザクションのコミット後)に1増やして、その変更内容もバージョンごとにキャッシュに書く。
+# 各プロセスはFOLLOW_INDEX_CHECK_INTERVAL秒ごとにバージョンを確かめ、自分のものより進んでいたら
+# その間の変更を取り込む。変更内容がキャッシュから消えていたら全体を読み込み直す。
+# 変更はFriendShipのpost_save・post_deleteシグナル(accounts/signals.py)と、
+# シグナルが送られない一括フォロー(BulkFollowView)からrecord()で記録する。
+
+VERSION_KEY = "follow_index:version"
+
+# 変更内容をキャッシュに残しておく秒数。これより長く確かめなかったプロセスは全体を読み込み直す
+CHANGE_TIMEOUT = 3600
+
+# 一度に取り込む変更の最大数。これより多く遅れていたら全体を読み込み直す方が速い
+MAX_CATCH_UP = 1000
+
+# プロセスの間で共有されないキャッシュ。バージョン番号を置くと、ほかのプロセスの変更がいつまでも伝わらない
+PROCESS_LOCAL_CACHES = (LocMemCache, DummyCache)
+
+EMPTY = array("q")
+
+
+def _change_key(version):
+    return f"follow_index:changes:{version}"
+
+
+def _contains(ids, user_id):
+    i = bisect_left(ids, user_id)
+    return i < len(ids) and ids[i] == user_id
+
+
+class FollowIndex:
+    """
+    ユーザのidごとに、フォローしている人とフォロワーのidを昇順に並べた配列(array)で持つ。
+    フォロー済みかどうかは二分探索、フォロー数は配列の長さで答える。
+    インデックスが使えない(無効・まだ作っていない・別のスレッドが作り直し中)ときはNoneを返す。
+    """
+
+    def __init__(self, enabled=None, cache_alias=None, check_interval=None):
+        # enabledを省略するとsettings.FOLLOW_INDEX_ENABLEDに従う(テストで設定を変えられるように毎回読む)
+        self._enabled = enabled
+        self.cache_alias = settings.FOLLOW_INDEX_CACHE_ALIAS if cache_alias is None else cache_alias
+        self.check_interval = settings.FOLLOW_INDEX_CHECK_INTERVAL if check_interval is None else check_interval
+        self._lock = threading.Lock()
+        # 全体の読み込みは1つのスレッドだけが行い、その間ほかのスレッドはDBに問い合わせる
+        self._build_lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # 読み込んだ内容を捨てる。次に使うときに全体を読み込み直す
+        with self._lock:
+            self._following = {}
+            self._followers = {}
+            self.edge_count = 0
+            # 読み込んだ内容がどの共有のバージョンのものか。Noneはまだ読み込んでいない
+            self.version = None
+            self._checked_at = float("-inf")
+
+    def _cache(self):
+        return caches[self.cache_alias]
+
+    def shared_version(self):
+        cache = self._cache()
+        cache.add(VERSION_KEY, 0, timeout=None)
+        return cache.get(VERSION_KEY, 0)
+
+    def build(self, using=None):
+        """
+        全フォロー関係を読み込んで作り直す。読み込む前のバージョンを記録するので、
+        読み込み中に変わった分は次の確認で取り込まれる。
+        """
+        version = self.shared_version()
+        following = {}
+        followers = {}
+        edge_count = 0
+        follower_id = current = None
+        # unique_friendshipのインデックスの順に読むので、フォローしている人もフォロワーも昇順に追加される
+        edges = FriendShip.objects.using(using).order_by("follower_id", "following_id")
+        for row_follower_id, following_id in edges.values_list("follower_id", "following_id").iterator(10000):
+            if row_follower_id != follower_id:
+                follower_id = row_follower_id
+                current = following[follower_id] = array("q")
+            current.append(following_id)
+            ids = followers.get(following_id)
+            if ids is None:
+                ids = followers[following_id] = array("q")
+            ids.append(follower_id)
+            edge_count += 1
+        with self._lock:
+            self._following, self._followers = following, followers
+            self.edge_count = edge_count
+            self.version = version
+            self._checked_at = time.monotonic()
+
+    def _apply(self, follower_id, following_id, followed):
+        # self._lockを取ってから呼ぶ。すでに取り込んである変更なら何もしない
+        if _contains(self._following.get(follower_id, EMPTY), following_id) == followed:
+            return
+        for lists, key, value in (
+            (self._following, follower_id, following_id),
+            (self._followers, following_id, follower_id),
+        ):
+            ids = lists.setdefault(key, array("q"))
+            if followed:
+                insort(ids, value)
+            else:
+                del ids[bisect_left(ids, value)]
+                if not ids:
+                    del lists[key]
+        self.edge_count += 1 if followed else -1
+
+    def refresh(self):
+        """
+        共有のバージョンまで変更を取り込む。取り込めないほど遅れていれば全体を読み込み直す。
+        使える状態になればTrue、別のスレッドが読み込み中ならFalseを返す。
+        """
+        shared = self.shared_version()
+        local = self.version
+        if local is not None and local <= shared and shared - local <= MAX_CATCH_UP:
+            keys = [_change_key(version) for version in range(local + 1, shared + 1)]
+            changes = self._cache().get_many(keys)
+            if len(changes) == len(keys):
+                with self._lock:
+                    # 待っている間に他のスレッドが取り込んでいたら、その続きから取り込む
+                    if self.version is not None:
+                        for version in range(self.version + 1, shared + 1):
+                            for follower_id, following_id, followed in changes[_change_key(version)]:
+                                self._apply(follower_id, following_id, followed)
+                        self.version = max(self.version, shared)
+                        self._checked_at = time.monotonic()
+                        return True
+        if not self._build_lock.acquire(blocking=False):
+            return False
+        try:
+            self.build()
+        finally:
+            self._build_lock.release()
+        return True
+
+    @property
+    def enabled(self):
+        return settings.FOLLOW_INDEX_ENABLED if self._enabled is None else self._enabled
+
+    def ready(self):
+        if not self.enabled:
+            return False
+        if self.version is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return True
+        return self.refresh()
+
+    def record(self, changes):
+        """
+        changes([(フォローする人のid, フォローされる人のid, フォローしたらTrue・解除したらFalse)])を
+        共有のバージョン1つ分として記録し、このプロセスのインデックスにもすぐ取り込む。
+        """
+        cache = self._cache()
+        cache.add(VERSION_KEY, 0, timeout=None)
+        version = cache.incr(VERSION_KEY)
+        cache.set(_change_key(version), list(changes), CHANGE_TIMEOUT)
+        if self.version is not None:
+            self.refresh()
+
+    def invalidate(self):
+        # 変更内容を書かずにバージョンだけ進め、すべてのプロセスに全体を読み込み直させる(一括で書き込んだ後など)
+        cache = self._cache()
+        cache.add(VERSION_KEY, 0, timeout=None)
+        cache.incr(VERSION_KEY)
+
+    def is_following(self, follower_id, following_id):
+        if not self.ready():
+            return None
+        with self._lock:
+            return _contains(self._following.get(follower_id, EMPTY), following_id)
+
+    def counts(self, user_id):
+        # (フォロー数, フォロワー数)
+        if not self.ready():
+            return None
+        with self._lock:
+            return len(self._following.get(user_id, EMPTY)), len(self._followers.get(user_id, EMPTY))
+
+    def relationship(self, user_id, other_id):
+        # (user_idがother_idをフォローしているか, other_idがuser_idをフォローしているか)。両方Trueなら相互フォロー
+        if not self.ready():
+            return None
+        with self._lock:
+            following = self._following.get(user_id, EMPTY)
+            followers = self._followers.get(user_id, EMPTY)
+            return _contains(following, other_id), _contains(followers, other_id)
+
+    def nbytes(self):
+        # 辞書と配列が使っているメモリのバイト数(辞書のキーのintも含める)
+        with self._lock:
+            total = 0
+            for lists in (self._following, self._followers):
+                total += sys.getsizeof(lists)
+                total += sum(sys.getsizeof(key) + sys.getsizeof(ids) for key, ids in lists.items())
+            return total
+
+
+index = FollowIndex()
+
+
+def record(changes):
+    # トランザクションのコミット後に記録する。ロールバックされた変更はインデックスに入れない
+    if not index.enabled:
+        return
+    changes = list(changes)
+    if changes:
+        transaction.on_commit(lambda: index.record(changes))
+
+
+def invalidate():
+    # シグナルを送らずに一括で書き込んだ後(generate_social_graphなど)に、すべてのプロセスで読み込み直させる
+    if index.enabled:
+        index.invalidate()
+
+
+def warm():
+    """
+    起動時(mysite/wsgi.py・asgi.py)に全体を読み込んでおき、最初のリクエストで読み込まないようにする。
+    FOLLOW_INDEX_CACHE_ALIASがプロセスごとのキャッシュなら、ワーカーの間で表示がずれ続けるので起動させない。
+    """
+    if index.enabled:
+        if isinstance(index._cache(), PROCESS_LOCAL_CACHES):
+            raise ImproperlyConfigured(
+                "FOLLOW_INDEX_ENABLEDをTrueにする場合は、DJANGO_SHARED_CACHE_URLを設定して"
+                f"キャッシュ{index.cache_alias!r}をプロセスの間で共有してください。"
+            )
+        index.refresh()
+        # 起動時のスレッドで開いたDB接続を閉じる
+        connections.close_all()
@@ -1,3 +1,6 @@
+import re
+
+from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
 
@@ -27,3 +30,31 @@ class LoginForm(AuthenticationForm):
         super().__init__(*args, **kwargs)
         for field in self.fields.values():
             field.widget.attrs["placeholder"] = field.label
+
+
+class BulkFollowForm(forms.Form):
+    # 一度に指定できるユーザ数の上限
+    MAX_USERNAMES = 1000
+
+    action = forms.ChoiceField(choices=[("follow", "フォロー"), ("unfollow", "フォロー解除")])
+    # カンマ・空白・改行区切りのユーザ名
+    usernames = forms.CharField(widget=forms.Textarea)
+
+    def clean_usernames(self):
+        # 重複を除き、指定された順番のままリストにする
+        usernames = split_usernames(self.cleaned_data["usernames"])
+        if not usernames:
+            raise forms.ValidationError("ユーザ名を指定してください。")
+        if len(usernames) > self.MAX_USERNAMES:
+            raise forms.ValidationError(f"一度に指定できるユーザは{self.MAX_USERNAMES}人までです。")
+        return usernames
+
+
+def split_usernames(value):
+    # カンマ・空白・改行区切りのユーザ名から、重複を除き、指定された順番のままリストにする
+    return list(dict.fromkeys(name for name in re.split(r"[\s,]+", value) if name))
+
+
+def bulk_follow_cost(request):
+    # 回数の制限(mysite/ratelimit.py)で、一括フォロー・フォロー解除はユーザ名1つにつきトークンを1個使う
+    return max(1, len(split_usernames(request.POST.get("usernames", ""))))
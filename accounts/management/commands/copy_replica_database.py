@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = "手元でレプリカを試すために、プライマリ(default)のSQLiteのデータベースをレプリカのファイルにコピーする。"
+
+    def handle(self, *args, **options):
+        if settings.REPLICA_DATABASE is None:
+            raise CommandError(
+                "レプリカがありません。環境変数DJANGO_REPLICA_DBにコピー先のファイルを指定してください。"
+            )
+        primary = connections[DEFAULT_DB_ALIAS]
+        replica = connections[settings.REPLICA_DATABASE]
+        if primary.vendor != "sqlite" or replica.vendor != "sqlite":
+            raise CommandError("SQLiteのデータベースしかコピーできません。")
+
+        # ファイルをそのままコピーすると書き込み中の内容が壊れることがあるので、SQLiteのバックアップを使う
+        primary.ensure_connection()
+        replica.ensure_connection()
+        primary.connection.backup(replica.connection)
+        self.stdout.write(self.style.SUCCESS(f"{replica.settings_dict['NAME']}にコピーしました。"))
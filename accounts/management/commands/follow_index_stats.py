@@ -0,0 +1,46 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from accounts.follow_index import FollowIndex
+
+
+class Command(BaseCommand):
+    help = "フォロー関係のインデックス(accounts/follow_index.py)を作り、作成時間・メモリ使用量・問い合わせ時間を表示する。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lookups", type=int, default=100000, help="時間を測る問い合わせの回数")
+        parser.add_argument("--seed", type=int, default=0, help="問い合わせるユーザを選ぶ乱数のシード")
+
+    def handle(self, *args, **options):
+        # settings.FOLLOW_INDEX_ENABLEDによらず、このコマンドの中だけで作って測る。
+        # 測っている間にバージョンを確かめに行かないように、確かめる間隔を無限にする
+        index = FollowIndex(enabled=True, check_interval=float("inf"))
+        started_at = time.perf_counter()
+        index.build()
+        build_seconds = time.perf_counter() - started_at
+        nbytes = index.nbytes()
+        edges = index.edge_count
+        self.stdout.write(f"フォロー関係: {edges}本 フォローしているユーザ: {len(index._following)}人")
+        self.stdout.write(f"作成時間: {build_seconds:.2f}秒")
+        self.stdout.write(f"メモリ: {nbytes / 2**20:.1f} MiB")
+        if edges:
+            self.stdout.write(f"フォロー100万本あたり: {nbytes / edges * 1_000_000 / 2**20:.1f} MiB")
+
+        # ランダムなユーザの組で問い合わせ時間を測る
+        user_ids = list(index._following) + list(index._followers)
+        if not user_ids:
+            return
+        rng = random.Random(options["seed"])
+        pairs = [(rng.choice(user_ids), rng.choice(user_ids)) for _ in range(options["lookups"])]
+        for name, lookup in (
+            ("is_following", index.is_following),
+            ("relationship", index.relationship),
+            ("counts", lambda user_id, other_id: index.counts(user_id)),
+        ):
+            started_at = time.perf_counter()
+            for user_id, other_id in pairs:
+                lookup(user_id, other_id)
+            elapsed = time.perf_counter() - started_at
+            self.stdout.write(f"{name}: 1回あたり{elapsed / len(pairs) * 1e6:.2f}マイクロ秒")
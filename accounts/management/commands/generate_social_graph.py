@@ -0,0 +1,251 @@
+from array import array
+from bisect import bisect
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+from accounts import follow_index
+from accounts.models import FriendShip
+from tweets import search
+from tweets.models import Tweet
+
+CustomUser = get_user_model()
+
+# 負荷試験用に、ユーザ・ツイート・フォロー関係を大量に作る。
+# SignupFormやモデルのsave()を通すとパスワードのハッシュ化と1行ずつのINSERTで遅いので、
+# ハッシュ化したパスワードを1つだけ作って全員で使い、INSERTはexecutemany()でbatch_size行ずつまとめる。
+#
+# フォロワー数とツイート数は、少数の人気ユーザに集中するべき乗分布(Zipf分布)にする。
+# ツイートの投稿日時は最近のものほど多くなるようにする。
+# 同じ--seedと--endなら毎回同じデータになる。受信箱(TimelineEntry)は作らないので、必要ならrebuild_timelinesを実行する。
+
+WORDS = (
+    "django python sqlite index query cache timeline follow tweet profile async server "
+    "今日 明日 天気 ランチ 仕事 勉強 映画 音楽 旅行 週末 カフェ コーヒー 散歩 読書 ゲーム"
+).split()
+
+
+def zipf_cum_weights(n, exponent):
+    # 順位rank(0始まり)の重みを1 / (rank + 1)^exponentにした累積の重み
+    return list(accumulate(1.0 / (rank + 1) ** exponent for rank in range(n)))
+
+
+def weighted_sampler(rng, population, exponent):
+    # populationを乱数で並べ替えて順位を決め、順位が上のものほど選ばれやすくする
+    population = list(population)
+    rng.shuffle(population)
+    cum_weights = zipf_cum_weights(len(population), exponent)
+    total = cum_weights[-1]
+    last = len(population) - 1
+
+    def sample():
+        return population[min(bisect(cum_weights, rng.random() * total), last)]
+
+    return sample
+
+
+class Command(BaseCommand):
+    help = "負荷試験用のユーザ・ツイート・フォロー関係を、べき乗分布で高速に大量作成する。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100000, help="作成するユーザ数")
+        parser.add_argument("--tweets", type=int, default=1000000, help="作成するツイートの総数")
+        parser.add_argument("--follows-per-user", type=int, default=50, help="1ユーザあたりのフォロー数の平均")
+        parser.add_argument("--days", type=int, default=365, help="この日数前から--endまでの間にデータを作る")
+        parser.add_argument("--end", help="データの最後の日時(ISO形式)。省略すると今日の0時(UTC)")
+        parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+        parser.add_argument("--follower-exponent", type=float, default=1.0, help="フォロワー数の偏り(大きいほど集中)")
+        parser.add_argument("--tweet-exponent", type=float, default=1.0, help="ツイート数の偏り(大きいほど集中)")
+        parser.add_argument("--recency-skew", type=float, default=3.0, help="大きいほどツイートが最近に集中する")
+        parser.add_argument("--password", default="password", help="全ユーザ共通のパスワード")
+        parser.add_argument("--prefix", default="gen", help="ユーザ名の前につける文字列")
+        parser.add_argument("--batch-size", type=int, default=50000, help="1回のexecutemany()とトランザクションの行数")
+
+    def handle(self, *args, **options):
+        if options["users"] < 2:
+            raise CommandError("--usersは2以上にしてください。")
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        if options["end"]:
+            self.end = datetime.fromisoformat(options["end"]).replace(tzinfo=timezone.utc)
+        else:
+            self.end = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.span = timedelta(days=options["days"]).total_seconds()
+
+        started_at = time.perf_counter()
+        with self.fast_sqlite_writes():
+            user_ids, joined = self.create_users(options)
+            self.report("ユーザ", len(user_ids), started_at)
+            step_started_at = time.perf_counter()
+            follows = self.create_friendships(user_ids, joined, options)
+            self.report("フォロー関係", follows, step_started_at)
+            step_started_at = time.perf_counter()
+            self.create_tweets(user_ids, joined, options)
+            self.report("ツイート", options["tweets"], step_started_at)
+            self.reset_sequences()
+        # FriendShipのシグナルを送らずに書き込んだので、フォロー関係のインデックスを読み込み直させる
+        follow_index.invalidate()
+
+        elapsed = time.perf_counter() - started_at
+        total = len(user_ids) + follows + options["tweets"]
+        self.stdout.write(self.style.SUCCESS(f"合計{total}行を{elapsed:.1f}秒で作成しました。"))
+
+    def report(self, label, count, started_at):
+        elapsed = time.perf_counter() - started_at
+        self.stdout.write(f"{label}: {count}行 {elapsed:.1f}秒 ({count / max(elapsed, 1e-9):.0f}行/秒)")
+
+    @contextmanager
+    def fast_sqlite_writes(self):
+        # SQLiteでは作成中だけディスクへの同期を省く。途中で落ちた場合は作り直す前提
+        # (トランザクションの中では変えられないので、テストなどでは省かない)
+        if connection.vendor != "sqlite" or connection.in_atomic_block:
+            yield
+            return
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            old_synchronous = cursor.fetchone()[0]
+            cursor.execute("PRAGMA synchronous = OFF")
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f"PRAGMA synchronous = {int(old_synchronous)}")
+
+    def insert_many(self, model, field_names, rows, atomic=transaction.atomic):
+        # rowsをbatch_size行ずつ、1回のexecutemany()と1つのトランザクション(atomic())で書き込む
+        opts = model._meta
+        columns = ", ".join(connection.ops.quote_name(opts.get_field(name).column) for name in field_names)
+        placeholders = ", ".join(["%s"] * len(field_names))
+        sql = f"INSERT INTO {connection.ops.quote_name(opts.db_table)} ({columns}) VALUES ({placeholders})"
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self.execute_many(sql, batch, atomic)
+                batch = []
+        if batch:
+            self.execute_many(sql, batch, atomic)
+
+    def execute_many(self, sql, rows, atomic=transaction.atomic):
+        with atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+
+    def timestamp(self, seconds_before_end):
+        return connection.ops.adapt_datetimefield_value(self.end - timedelta(seconds=seconds_before_end))
+
+    def create_users(self, options):
+        # idを自分で振るので、既存のユーザの後ろから始める
+        first_id = (CustomUser.objects.aggregate(max_id=Max("pk"))["max_id"] or 0) + 1
+        user_ids = range(first_id, first_id + options["users"])
+        # 登録日時(--endの何秒前か)。フォロー関係やツイートの日時は登録日時より後にする
+        joined = array("d", (self.rng.random() * self.span for _ in user_ids))
+        password = make_password(options["password"])
+        prefix = options["prefix"]
+        rows = (
+            (user_id, password, False, f"{prefix}{user_id}", "", "", "", False, True, self.timestamp(joined[i]), 0, 0)
+            for i, user_id in enumerate(user_ids)
+        )
+        fields = [
+            "id",
+            "password",
+            "is_superuser",
+            "username",
+            "first_name",
+            "last_name",
+            "email",
+            "is_staff",
+            "is_active",
+            "date_joined",
+            "follower_count",
+            "following_count",
+        ]
+        self.insert_many(CustomUser, fields, rows)
+        return user_ids, joined
+
+    def create_friendships(self, user_ids, joined, options):
+        """
+        1人ずつ、フォロー数をパレート分布(平均--follows-per-user)で決め、
+        フォロー先を人気の順位によるZipf分布で選ぶ。作った行数を返す。
+        """
+        rng = self.rng
+        first_id = user_ids[0]
+        pick_following = weighted_sampler(rng, user_ids, options["follower_exponent"])
+        # パレート分布(alpha=2)の平均は2なので、半分にすると平均が--follows-per-userになる
+        scale = options["follows_per_user"] / 2
+        limit = len(user_ids) - 1
+        follower_counts = array("l", [0]) * len(user_ids)
+        following_counts = array("l", [0]) * len(user_ids)
+
+        def rows():
+            for follower_id in user_ids:
+                degree = min(limit, int(rng.paretovariate(2) * scale))
+                followings = {pick_following() for _ in range(degree)}
+                followings.discard(follower_id)
+                follower_index = follower_id - first_id
+                following_counts[follower_index] = len(followings)
+                for following_id in sorted(followings):
+                    following_index = following_id - first_id
+                    follower_counts[following_index] += 1
+                    # 2人とも登録した後の日時にする
+                    latest_joined = min(joined[follower_index], joined[following_index])
+                    yield follower_id, following_id, self.timestamp(rng.random() * latest_joined)
+
+        self.insert_many(FriendShip, ["follower", "following", "created_at"], rows())
+
+        # フォロー数・フォロワー数をまとめて書き込む
+        counts = (
+            (follower_counts[i], following_counts[i], user_id)
+            for i, user_id in enumerate(user_ids)
+            if follower_counts[i] or following_counts[i]
+        )
+        opts = CustomUser._meta
+        quote_name = connection.ops.quote_name
+        sql = (
+            f"UPDATE {quote_name(opts.db_table)} SET {quote_name('follower_count')} = %s, "
+            f"{quote_name('following_count')} = %s WHERE {quote_name(opts.pk.column)} = %s"
+        )
+        batch = []
+        for row in counts:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self.execute_many(sql, batch)
+                batch = []
+        if batch:
+            self.execute_many(sql, batch)
+        return sum(following_counts)
+
+    def create_tweets(self, user_ids, joined, options):
+        # 投稿者は投稿数の順位によるZipf分布で選び、投稿日時は登録日時から--endの間で最近に寄せる
+        rng = self.rng
+        first_id = user_ids[0]
+        pick_author = weighted_sampler(rng, user_ids, options["tweet_exponent"])
+        skew = options["recency_skew"]
+
+        def rows():
+            for _ in range(options["tweets"]):
+                user_id = pick_author()
+                content = " ".join(rng.choices(WORDS, k=rng.randint(3, 12)))
+                seconds_before_end = rng.random() ** skew * joined[user_id - first_id]
+                yield user_id, content, self.timestamp(seconds_before_end), 0
+
+        # 全文検索の索引は1行ずつではなく、バッチごとにまとめて入れる
+        self.insert_many(
+            Tweet, ["user", "content", "created_at", "favorite_count"], rows(), atomic=search.deferred_indexing
+        )
+
+    def reset_sequences(self):
+        # idを自分で振ったので、PostgreSQLなどでは連番を進めておく(SQLiteでは何もしない)
+        statements = connection.ops.sequence_reset_sql(no_style(), [CustomUser, Tweet, FriendShip])
+        if statements:
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
@@ -0,0 +1,45 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+
+from accounts.models import count_friendships
+
+CustomUser = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "CustomUserのフォロー数・フォロワー数をFriendShipから集計し直し、ずれている行だけまとめて更新する。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="1回のUPDATEで調べるユーザ数")
+
+    def handle(self, *args, **options):
+        fixed = 0
+        last_pk = 0
+        while True:
+            # pkの範囲ごとに区切り、1バッチにつきUPDATE文1回で直す
+            pks = list(
+                CustomUser.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", flat=True)[: options["batch_size"]]
+            )
+            if not pks:
+                break
+
+            with transaction.atomic():
+                fixed += (
+                    CustomUser.objects.filter(pk__gt=last_pk, pk__lte=pks[-1])
+                    .annotate(
+                        actual_follower_count=count_friendships("following"),
+                        actual_following_count=count_friendships("follower"),
+                    )
+                    .filter(
+                        ~Q(follower_count=F("actual_follower_count")) | ~Q(following_count=F("actual_following_count"))
+                    )
+                    .update(
+                        follower_count=count_friendships("following"), following_count=count_friendships("follower")
+                    )
+                )
+            last_pk = pks[-1]
+        self.stdout.write(self.style.SUCCESS(f"{fixed}人のフォロー数・フォロワー数を修正しました。"))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts import recommendations
+
+
+class Command(BaseCommand):
+    help = (
+        "フォロー関係から友達の友達を数え、ユーザごとのおすすめユーザを保存する。"
+        "前回の実行以降にフォローが変わったユーザとそのフォロワーだけを計算し直す。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true", help="全ユーザのおすすめを計算し直す")
+        parser.add_argument("--top-k", type=int, default=recommendations.TOP_K, help="1ユーザあたりに保存する候補の数")
+
+    def handle(self, *args, **options):
+        if options["top_k"] < 1:
+            raise CommandError("--top-kは1以上にしてください。")
+        started_at = time.perf_counter()
+        run = recommendations.refresh(full=options["full"], k=options["top_k"])
+        elapsed = time.perf_counter() - started_at
+        kind = "全ユーザ" if run.full else "差分"
+        self.stdout.write(
+            self.style.SUCCESS(f"{kind}: {run.user_count}人のおすすめを{elapsed:.1f}秒で計算し直しました。")
+        )
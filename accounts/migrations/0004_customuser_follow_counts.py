@@ -0,0 +1,38 @@
+# Generated by Django 4.1.13 on 2026-10-17 14:29
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_follow_counts(apps, schema_editor):
+    # 既存ユーザのフォロー数・フォロワー数をFriendShipから集計して埋める
+    CustomUser = apps.get_model("accounts", "CustomUser")
+    FriendShip = apps.get_model("accounts", "FriendShip")
+
+    def count_by(field):
+        counts = FriendShip.objects.filter(**{field: OuterRef("pk")}).order_by().values(field)
+        return Coalesce(Subquery(counts.annotate(count=Count("pk")).values("count")), 0)
+
+    CustomUser.objects.update(follower_count=count_by("following"), following_count=count_by("follower"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("accounts", "0003_alter_friendship_follower_alter_friendship_following"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customuser",
+            name="follower_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="フォロワー数"),
+        ),
+        migrations.AddField(
+            model_name="customuser",
+            name="following_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="フォロー数"),
+        ),
+        migrations.RunPython(populate_follow_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.1.13 on 2026-10-17 15:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("accounts", "0004_customuser_follow_counts"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="friendship",
+            name="follower",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="following",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="friendship",
+            name="following",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="follower",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(fields=["follower", "-created_at", "-id"], name="friendship_follower_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(fields=["following", "-created_at", "-id"], name="friendship_following_idx"),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.1.13 on 2026-10-17 15:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("accounts", "0005_friendship_created_at_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecommendationRun",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("started_at", models.DateTimeField()),
+                ("full", models.BooleanField(default=False, verbose_name="全ユーザを計算したか")),
+                ("user_count", models.PositiveIntegerField(default=0, verbose_name="計算し直したユーザ数")),
+            ],
+        ),
+        migrations.AddField(
+            model_name="customuser",
+            name="follows_changed_at",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name="FollowRecommendation",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("score", models.PositiveIntegerField(verbose_name="共通のフォロー数")),
+                (
+                    "candidate",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="+", to=settings.AUTH_USER_MODEL
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="recommendations",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="followrecommendation",
+            index=models.Index(fields=["user", "-score", "candidate"], name="recommendation_user_score_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="followrecommendation",
+            constraint=models.UniqueConstraint(fields=("user", "candidate"), name="unique_recommendation"),
+        ),
+    ]
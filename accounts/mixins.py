@@ -0,0 +1,28 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth.mixins import AccessMixin
+
+# 非同期ビュー(async def get()などを持つビュー)で使う部品。
+
+
+def _load_user(request):
+    # request.userは最初に属性を読んだときにセッションとユーザをDBから取得する遅延オブジェクト。
+    # 一度読めば結果が保存されるので、以降はテンプレートなどから触ってもDBには行かない
+    request.user.is_authenticated
+    return request.user
+
+
+async def aget_user(request):
+    # 非同期のコードから直接DBに触れるとSynchronousOnlyOperationになるので、スレッドで読み込む
+    return await sync_to_async(_load_user)(request)
+
+
+class AsyncLoginRequiredMixin(AccessMixin):
+    """
+    LoginRequiredMixinの非同期ビュー版。ログインしていなければログイン画面にリダイレクトする。
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        user = await aget_user(request)
+        if not user.is_authenticated:
+            return self.handle_no_permission()
+        return await super().dispatch(request, *args, **kwargs)
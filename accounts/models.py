@@ -1,10 +1,144 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 
 
 class CustomUser(AbstractUser):
     # AbstractUserを継承してモデルをつくり，Emailフィールドのカラムを追加
     email = models.EmailField()
+    # プロフィール画面で毎回FriendShipをCOUNT(*)しなくて済むように数を持っておく。
+    # 更新はFriendShip.objects.follow()/unfollow()でF()式を使ってフォロー関係の書き込みと同じトランザクションで行う。
+    # ずれた場合はreconcile_follow_countsコマンドで直す
+    follower_count = models.PositiveIntegerField(default=0, verbose_name="フォロワー数")
+    following_count = models.PositiveIntegerField(default=0, verbose_name="フォロー数")
+    # このユーザのフォローが最後に変わった日時。フォロー数と同じUPDATEで書き込み、
+    # おすすめユーザ(accounts/recommendations.py)の差分更新で計算し直すユーザを決めるのに使う
+    follows_changed_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+
+def count_friendships(field):
+    # CustomUserごとにFriendShipをfield("follower"か"following")で数えるサブクエリ。該当行がないとNULLになるので0にする
+    counts = FriendShip.objects.filter(**{field: OuterRef("pk")}).order_by().values(field)
+    return Coalesce(Subquery(counts.annotate(count=Count("pk")).values("count")), 0)
+
+
+class FriendShipManager(models.Manager):
+    # bulk_followで1つのINSERTに入れる行数。1行3パラメータなのでSQLiteの変数の上限に収まる
+    INSERT_BATCH_SIZE = 300
+
+    def follow(self, follower, following):
+        # フォロー関係を作り、followerのフォロー数とfollowingのフォロワー数を1増やす
+        with transaction.atomic():
+            friendship = self.create(follower=follower, following=following)
+            CustomUser.objects.filter(pk=follower.pk).update(
+                following_count=F("following_count") + 1, follows_changed_at=timezone.now()
+            )
+            CustomUser.objects.filter(pk=following.pk).update(follower_count=F("follower_count") + 1)
+        return friendship
+
+    def unfollow(self, follower, following):
+        # フォロー関係を削除し、削除できた場合だけ数を1減らす。削除できたかどうかを返す
+        with transaction.atomic():
+            deleted, _ = self.filter(follower=follower, following=following).delete()
+            if deleted:
+                # 数がずれていてもマイナスにはしない(PositiveIntegerFieldの制約違反になるため)
+                CustomUser.objects.filter(pk=follower.pk).update(
+                    following_count=Greatest(F("following_count") - 1, 0), follows_changed_at=timezone.now()
+                )
+                CustomUser.objects.filter(pk=following.pk, follower_count__gt=0).update(
+                    follower_count=F("follower_count") - 1
+                )
+        return bool(deleted)
+
+    def _resolve_usernames(self, follower, usernames):
+        # ユーザ名をまとめて1回のクエリでidにする。存在しない・自分自身のユーザ名は結果に書き込んでおく
+        ids = dict(CustomUser.objects.filter(username__in=usernames).values_list("username", "pk"))
+        results = {}
+        for username in usernames:
+            if username not in ids:
+                results[username] = "not_found"
+            elif ids[username] == follower.pk:
+                results[username] = "self"
+        return ids, results
+
+    def bulk_follow(self, follower, usernames):
+        """
+        usernamesのユーザをまとめてフォローする。
+        ({ユーザ名: 結果}, 新しくフォローしたユーザのidのリスト)を返す。
+        結果は"followed", "already_following", "not_found", "self"のどれか。
+        """
+        ids, results = self._resolve_usernames(follower, usernames)
+        targets = {username: pk for username, pk in ids.items() if username not in results}
+        with transaction.atomic():
+            existing = set(
+                self.filter(follower=follower, following__in=targets.values()).values_list("following_id", flat=True)
+            )
+            new_ids = [pk for pk in targets.values() if pk not in existing]
+            created_ids = self._insert_ignoring_conflicts(follower, new_ids)
+            if created_ids:
+                # 無視された行の分まで数を増やさないように、数は作った後のFriendShipから数え直す
+                CustomUser.objects.filter(pk=follower.pk).update(
+                    following_count=count_friendships("follower"), follows_changed_at=timezone.now()
+                )
+                CustomUser.objects.filter(pk__in=created_ids).update(follower_count=count_friendships("following"))
+        created = set(created_ids)
+        for username, pk in targets.items():
+            results[username] = "followed" if pk in created else "already_following"
+        return {username: results[username] for username in usernames}, created_ids
+
+    def _insert_ignoring_conflicts(self, follower, following_ids):
+        """
+        followerからfollowing_idsへのFriendShipを作り、実際に作ったフォロー先のidのリストを返す。
+        同時に同じフォローが作られていた行はunique_friendship制約で無視される。
+        bulk_create(ignore_conflicts=True)はどの行が作れたかを返さないので、
+        ON CONFLICT DO NOTHING RETURNINGでこのINSERTが挿入した行だけを受け取る
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        columns = ", ".join(qn(opts.get_field(name).column) for name in ("follower", "following", "created_at"))
+        created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+        created_ids = []
+        with connection.cursor() as cursor:
+            for start in range(0, len(following_ids), self.INSERT_BATCH_SIZE):
+                batch = following_ids[start : start + self.INSERT_BATCH_SIZE]
+                sql = (
+                    f"INSERT INTO {qn(opts.db_table)} ({columns}) VALUES "
+                    + ", ".join(["(%s, %s, %s)"] * len(batch))
+                    + f" ON CONFLICT DO NOTHING RETURNING {qn(opts.get_field('following').column)}"
+                )
+                cursor.execute(sql, [param for pk in batch for param in (follower.pk, pk, created_at)])
+                created_ids += [row[0] for row in cursor.fetchall()]
+        return created_ids
+
+    def bulk_unfollow(self, follower, usernames):
+        """
+        usernamesのユーザのフォローをまとめて解除する。
+        ({ユーザ名: 結果}, フォロー解除したユーザのidのリスト)を返す。
+        結果は"unfollowed", "not_following", "not_found", "self"のどれか。
+        """
+        ids, results = self._resolve_usernames(follower, usernames)
+        targets = {username: pk for username, pk in ids.items() if username not in results}
+        with transaction.atomic():
+            # 消す行をロックしてから消す(SQLiteは書き込みが一度に1つだけなので、ロックしなくても同じになる)
+            friendships = self.filter(follower=follower, following__in=targets.values()).select_for_update()
+            existing = set(friendships.values_list("following_id", flat=True))
+            # delete()は消した行ごとにシグナルを送るので、プロフィールなどのキャッシュの削除と
+            # フォロー関係のインデックスへの記録はaccounts/signals.pyで行われる
+            deleted, _ = self.filter(follower=follower, following_id__in=existing).delete()
+            if deleted:
+                # フォロー数は実際に消せた行の数だけ減らす
+                CustomUser.objects.filter(pk=follower.pk).update(
+                    following_count=Greatest(F("following_count") - deleted, 0),
+                    follows_changed_at=timezone.now(),
+                )
+                # 同時に別のリクエストで解除されて消せなかった行があっても二重に減らさないように、フォロワー数は数え直す
+                CustomUser.objects.filter(pk__in=existing).update(follower_count=count_friendships("following"))
+        for username, pk in targets.items():
+            results[username] = "unfollowed" if pk in existing else "not_following"
+        return {username: results[username] for username in usernames}, list(existing)
 
 
 class FriendShip(models.Model):
@@ -29,10 +163,14 @@ class FriendShip(models.Model):
     user(Kyoko)「を」フォローしている(FriendShipモデルのfollowingフィールドがKyokoである)オブジェクト抽出
     """
 
-    follower = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="following")
-    following = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="follower")
+    # followerで絞り込むときはunique_friendshipとfriendship_follower_idx、
+    # followingで絞り込むときはfriendship_following_idxが使えるので、単独のインデックスは作らない
+    follower = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="following", db_index=False)
+    following = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="follower", db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = FriendShipManager()
+
     class Meta:
         verbose_name_plural = "フォロワー/フォロー"
         constraints = [
@@ -42,6 +180,38 @@ class FriendShip(models.Model):
                 name="unique_friendship",
             )
         ]
+        indexes = [
+            # フォローリスト・フォロワーリストのカーソルページング(created_at, idの降順)用の複合インデックス
+            models.Index(fields=["follower", "-created_at", "-id"], name="friendship_follower_idx"),
+            models.Index(fields=["following", "-created_at", "-id"], name="friendship_following_idx"),
+        ]
 
         def __str__(self):
             return f"{self.follower} → {self.following}"
+
+
+class FollowRecommendation(models.Model):
+    """
+    おすすめユーザ(友達の友達)。userがフォローしている人のうちcandidateをフォローしている人数をscoreとして、
+    ユーザごとに上位の候補だけをrefresh_recommendationsコマンドで保存しておく(accounts/recommendations.py)。
+    表示するときはuserで絞ったインデックスの範囲検索1回で済む。
+    """
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="recommendations", db_index=False)
+    candidate = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="+")
+    score = models.PositiveIntegerField(verbose_name="共通のフォロー数")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "candidate"], name="unique_recommendation"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "-score", "candidate"], name="recommendation_user_score_idx"),
+        ]
+
+
+class RecommendationRun(models.Model):
+    # refresh_recommendationsコマンドの実行記録。次の差分更新は前回のstarted_at以降にフォローが変わったユーザが対象
+    started_at = models.DateTimeField()
+    full = models.BooleanField(default=False, verbose_name="全ユーザを計算したか")
+    user_count = models.PositiveIntegerField(default=0, verbose_name="計算し直したユーザ数")
@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+
+from tweets.models import Tweet
+from tweets.pagination import KeysetPaginator
+
+from . import username_cache
+
+CustomUser = get_user_model()
+
+# プロフィール画面のうち、見ている人に関係なく同じになる部分(ユーザ本人の行・ツイート一覧・フォロー数)をキャッシュする。
+# キャッシュの保存先・有効期限・最大件数はsettings.CACHESのPROFILE_CACHE_ALIASで設定する。
+# 消すタイミングはaccounts/signals.pyでTweet・FriendShip・CustomUserの保存/削除を受け取って決めている。
+# キーはユーザのidにして、URLのユーザ名はusername_cacheでidに変換する。
+# シグナルで受け取るTweet・FriendShipにはidしかないので、消すときにユーザ名を問い合わせなくてよい。
+# ツイートの多いユーザでも1件が大きくならないように、キャッシュするツイートは1ページ目(TWEETS_PER_PAGE件)だけにする。
+# 2ページ目からはtweet_page()でカーソルから取る。
+
+# プロフィール画面の1ページあたりのツイート数
+TWEETS_PER_PAGE = 20
+
+
+def _cache():
+    return caches[settings.PROFILE_CACHE_ALIAS]
+
+
+def _key(user_id):
+    return f"profile:{user_id}"
+
+
+def _paginator(user):
+    return KeysetPaginator(Tweet.objects.filter(user=user), TWEETS_PER_PAGE)
+
+
+def _with_user(page, user):
+    # tweet.userで再度ユーザを取得しないように、取得済みのuserを入れておく
+    for tweet in page:
+        tweet.user = user
+    return page
+
+
+def tweet_page(user, cursor):
+    # 2ページ目からのツイート。キャッシュせずに(created_at, id)のカーソルから取る
+    return _with_user(_paginator(user).page(cursor), user)
+
+
+async def atweet_page(user, cursor):
+    # tweet_page()の非同期版
+    return _with_user(await _paginator(user).apage(cursor), user)
+
+
+def get_profile(username):
+    """
+    {"user": CustomUser, "tweet_page": 1ページ目のKeysetPage}を返す。ユーザが存在しなければNone。
+    """
+    # 存在しないとusername_cacheにキャッシュされているユーザ名ならSQLを実行しない
+    user_id = username_cache.get_cached_user_id(username)
+    if user_id is None:
+        return None
+    if user_id is not username_cache.NOT_CACHED:
+        profile = _cache().get(_key(user_id))
+        if profile is not None:
+            return profile
+        user = CustomUser.objects.filter(pk=user_id).first()
+    else:
+        # idがわからなければユーザ名でユーザを取り、ついでにidをキャッシュする
+        user = CustomUser.objects.filter(username=username).first()
+        username_cache.set_user_id(username, user.pk if user is not None else None)
+    if user is None:
+        return None
+    profile = {"user": user, "tweet_page": tweet_page(user, None)}
+    _cache().set(_key(user.pk), profile)
+    return profile
+
+
+async def aget_profile(username):
+    # get_profile()の非同期版
+    user_id = await username_cache.aget_cached_user_id(username)
+    if user_id is None:
+        return None
+    if user_id is not username_cache.NOT_CACHED:
+        profile = await _cache().aget(_key(user_id))
+        if profile is not None:
+            return profile
+        user = await CustomUser.objects.filter(pk=user_id).afirst()
+    else:
+        user = await CustomUser.objects.filter(username=username).afirst()
+        await username_cache.aset_user_id(username, user.pk if user is not None else None)
+    if user is None:
+        return None
+    profile = {"user": user, "tweet_page": await atweet_page(user, None)}
+    await _cache().aset(_key(user.pk), profile)
+    return profile
+
+
+def invalidate(*user_ids):
+    """
+    すぐに消したうえで、トランザクションのコミット後にもう一度消す。
+    コミット前に別のリクエストが古い内容を読んでキャッシュし直してしまっても、コミット後の削除で消える。
+    """
+    keys = [_key(user_id) for user_id in user_ids]
+    _cache().delete_many(keys)
+    transaction.on_commit(lambda: _cache().delete_many(keys))
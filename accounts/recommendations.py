@@ -0,0 +1,187 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+import heapq
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import FollowRecommendation, FriendShip, RecommendationRun
+
+CustomUser = get_user_model()
+
+# おすすめユーザ(友達の友達)の計算と読み出し。
+#
+# 表示のたびにFriendShipを自己結合して友達の友達を数えると、フォローが多いユーザほど重くなるので、
+# refresh_recommendationsコマンドでフォロー関係をまとめてメモリに読み込み(FollowGraph)、
+# ユーザごとに上位TOP_K人の候補をFollowRecommendationに保存しておく。
+# 画面からはsuggestions()でuserのインデックスを1回引くだけにする。
+#
+# 差分更新では、前回の実行以降にフォローが変わったユーザ(CustomUser.follows_changed_at)と、
+# そのユーザのフォロワー(友達の友達が変わる人)だけを計算し直す。
+# ユーザの削除はfollows_changed_atに残らないので、ときどき--fullで全員を計算し直す。
+
+# 1ユーザあたりに保存する候補の数
+TOP_K = 20
+
+# 保存するときに1つのトランザクションで書き込むユーザ数
+BATCH_SIZE = 1000
+
+# 画面に表示する候補の数
+DISPLAY_LIMIT = 5
+
+
+class FollowGraph:
+    """
+    フォロー関係をCSR形式(ユーザごとの隣接リストを1本の配列につなげたもの)で持つ。
+    ユーザはidの昇順に振った0始まりの番号で表し、user_ids[i]がi番目のユーザのid。
+    i番目のユーザがフォローしているユーザの番号はfollowing[following_offsets[i]:following_offsets[i + 1]]にあり、
+    フォロワーも同じ形でfollowersに持つ。どちらも番号の昇順に並んでいる。
+    intのリストやsetで持つより小さく、1本のフォローあたり2つの配列で16バイトで済む。
+    """
+
+    def __init__(self, user_ids, edges):
+        # user_ids: ユーザのidの昇順。edges: (フォローする人のid, フォローされる人のid)を、この組の昇順に並べたもの
+        self.user_ids = array("q", user_ids)
+        size = len(self.user_ids)
+        # edgesはフォローする人の順に並んでいるので、そのまま追加すればフォローの隣接リストになる
+        degrees = array("q", [0]) * (size + 1)
+        self.following = array("q")
+        for follower_id, following_id in edges:
+            follower, followee = self.index(follower_id), self.index(following_id)
+            if follower is None or followee is None:
+                # user_idsを読んだ後に作られたユーザ。follows_changed_atが新しいので次の差分更新で計算される
+                continue
+            degrees[follower + 1] += 1
+            self.following.append(followee)
+        self.following_offsets = self._offsets(degrees)
+
+        # フォロワーの隣接リストは、フォローの隣接リストを逆向きにして作る(計数ソート)。
+        # フォローする人の番号の順に置いていくので、それぞれのフォロワーも番号の昇順になる
+        in_degrees = array("q", [0]) * (size + 1)
+        for followee in self.following:
+            in_degrees[followee + 1] += 1
+        self.follower_offsets = self._offsets(in_degrees)
+        self.followers = array("q", [0]) * len(self.following)
+        positions = array("q", self.follower_offsets)
+        for follower in range(size):
+            for followee in self.following_of(follower):
+                self.followers[positions[followee]] = follower
+                positions[followee] += 1
+
+    @classmethod
+    def load(cls, using=None):
+        # 全ユーザのidと全フォロー関係を読み込む。フォロー関係はunique_friendshipのインデックスの順に読める
+        user_ids = CustomUser.objects.using(using).order_by("pk").values_list("pk", flat=True)
+        edges = FriendShip.objects.using(using).order_by("follower_id", "following_id")
+        return cls(
+            user_ids.iterator(chunk_size=BATCH_SIZE * 10),
+            edges.values_list("follower_id", "following_id").iterator(chunk_size=BATCH_SIZE * 10),
+        )
+
+    @staticmethod
+    def _offsets(degrees):
+        # degrees[i + 1]がi番目のユーザの次数の配列を、その場で累積和にして隣接リストの開始位置にする
+        for i in range(1, len(degrees)):
+            degrees[i] += degrees[i - 1]
+        return degrees
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def index(self, user_id):
+        # ユーザのidを番号にする。いなければNone
+        i = bisect_left(self.user_ids, user_id)
+        if i < len(self.user_ids) and self.user_ids[i] == user_id:
+            return i
+        return None
+
+    def following_of(self, i):
+        return self.following[self.following_offsets[i] : self.following_offsets[i + 1]]
+
+    def followers_of(self, i):
+        return self.followers[self.follower_offsets[i] : self.follower_offsets[i + 1]]
+
+    @property
+    def nbytes(self):
+        # 配列が使っているメモリのバイト数
+        arrays = (self.user_ids, self.following_offsets, self.following, self.follower_offsets, self.followers)
+        return sum(a.itemsize * len(a) for a in arrays)
+
+    def affected(self, user_ids):
+        """
+        user_idsのユーザのフォローが変わったときに、おすすめが変わりうるユーザの番号の集合を返す。
+        本人(フォローしている人と候補から除く人が変わる)と、そのフォロワー(友達の友達が変わる)。
+        """
+        result = set()
+        for user_id in user_ids:
+            i = self.index(user_id)
+            if i is not None:
+                result.add(i)
+                result.update(self.followers_of(i))
+        return result
+
+    def recommend(self, i, k=TOP_K):
+        """
+        i番目のユーザのおすすめを[(候補のid, 共通のフォロー数)]で多い順にk件返す。
+        同じ数ならidの小さい順。自分とフォロー済みのユーザは含めない。
+        """
+        following = self.following_of(i)
+        scores = Counter()
+        for middle in following:
+            scores.update(self.following_of(middle))
+        scores.pop(i, None)
+        for followee in following:
+            scores.pop(followee, None)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+        return [(self.user_ids[candidate], score) for candidate, score in best]
+
+
+def save(graph, indexes, k=TOP_K):
+    # indexesの番号のユーザのおすすめを計算し、BATCH_SIZE人ずつ古いものと入れ替える
+    indexes = sorted(indexes)
+    for start in range(0, len(indexes), BATCH_SIZE):
+        batch = indexes[start : start + BATCH_SIZE]
+        rows = [
+            FollowRecommendation(user_id=graph.user_ids[i], candidate_id=candidate_id, score=score)
+            for i in batch
+            for candidate_id, score in graph.recommend(i, k)
+        ]
+        with transaction.atomic():
+            FollowRecommendation.objects.filter(user_id__in=[graph.user_ids[i] for i in batch]).delete()
+            FollowRecommendation.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+
+
+def refresh(full=False, k=TOP_K):
+    """
+    おすすめを計算し直して保存し、実行記録(RecommendationRun)を返す。
+    前回の実行がないかfull=Trueなら全ユーザ、それ以外は前回の実行の開始以降にフォローが変わったユーザとそのフォロワーが対象。
+    """
+    # 読み込みの途中で変わったフォローも次回の対象になるように、読み込む前の日時を記録する
+    started_at = timezone.now()
+    last_run = RecommendationRun.objects.order_by("-started_at").first()
+    full = full or last_run is None
+    graph = FollowGraph.load()
+    if full:
+        indexes = range(len(graph))
+    else:
+        changed = CustomUser.objects.filter(follows_changed_at__gte=last_run.started_at)
+        indexes = graph.affected(changed.values_list("pk", flat=True).iterator())
+    save(graph, indexes, k)
+    return RecommendationRun.objects.create(started_at=started_at, full=full, user_count=len(indexes))
+
+
+def suggestions(user_id, limit=DISPLAY_LIMIT):
+    """
+    user_idのユーザのおすすめを共通のフォロー数の多い順にlimit件返すquerysetで、候補のユーザも一緒に読み込む。
+    前回の計算の後にフォローしたユーザはNOT EXISTSで除く。どちらもインデックスを引くだけの1回のSQLになる。
+    """
+    already_following = FriendShip.objects.filter(follower_id=user_id, following_id=OuterRef("candidate_id"))
+    return (
+        FollowRecommendation.objects.filter(user_id=user_id)
+        .filter(~Exists(already_following))
+        .select_related("candidate")
+        .order_by("-score", "candidate_id")[:limit]
+    )
@@ -0,0 +1,57 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from tweets import fragments
+from tweets.models import Tweet
+
+from . import follow_index, profile_cache, user_cache, username_cache
+from .models import FriendShip
+
+CustomUser = get_user_model()
+
+
+@receiver([post_save, post_delete], sender=Tweet)
+def invalidate_tweet_author_profile(sender, instance, **kwargs):
+    # ツイートの投稿・削除で投稿者のツイート一覧が変わる
+    profile_cache.invalidate(instance.user_id)
+
+
+@receiver(post_delete, sender=Tweet)
+def invalidate_tweet_fragment(sender, instance, **kwargs):
+    # ツイートは編集できないので、キャッシュした表示用のHTMLを消すのは削除のときだけ
+    fragments.invalidate(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=FriendShip)
+def invalidate_friendship_profiles(sender, instance, **kwargs):
+    # フォロー・フォロー解除で両者のフォロー数・フォロワー数が変わる
+    profile_cache.invalidate(instance.follower_id, instance.following_id)
+    user_cache.invalidate(instance.follower_id, instance.following_id)
+
+
+@receiver([post_save, post_delete], sender=FriendShip)
+def record_friendship_change(sender, instance, signal, **kwargs):
+    # プロセス内のフォロー関係のインデックスに、コミット後に取り込む(FriendShipは更新されず作成・削除だけ)
+    follow_index.record([(instance.follower_id, instance.following_id, signal is post_save)])
+
+
+@receiver(pre_save, sender=CustomUser)
+def invalidate_renamed_user_profile(sender, instance, update_fields=None, **kwargs):
+    # ユーザ名が変わる場合は、古いユーザ名からidへの変換も消す(プロフィールはidで引くのでpost_saveで消える)
+    if instance.pk is None or (update_fields is not None and "username" not in update_fields):
+        return
+    old_username = CustomUser.objects.filter(pk=instance.pk).values_list("username", flat=True).first()
+    if old_username is not None and old_username != instance.username:
+        username_cache.invalidate(old_username)
+        # ツイートの表示用のHTMLには投稿者のユーザ名が入っている
+        fragments.invalidate_user(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=CustomUser)
+def invalidate_user_profile(sender, instance, **kwargs):
+    profile_cache.invalidate(instance.pk)
+    # パスワードの変更・最終ログイン日時の更新・削除などでキャッシュしたログイン中のユーザが古くなる
+    user_cache.invalidate(instance.pk)
+    # 登録で「存在しない」とキャッシュしていたユーザ名が使われるようになり、削除で使われなくなる
+    username_cache.invalidate(instance.username)
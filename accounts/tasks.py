@@ -0,0 +1,15 @@
+from jobs.queue import task
+from tweets import timeline
+
+from .models import FriendShip
+
+# バックグラウンドのジョブ(jobs/queue.py)として実行する処理。runworkerコマンドのワーカーで実行される。
+
+
+@task
+def backfill_timeline(owner_id, author_ids):
+    # ジョブを実行するまでにフォロー解除したユーザのツイートは入れない
+    author_ids = FriendShip.objects.filter(follower_id=owner_id, following_id__in=author_ids).values_list(
+        "following_id", flat=True
+    )
+    timeline.backfill(owner_id, list(author_ids))
@@ -1,12 +1,32 @@
+from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+import tempfile
+from unittest import mock
+
 from django.conf import settings
 from django.contrib.auth import SESSION_KEY, get_user_model
 from django.contrib.messages import get_messages
-from django.test import TestCase
-from django.urls import reverse
-
-from tweets.models import Tweet
-
-from .models import FriendShip
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count, F, QuerySet
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from jobs import queue
+from mysite.testing import AsyncViewsTestCase, TestCase, cached_sessions
+from tweets import search
+from tweets.models import TimelineEntry, Tweet
+
+from . import follow_index, recommendations, user_cache, username_cache
+from .models import FollowRecommendation, FriendShip, RecommendationRun
+from .profile_cache import TWEETS_PER_PAGE, get_profile
+from .views import FollowerListView
 
 CustomUser = get_user_model()
 
@@ -318,6 +338,7 @@ class TestUserLogoutView(TestCase):
         self.assertNotIn(SESSION_KEY, self.client.session)
 
 
+@cached_sessions
 class TestUserProfileView(TestCase):
     def setUp(self):
         # ログイン後の画面なのでログイン用テストユーザ作成
@@ -347,10 +368,10 @@ class TestUserProfileView(TestCase):
         Tweet.objects.create(user=self.user1, content="testpost")
 
         # user1がuser2をフォローする
-        FriendShip.objects.create(follower=self.user1, following=self.user2)
+        FriendShip.objects.follow(self.user1, self.user2)
 
         # user2がuser1をフォローする
-        FriendShip.objects.create(follower=self.user2, following=self.user1)
+        FriendShip.objects.follow(self.user2, self.user1)
 
     def test_success_get(self):
         """
@@ -382,6 +403,142 @@ class TestUserProfileView(TestCase):
         FriendShip.objects.filter(follower=self.user1).count()は自分がフォロワーになっているFriendShipモデルのオブジェクトの数
         """
 
+    def test_success_get_with_mutual_follow(self):
+        """
+        品質:相互フォローしているユーザーのプロフィールを表示する
+        効果:両方向のフォロー状態と相互フォローがcontextに含まれる
+        """
+        response = self.client.get(reverse("accounts:user_profile", kwargs={"username": self.user2.username}))
+        context = response.context
+
+        self.assertTrue(context["login_user_follows_template_user"])
+        self.assertTrue(context["template_user_follows_login_user"])
+        self.assertTrue(context["mutual_follow"])
+        self.assertContains(response, "相互フォロー")
+
+    def test_success_get_with_one_way_follow(self):
+        """
+        品質:自分をフォローしているが自分はフォローしていないユーザーのプロフィールを表示する
+        効果:相互フォローではなく「フォローされています」と表示される
+        """
+        FriendShip.objects.unfollow(self.user1, self.user2)
+        response = self.client.get(reverse("accounts:user_profile", kwargs={"username": self.user2.username}))
+        context = response.context
+
+        self.assertFalse(context["login_user_follows_template_user"])
+        self.assertTrue(context["template_user_follows_login_user"])
+        self.assertFalse(context["mutual_follow"])
+        self.assertContains(response, "フォローされています")
+
+    def test_num_queries(self):
+        """
+        品質:プロフィール画面のクエリ数が増えていない
+        効果:
+        ・セッションはキャッシュから取れるのでDBには行かない
+        ・他人のプロフィール: ログインユーザー・表示ユーザー・ツイート一覧・フォロー関係の4回
+        ・2回目以降はログインユーザー・表示ユーザー・ツイート一覧がキャッシュから取れるのでフォロー関係の1回
+        ・自分のプロフィール: フォロー関係を調べないので表示ユーザー・ツイート一覧の2回、2回目以降は0回
+        """
+        other_url = reverse("accounts:user_profile", kwargs={"username": self.user2.username})
+        with self.assertNumQueries(4):
+            self.client.get(other_url)
+        with self.assertNumQueries(1):
+            self.client.get(other_url)
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+        with self.assertNumQueries(0):
+            self.client.get(self.url)
+
+    @override_settings(
+        SESSION_ENGINE="django.contrib.sessions.backends.db",
+        AUTHENTICATION_BACKENDS=["django.contrib.auth.backends.ModelBackend"],
+    )
+    def test_num_queries_with_db_sessions(self):
+        """
+        品質:SHARED_CACHE_URLを設定しない既定の設定(セッション・ログインユーザをDBから取る)でプロフィール画面を表示する
+        効果:
+        ・セッションとログインユーザーは毎回DBから取る
+        ・他人のプロフィール: セッション・ログインユーザー・表示ユーザー・ツイート一覧・フォロー関係の5回
+        ・2回目以降は表示ユーザー・ツイート一覧がキャッシュから取れるのでセッション・ログインユーザー・フォロー関係の3回
+        ・自分のプロフィール: フォロー関係を調べないので4回、2回目以降はセッション・ログインユーザーの2回
+        """
+        # 認証バックエンドを変えたのでログインし直す
+        self.client.login(username="testuser1", password="testpassword1")
+        other_url = reverse("accounts:user_profile", kwargs={"username": self.user2.username})
+        with self.assertNumQueries(5):
+            self.client.get(other_url)
+        with self.assertNumQueries(3):
+            self.client.get(other_url)
+        with self.assertNumQueries(4):
+            self.client.get(self.url)
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+
+    def test_cache_invalidated_on_tweet(self):
+        """
+        品質:キャッシュされた後にツイートを投稿・削除する
+        効果:プロフィール画面のツイート一覧に反映されている
+        """
+        self.client.get(self.url)
+        tweet = Tweet.objects.create(user=self.user1, content="newpost")
+        response = self.client.get(self.url)
+        self.assertIn(tweet, response.context["tweet_list"])
+
+        tweet.delete()
+        response = self.client.get(self.url)
+        self.assertNotIn(tweet, response.context["tweet_list"])
+
+    def test_cache_invalidated_without_query(self):
+        """
+        品質:キャッシュされた後にツイートを投稿する
+        効果:プロフィールのキャッシュはユーザのidで消せるので、投稿でユーザ名を問い合わせない
+        """
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            Tweet.objects.create(user=self.user1, content="newpost")
+        self.assertFalse([query for query in queries if 'FROM "accounts_customuser"' in query["sql"]])
+        self.assertEqual(len(self.client.get(self.url).context["tweet_list"]), 2)
+
+    def test_success_get_next_page(self):
+        """
+        品質:1ページに表示する数より多くツイートしたユーザのプロフィールを表示する
+        効果:
+        ・キャッシュするのは1ページ目のTWEETS_PER_PAGE件だけで、次のページのカーソルがある
+        ・2ページ目はカーソルで残りのツイートが取れる
+        """
+        for i in range(TWEETS_PER_PAGE):
+            Tweet.objects.create(user=self.user1, content=f"testpost{i}")
+        tweets = list(Tweet.objects.filter(user=self.user1).order_by("-created_at", "-id"))
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["tweet_list"], tweets[: TWEETS_PER_PAGE])
+        self.assertTrue(response.context["page_obj"].has_next())
+        cached = get_profile(self.user1.username)
+        self.assertEqual(len(cached["tweet_page"].object_list), TWEETS_PER_PAGE)
+
+        response = self.client.get(self.url, {"cursor": response.context["page_obj"].next_cursor})
+        self.assertEqual(response.context["tweet_list"], tweets[TWEETS_PER_PAGE :])
+        self.assertFalse(response.context["page_obj"].has_next())
+
+    def test_cache_invalidated_on_follow(self):
+        """
+        品質:キャッシュされた後にフォロー解除する
+        効果:プロフィール画面のフォロー数・フォロワー数に反映されている
+        """
+        self.client.get(self.url)
+        FriendShip.objects.unfollow(self.user2, self.user1)
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["follower_count"], 0)
+        self.assertEqual(response.context["following_count"], 1)
+
+    def test_failure_get_with_not_exist_user(self):
+        """
+        品質:存在しないユーザーのプロフィールを表示する
+        効果:Response Status Code: 404
+        """
+        response = self.client.get(reverse("accounts:user_profile", kwargs={"username": "not_exist_user"}))
+        self.assertEqual(response.status_code, 404)
+
 
 class TestUserProfileEditView(TestCase):
     def test_success_get(self):
@@ -446,6 +603,12 @@ class TestFollowView(TestCase):
         # following=self.user2.usernameではない。FriendShipモデルの該当フィールドに表示されるのはユーザのidのため
         self.assertTrue(FriendShip.objects.filter(following=self.user2, follower=self.user1).exists())
 
+        # フォロー数・フォロワー数が1増えている
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user2.follower_count, 1)
+
         # 以下はメッセージのテスト
         messages = list(get_messages(response.wsgi_request))
 
@@ -456,6 +619,21 @@ class TestFollowView(TestCase):
         self.assertIn(f"{ self.user2.username }さんをフォローしました。", message)
         self.assertIn(SESSION_KEY, self.client.session)
 
+    def test_success_post_backfills_timeline(self):
+        """
+        品質:ツイートのあるユーザーをフォローする
+        効果:
+        ・リクエストの中では受信箱に入れず、ジョブを登録する
+        ・ジョブを実行するとフォローしたユーザーの既存のツイートが自分の受信箱に追加されている
+        """
+        tweet = Tweet.objects.create(user=self.user2, content="testpost")
+
+        self.client.post(self.url, None)
+        self.assertFalse(TimelineEntry.objects.exists())
+        self.assertEqual(queue.run_pending(), 1)
+
+        self.assertTrue(TimelineEntry.objects.filter(owner=self.user1, tweet=tweet).exists())
+
     def test_failure_post_with_not_exist_user(self):
         """
         品質:存在しないユーザーに対して(フォローの)リクエストを送信する。
@@ -519,7 +697,7 @@ class TestUnfollowView(TestCase):
         )  # urls.pyでstr:usernameとなっているのでキーはusernameになる。
 
         # user1がuser2をフォローする
-        FriendShip.objects.create(follower=self.user1, following=self.user2)
+        FriendShip.objects.follow(self.user1, self.user2)
 
     def test_success_post(self):
         """
@@ -546,6 +724,12 @@ class TestUnfollowView(TestCase):
         self.assertFalse(FriendShip.objects.filter(following=self.user2, follower=self.user1).exists())
         self.assertIn(SESSION_KEY, self.client.session)
 
+        # フォロー数・フォロワー数が0に戻っている
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 0)
+        self.assertEqual(self.user2.follower_count, 0)
+
         # 以下はメッセージのテスト
         messages = list(get_messages(response.wsgi_request))
 
@@ -555,6 +739,18 @@ class TestUnfollowView(TestCase):
         # self.assertEqualを使うのでも可.
         self.assertIn(f"{ self.user2.username }さんのフォローを解除しました。", message)
 
+    def test_success_post_purges_timeline(self):
+        """
+        品質:（フォロー解除）リクエストを送信する
+        効果:フォロー解除したユーザーのツイートが自分の受信箱から取り除かれている
+        """
+        tweet = Tweet.objects.create(user=self.user2, content="testpost")
+        TimelineEntry.objects.create(owner=self.user1, tweet=tweet, created_at=tweet.created_at)
+
+        self.client.post(self.url, None)
+
+        self.assertFalse(TimelineEntry.objects.filter(owner=self.user1).exists())
+
     def test_failure_post_with_not_exist_tweet(self):
         """
         品質:存在しないユーザに対して（フォロー解除の）リクエストを送信する
@@ -583,6 +779,169 @@ class TestUnfollowView(TestCase):
         self.assertIn("フォローしていない人や、自分自身をフォロー解除できません。", message)
 
 
+class TestBulkFollowView(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.user3 = CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.url = reverse("accounts:bulk_follow")
+        FriendShip.objects.follow(self.user1, self.user2)
+
+    def test_success_post_follow(self):
+        """
+        品質:複数のユーザーをまとめてフォローする
+        効果:
+        ・Response Status Code: 200
+        ・ユーザー名ごとの結果が返る
+        ・フォローしていなかったユーザーだけDBに追加され、フォロー数・フォロワー数が増えている
+        """
+        data = {"action": "follow", "usernames": "testuser2, testuser3\nnot_exist_user testuser1"}
+        response = self.client.post(self.url, data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["results"],
+            {
+                "testuser2": "already_following",
+                "testuser3": "followed",
+                "not_exist_user": "not_found",
+                "testuser1": "self",
+            },
+        )
+        self.assertTrue(FriendShip.objects.filter(follower=self.user1, following=self.user3).exists())
+        self.user1.refresh_from_db()
+        self.user3.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 2)
+        self.assertEqual(self.user3.follower_count, 1)
+
+    def test_success_post_unfollow(self):
+        """
+        品質:複数のユーザーのフォローをまとめて解除する
+        効果:
+        ・ユーザー名ごとの結果が返る
+        ・フォローしていたユーザーだけDBから削除され、フォロー数・フォロワー数が減っている
+        """
+        data = {"action": "unfollow", "usernames": "testuser2,testuser3"}
+        response = self.client.post(self.url, data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"], {"testuser2": "unfollowed", "testuser3": "not_following"})
+        self.assertFalse(FriendShip.objects.exists())
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 0)
+        self.assertEqual(self.user2.follower_count, 0)
+
+    def test_success_post_follow_in_batches(self):
+        """
+        品質:1つのINSERTに入る行数より多くのユーザーをまとめてフォローする
+        効果:全員分のフォロー関係が作られ、新しくフォローしたidにも全員が含まれる
+        """
+        user4 = CustomUser.objects.create_user(username="testuser4", password="testpassword4")
+        with mock.patch.object(type(FriendShip.objects), "INSERT_BATCH_SIZE", 1):
+            results, changed_ids = FriendShip.objects.bulk_follow(self.user1, ["testuser3", "testuser4"])
+
+        self.assertEqual(results, {"testuser3": "followed", "testuser4": "followed"})
+        self.assertEqual(sorted(changed_ids), sorted([self.user3.pk, user4.pk]))
+        self.user1.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 3)
+
+    def test_failure_post_with_empty_usernames(self):
+        """
+        品質:ユーザー名を指定せずにリクエストを送信する
+        効果:Response Status Code: 400
+        """
+        response = self.client.post(self.url, {"action": "follow", "usernames": " , "})
+        self.assertEqual(response.status_code, 400)
+
+    def test_success_follow_race(self):
+        """
+        品質:フォローしていないことを確かめてから作るまでの間に、同じフォローが別のリクエストで作られる
+        効果:
+        ・ON CONFLICT DO NOTHINGで無視された行の分まではフォロー数・フォロワー数が増えない
+        ・無視された行は"followed"ではなく"already_following"になり、新しくフォローしたidにも含まれない
+        ・別のリクエストの行のcreated_atがこちらの挿入より後でも、こちらが作った行とはみなさない
+        """
+        user4 = CustomUser.objects.create_user(username="testuser4", password="testpassword4")
+        now = timezone.now
+        other_request = []
+
+        def now_after_other_request():
+            # 確かめた後、挿入の直前の時刻を取るときに別のリクエストのフォローが作られる。
+            # こちらの時計は遅れていて、挿入する行のcreated_atは別のリクエストの行より前になる
+            if not other_request:
+                other_request.append(True)
+                FriendShip.objects.follow(self.user1, self.user3)
+                return now() - timedelta(minutes=1)
+            return now()
+
+        with mock.patch("accounts.models.timezone.now", side_effect=now_after_other_request):
+            results, changed_ids = FriendShip.objects.bulk_follow(self.user1, ["testuser3", "testuser4"])
+
+        self.assertEqual(results, {"testuser3": "already_following", "testuser4": "followed"})
+        self.assertEqual(changed_ids, [user4.pk])
+        self.user1.refresh_from_db()
+        self.user3.refresh_from_db()
+        user4.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 3)
+        self.assertEqual(self.user3.follower_count, 1)
+        self.assertEqual(user4.follower_count, 1)
+
+    def test_success_unfollow_race(self):
+        """
+        品質:フォローしていることを確かめてから消すまでの間に、同じフォローが別のリクエストで解除される
+        効果:実際に消せた行の分だけフォロー数・フォロワー数が減り、二重に減らない
+        """
+        user4 = CustomUser.objects.create_user(username="testuser4", password="testpassword4")
+        FriendShip.objects.follow(self.user1, self.user3)
+        FriendShip.objects.follow(self.user1, user4)
+        FriendShip.objects.follow(self.user3, self.user2)
+        delete = QuerySet.delete
+        other_request = []
+
+        def delete_after_other_request(queryset):
+            if not other_request:
+                other_request.append(True)
+                FriendShip.objects.unfollow(self.user1, self.user2)
+            return delete(queryset)
+
+        with mock.patch.object(QuerySet, "delete", autospec=True, side_effect=delete_after_other_request):
+            FriendShip.objects.bulk_unfollow(self.user1, ["testuser2", "testuser3"])
+
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.user3.refresh_from_db()
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user2.follower_count, 1)
+        self.assertEqual(self.user3.follower_count, 0)
+
+
+class TestReconcileFollowCountsCommand(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.user3 = CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+
+    def test_success_reconcile(self):
+        """
+        品質:フォロー数・フォロワー数がFriendShipとずれている状態でコマンドを実行する
+        効果:ずれていたユーザーだけが修正され、全員の数がFriendShipの件数と一致する
+        """
+        # counterを更新しないcreate()でフォロー関係を作ってずれを起こす
+        FriendShip.objects.create(follower=self.user1, following=self.user2)
+        FriendShip.objects.create(follower=self.user3, following=self.user2)
+        CustomUser.objects.filter(pk=self.user3.pk).update(follower_count=5)
+
+        out = StringIO()
+        call_command("reconcile_follow_counts", "--batch-size=2", stdout=out)
+
+        self.assertIn("3人", out.getvalue())
+        for user in CustomUser.objects.all():
+            self.assertEqual(user.follower_count, FriendShip.objects.filter(following=user).count())
+            self.assertEqual(user.following_count, FriendShip.objects.filter(follower=user).count())
+
+
 class TestFollowingListView(TestCase):
     def setUp(self):
         self.user1 = CustomUser.objects.create_user(
@@ -617,6 +976,61 @@ class TestFollowingListView(TestCase):
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
 
+    def test_success_get_with_cursor(self):
+        """
+        フォロー数がpaginate_by件より多いユーザのフォローリストをカーソルで取得する。
+        ・カーソルをたどると重複も漏れもなく全フォローを新しい順に取得できる
+        """
+        others = CustomUser.objects.bulk_create(CustomUser(username=f"other{i}") for i in range(60))
+        FriendShip.objects.bulk_create(FriendShip(follower=self.user2, following=other) for other in others)
+        expected = list(FriendShip.objects.filter(follower=self.user2).order_by("-created_at", "-id"))
+        url = reverse("accounts:following_list", kwargs={"username": self.user2.username})
+
+        response = self.client.get(url)
+        page_obj = response.context["page_obj"]
+        self.assertEqual(len(response.context["following_list"]), 50)
+        response = self.client.get(url, {"cursor": page_obj.next_cursor})
+        self.assertFalse(response.context["page_obj"].has_next())
+        self.assertEqual(list(page_obj.object_list) + list(response.context["following_list"]), expected)
+
+    def test_success_relationship_badges(self):
+        """
+        ログインユーザと相互フォロー・片方向のフォロー・フォロー関係なしのユーザが並ぶフォローリストを表示する。
+        ・それぞれの行にログインユーザとの関係が付き、バッジが表示される
+        """
+        mutual, following, follower, stranger = CustomUser.objects.bulk_create(
+            CustomUser(username=username) for username in ("mutual", "following", "follower", "stranger")
+        )
+        FriendShip.objects.bulk_create(
+            FriendShip(follower=self.user2, following=other) for other in (mutual, following, follower, stranger)
+        )
+        FriendShip.objects.bulk_create(
+            [
+                FriendShip(follower=self.user1, following=mutual),
+                FriendShip(follower=mutual, following=self.user1),
+                FriendShip(follower=self.user1, following=following),
+                FriendShip(follower=follower, following=self.user1),
+            ]
+        )
+        url = reverse("accounts:following_list", kwargs={"username": self.user2.username})
+
+        response = self.client.get(url)
+        relationships = {
+            friend.following.username: (friend.viewer_follows, friend.follows_viewer)
+            for friend in response.context["following_list"]
+        }
+        self.assertEqual(
+            relationships,
+            {
+                "mutual": (True, True),
+                "following": (True, False),
+                "follower": (False, True),
+                "stranger": (False, False),
+            },
+        )
+        self.assertContains(response, "フォロー中", count=2)
+        self.assertContains(response, "フォローされています", count=2)
+
 
 class TestFollowerListView(TestCase):
     def setUp(self):
@@ -646,3 +1060,698 @@ class TestFollowerListView(TestCase):
         """
         response = self.client.get(self.url)
         self.assertEqual(response.status_code, 200)
+
+    def test_success_get_with_cursor(self):
+        """
+        フォロワーがpaginate_by件より多いユーザのフォロワーリストをカーソルで取得する。
+        ・1ページ目はpaginate_by件で、次のページのカーソルがある
+        ・カーソルをたどると重複も漏れもなく全フォロワーを新しい順に取得できる
+        ・全ユーザのquerysetはcontextに入っていない
+        """
+        others = CustomUser.objects.bulk_create(CustomUser(username=f"other{i}") for i in range(60))
+        FriendShip.objects.bulk_create(FriendShip(follower=other, following=self.user2) for other in others)
+        expected = list(FriendShip.objects.filter(following=self.user2).order_by("-created_at", "-id"))
+
+        response = self.client.get(self.url)
+        page_obj = response.context["page_obj"]
+        self.assertEqual(len(response.context["follower_list"]), 50)
+        self.assertTrue(page_obj.has_next())
+        self.assertNotIn("customuser_list", response.context)
+
+        response = self.client.get(self.url, {"cursor": page_obj.next_cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context["page_obj"].has_next())
+        self.assertEqual(list(page_obj.object_list) + list(response.context["follower_list"]), expected)
+
+    def test_query_plan_uses_index(self):
+        """
+        フォロワーリストを1ページ目とカーソル指定で取得する。
+        ・FriendShipを全件走査(SCAN)せず、friendship_following_idxを使う
+        """
+        others = CustomUser.objects.bulk_create(CustomUser(username=f"other{i}") for i in range(60))
+        FriendShip.objects.bulk_create(FriendShip(follower=other, following=self.user2) for other in others)
+        cursor = self.client.get(self.url).context["page_obj"].next_cursor
+
+        for params in ({}, {"cursor": cursor}):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(self.url, params)
+            list_queries = [query["sql"] for query in queries if 'FROM "accounts_friendship"' in query["sql"]]
+            self.assertEqual(len(list_queries), 1)
+            with connection.cursor() as db_cursor:
+                db_cursor.execute("EXPLAIN QUERY PLAN " + list_queries[0])
+                plan = [row[-1] for row in db_cursor.fetchall()]
+            self.assertFalse([step for step in plan if step.startswith("SCAN")], plan)
+            self.assertTrue([step for step in plan if "friendship_following_idx" in step], plan)
+            self.assertFalse([step for step in plan if "TEMP B-TREE" in step], plan)
+
+    def test_failure_get_with_invalid_cursor(self):
+        """
+        不正なカーソルでリクエストを送信する。
+        ・Response Status Code: 400
+        """
+        response = self.client.get(self.url, {"cursor": "invalid"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_success_relationship_in_one_query(self):
+        """
+        1,000人のフォロワーを1ページに表示する。ログインユーザはそのうち半分をフォローし、3分の1にフォローされている。
+        ・SQLの回数は1人のときと同じで、ログインユーザとの関係も一覧と同じ1回のSQLで取る
+        ・それぞれの行の関係が正しい
+        """
+        CustomUser.objects.bulk_create(CustomUser(username=f"other{i}") for i in range(1000))
+        others = list(CustomUser.objects.filter(username__startswith="other").order_by("pk"))
+        FriendShip.objects.bulk_create(FriendShip(follower=other, following=self.user2) for other in others[:1])
+        with mock.patch.object(FollowerListView, "paginate_by", 1000):
+            self.client.get(self.url)
+            with CaptureQueriesContext(connection) as one_row_queries:
+                self.client.get(self.url)
+
+            FriendShip.objects.bulk_create(FriendShip(follower=other, following=self.user2) for other in others[1:])
+            FriendShip.objects.bulk_create(FriendShip(follower=self.user1, following=other) for other in others[::2])
+            FriendShip.objects.bulk_create(FriendShip(follower=other, following=self.user1) for other in others[::3])
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url)
+
+        self.assertEqual(len(response.context["follower_list"]), 1000)
+        self.assertEqual(len(queries), len(one_row_queries))
+        self.assertEqual(len([query for query in queries if 'FROM "accounts_friendship"' in query["sql"]]), 1)
+        relationships = {
+            friend.follower.username: (friend.viewer_follows, friend.follows_viewer)
+            for friend in response.context["follower_list"]
+        }
+        for i, other in enumerate(others):
+            self.assertEqual(relationships[other.username], (i % 2 == 0, i % 3 == 0))
+
+
+class TestUsernameCache(TestCase):
+    def setUp(self):
+        # 他のテストでキャッシュされたidが残らないようにする
+        username_cache.local_cache.clear()
+        caches[settings.USERNAME_CACHE_ALIAS].clear()
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+
+    def test_success_get_user_id(self):
+        """
+        同じユーザ名を2回変換する。
+        ・ユーザのidが返る
+        ・2回目はSQLを実行しない
+        ・プロセス内のキャッシュが消えても、共有のキャッシュから取れればSQLを実行しない
+        """
+        with self.assertNumQueries(1):
+            self.assertEqual(username_cache.get_user_id("testuser2"), self.user2.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(username_cache.get_user_id("testuser2"), self.user2.pk)
+        username_cache.local_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(username_cache.get_user_id("testuser2"), self.user2.pk)
+
+    def test_success_not_found_is_cached(self):
+        """
+        存在しないユーザ名を変換してから、そのユーザ名で登録する。
+        ・存在しない間はNoneが返り、2回目はSQLを実行しない
+        ・登録するとキャッシュが消え、新しいユーザのidが返る
+        """
+        self.assertIsNone(username_cache.get_user_id("newuser"))
+        with self.assertNumQueries(0):
+            self.assertIsNone(username_cache.get_user_id("newuser"))
+        user = CustomUser.objects.create_user(username="newuser", password="testpassword")
+        self.assertEqual(username_cache.get_user_id("newuser"), user.pk)
+
+    def test_success_invalidate_on_rename_and_delete(self):
+        """
+        キャッシュした後でユーザ名を変え、ユーザを削除する。
+        ・古いユーザ名は存在しなくなり、新しいユーザ名でidが返る
+        ・削除するとNoneが返る
+        """
+        username_cache.get_user_id("testuser2")
+        self.user2.username = "renamed"
+        self.user2.save()
+        self.assertIsNone(username_cache.get_user_id("testuser2"))
+        self.assertEqual(username_cache.get_user_id("renamed"), self.user2.pk)
+        self.user2.delete()
+        self.assertIsNone(username_cache.get_user_id("renamed"))
+
+    def test_success_lru_cache(self):
+        """
+        最大2件のLRUキャッシュに3件入れる。有効期限0秒のキャッシュに入れる。
+        ・最も長く使われていないものが捨てられる
+        ・有効期限を過ぎたものは返らない
+        """
+        cache = username_cache.LRUCache(2, 60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        self.assertEqual(len(cache), 2)
+
+        cache = username_cache.LRUCache(2, 0)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_success_views_skip_username_query(self):
+        """
+        2回目以降のフォロー・フォロー解除・フォローリスト・存在しないユーザのプロフィールにアクセスする。
+        ・ユーザ名でCustomUserを探すSQLを実行しない
+        """
+        self.client.login(username="testuser1", password="testpassword1")
+        username_cache.get_user_id("testuser2")
+        username_cache.get_user_id("nobody")
+        requests = [
+            ("post", reverse("accounts:follow", kwargs={"username": "testuser2"})),
+            ("get", reverse("accounts:following_list", kwargs={"username": "testuser2"})),
+            ("get", reverse("accounts:follower_list", kwargs={"username": "testuser2"})),
+            ("post", reverse("accounts:unfollow", kwargs={"username": "testuser2"})),
+            ("get", reverse("accounts:user_profile", kwargs={"username": "nobody"})),
+        ]
+        for method, url in requests:
+            with CaptureQueriesContext(connection) as queries:
+                getattr(self.client, method)(url)
+            # ユーザ名での絞り込み(CustomUserの検索やfollower__usernameの結合)がない
+            username_queries = [query["sql"] for query in queries if '."username" =' in query["sql"]]
+            self.assertEqual(username_queries, [], url)
+
+    def test_failure_follow_list_of_unknown_user(self):
+        """
+        存在しないユーザのフォローリスト・フォロワーリストにアクセスする。
+        ・Response Status Code: 404
+        """
+        self.client.login(username="testuser1", password="testpassword1")
+        for name in ("accounts:following_list", "accounts:follower_list"):
+            response = self.client.get(reverse(name, kwargs={"username": "nobody"}))
+            self.assertEqual(response.status_code, 404)
+
+
+@cached_sessions
+class TestCachedSessionAndUser(TestCase):
+    def setUp(self):
+        caches[settings.SESSION_CACHE_ALIAS].clear()
+        caches[settings.USER_CACHE_ALIAS].clear()
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.url = reverse("tweets:home")
+
+    def queries_for(self, fragment):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return [query["sql"] for query in queries if fragment in query["sql"]]
+
+    def test_success_no_session_or_user_query(self):
+        """
+        ログインした後に同じ画面に2回アクセスする。
+        ・セッションはDBから読まない
+        ・ログインユーザーは1回目だけDBから読み、2回目はキャッシュから取れる
+        ・セッションが変わらないので書き込まない
+        """
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        sql = [query["sql"] for query in queries]
+        self.assertEqual([query for query in sql if '"django_session"' in query], [])
+        user_query = f'WHERE "accounts_customuser"."id" = {self.user1.pk}'
+        self.assertEqual(len([query for query in sql if user_query in query]), 1)
+
+        self.assertEqual(self.queries_for('"django_session"'), [])
+        self.assertEqual(self.queries_for(user_query), [])
+
+    def test_success_session_survives_cache_loss(self):
+        """
+        セッションのキャッシュが消えた状態でアクセスする。
+        ・DBから読み直してログインしたままになる
+        """
+        caches[settings.SESSION_CACHE_ALIAS].clear()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(self.client.session[SESSION_KEY]), self.user1.pk)
+
+    def test_success_invalidate_on_user_change(self):
+        """
+        キャッシュした後でパスワードを変える・ユーザーを無効にする。
+        ・どちらもログアウトした状態になる
+        """
+        self.client.get(self.url)
+        self.user1.set_password("newpassword1")
+        self.user1.save()
+        response = self.client.get(self.url)
+        self.assertRedirects(response, f"{reverse('accounts:login')}?next={self.url}")
+
+        self.client.login(username="testuser1", password="newpassword1")
+        self.client.get(self.url)
+        self.user1.is_active = False
+        self.user1.save()
+        response = self.client.get(self.url)
+        self.assertRedirects(response, f"{reverse('accounts:login')}?next={self.url}")
+
+    def test_success_logout_invalidates_session_cached_elsewhere(self):
+        """
+        セッションとユーザのキャッシュを複数のプロセスで共有できるキャッシュ(FileBasedCache)にして、
+        別のプロセス(同じセッションのCookieを持つ別のClient)でセッションをキャッシュに載せてからログアウトする。
+        ・共有のキャッシュからセッションが消え、別のプロセスでもログアウトした状態になる
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            shared = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": directory}
+            with self.settings(CACHES={**settings.CACHES, "sessions": shared, "users": shared}):
+                other_worker = Client()
+                other_worker.cookies = self.client.cookies
+                self.assertEqual(other_worker.get(self.url).status_code, 200)
+                session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+                cache_key = import_module(settings.SESSION_ENGINE).SessionStore(session_key).cache_key
+                # 別のプロセスから同じ場所を開いたキャッシュ
+                other_cache = FileBasedCache(directory, {})
+                self.assertIsNotNone(other_cache.get(cache_key))
+
+                self.client.post(reverse("accounts:logout"))
+
+                self.assertIsNone(other_cache.get(cache_key))
+                response = other_worker.get(self.url)
+                self.assertRedirects(response, f"{reverse('accounts:login')}?next={self.url}")
+
+    def test_success_invalidate_on_follow(self):
+        """
+        キャッシュした後でフォロー・一括フォローする。
+        ・キャッシュしたログインユーザーのフォロー数が新しい値になる
+        """
+        self.client.get(self.url)
+        self.client.post(reverse("accounts:follow", kwargs={"username": "testuser2"}))
+        self.assertEqual(user_cache.get_user(self.user1.pk).following_count, 1)
+        CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+        self.client.post(reverse("accounts:bulk_follow"), {"action": "follow", "usernames": "testuser3"})
+        self.assertEqual(user_cache.get_user(self.user1.pk).following_count, 2)
+
+
+class TestAsyncUserProfileView(AsyncViewsTestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.url = reverse("accounts:user_profile", kwargs={"username": "testuser2"})
+
+    def test_success_get(self):
+        """
+        非同期版のプロフィール画面にアクセスする。
+        ・URLには非同期版のビューが使われている
+        ・ツイート一覧・フォロー数・フォロー関係が同期版と同じく表示される
+        """
+        self.assertTrue(resolve(self.url).func.view_class.view_is_async)
+        Tweet.objects.create(user=self.user2, content="testpost")
+        FriendShip.objects.follow(self.user2, self.user1)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "accounts/profile.html")
+        self.assertEqual(response.context["profile"], self.user2)
+        self.assertEqual([tweet.content for tweet in response.context["tweet_list"]], ["testpost"])
+        self.assertFalse(response.context["page_obj"].has_next())
+        self.assertEqual(response.context["following_count"], 1)
+        self.assertEqual(response.context["follower_count"], 0)
+        self.assertFalse(response.context["login_user_follows_template_user"])
+        self.assertTrue(response.context["template_user_follows_login_user"])
+        self.assertFalse(response.context["mutual_follow"])
+
+    def test_success_get_mutual_follow(self):
+        """
+        相互フォローしているユーザのプロフィール画面にアクセスする。
+        ・相互フォローと表示される
+        """
+        FriendShip.objects.follow(self.user1, self.user2)
+        FriendShip.objects.follow(self.user2, self.user1)
+        response = self.client.get(self.url)
+        self.assertTrue(response.context["mutual_follow"])
+        self.assertContains(response, "相互フォロー")
+
+    def test_success_get_own_profile(self):
+        """
+        自分のプロフィール画面にアクセスする。
+        ・フォロー関係は問い合わせず、自分自身のプロフィールと表示される
+        """
+        response = self.client.get(reverse("accounts:user_profile", kwargs={"username": "testuser1"}))
+        self.assertFalse(response.context["mutual_follow"])
+        self.assertContains(response, "ここはあなた自身のプロフィール画面です。")
+
+    def test_failure_get_with_not_exist_user(self):
+        """
+        存在しないユーザのプロフィール画面にアクセスする。
+        ・404エラーになる
+        """
+        response = self.client.get(reverse("accounts:user_profile", kwargs={"username": "nobody"}))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestAsyncFollowListViews(AsyncViewsTestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.client.login(username="testuser1", password="testpassword1")
+        FriendShip.objects.follow(self.user1, self.user2)
+
+    def test_success_get_following_list(self):
+        """
+        非同期版のフォローリストにアクセスする。
+        ・フォロー中のユーザが表示される
+        """
+        url = reverse("accounts:following_list", kwargs={"username": "testuser1"})
+        self.assertTrue(resolve(url).func.view_class.view_is_async)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([friend.following for friend in response.context["following_list"]], [self.user2])
+
+    def test_success_get_follower_list(self):
+        """
+        非同期版のフォロワーリストにアクセスする。
+        ・フォロワーが表示される
+        """
+        url = reverse("accounts:follower_list", kwargs={"username": "testuser2"})
+        self.assertTrue(resolve(url).func.view_class.view_is_async)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([friend.follower for friend in response.context["follower_list"]], [self.user1])
+
+    def test_success_get_with_cursor(self):
+        """
+        非同期版のフォロワーリストをカーソルで取得する。
+        ・同期版と同じくpaginate_by件ずつ、全フォロワーを新しい順に取得できる
+        """
+        others = CustomUser.objects.bulk_create(CustomUser(username=f"other{i}") for i in range(60))
+        FriendShip.objects.bulk_create(FriendShip(follower=other, following=self.user2) for other in others)
+        expected = list(FriendShip.objects.filter(following=self.user2).order_by("-created_at", "-id"))
+        url = reverse("accounts:follower_list", kwargs={"username": "testuser2"})
+
+        response = self.client.get(url)
+        page_obj = response.context["page_obj"]
+        self.assertEqual(len(response.context["follower_list"]), 50)
+        response = self.client.get(url, {"cursor": page_obj.next_cursor})
+        self.assertFalse(response.context["page_obj"].has_next())
+        self.assertEqual(list(page_obj.object_list) + list(response.context["follower_list"]), expected)
+
+    def test_failure_not_logged_in(self):
+        """
+        ログアウトした状態で非同期版のフォローリストにアクセスする。
+        ・ログイン画面にリダイレクトされる
+        """
+        self.client.logout()
+        url = reverse("accounts:following_list", kwargs={"username": "testuser1"})
+        response = self.client.get(url)
+        self.assertRedirects(response, f"{reverse('accounts:login')}?next={url}")
+
+
+class TestGenerateSocialGraphCommand(TestCase):
+    def generate(self, *args):
+        options = ["--users", "50", "--tweets", "200", "--follows-per-user", "5", "--end", "2024-01-01"]
+        call_command("generate_social_graph", *options, *args, stdout=StringIO())
+
+    def snapshot(self):
+        return (
+            list(CustomUser.objects.order_by("pk").values_list("username", "follower_count", "following_count")),
+            list(FriendShip.objects.order_by("pk").values_list("follower__username", "following__username")),
+            list(Tweet.objects.order_by("pk").values_list("user__username", "content", "created_at")),
+        )
+
+    def test_success_generate(self):
+        """
+        小さい件数でデータを作る。
+        ・指定した数のユーザとツイートができる
+        ・フォロー数・フォロワー数がFriendShipの行数と合っている
+        ・自分自身をフォローしていない
+        ・作ったツイートが全文検索で見つかる
+        """
+        self.generate()
+        self.assertEqual(CustomUser.objects.count(), 50)
+        self.assertEqual(Tweet.objects.count(), 200)
+        self.assertTrue(FriendShip.objects.exists())
+        users = CustomUser.objects.annotate(
+            followings=Count("following", distinct=True),
+            followers=Count("follower", distinct=True),
+        )
+        for user in users:
+            self.assertEqual(user.following_count, user.followings)
+            self.assertEqual(user.follower_count, user.followers)
+        self.assertFalse(FriendShip.objects.filter(follower=F("following")).exists())
+        tweet = Tweet.objects.order_by("pk").last()
+        self.assertIn(tweet.pk, search.search_tweet_ids(tweet.content, 0, 200))
+
+    def test_success_same_seed(self):
+        """
+        同じ--seedと--endで2回作る。
+        ・2回とも同じデータになる
+        """
+        self.generate("--seed", "1")
+        first = self.snapshot()
+        FriendShip.objects.all().delete()
+        Tweet.objects.all().delete()
+        CustomUser.objects.all().delete()
+        self.generate("--seed", "1")
+        self.assertEqual(self.snapshot(), first)
+
+
+class TestFollowRecommendations(TestCase):
+    def setUp(self):
+        # alice → bob, carol / bob → dave, erin / carol → dave, alice / dave → erin
+        self.users = {
+            username: CustomUser.objects.create_user(username=username, password="testpassword")
+            for username in ("alice", "bob", "carol", "dave", "erin", "frank")
+        }
+        for follower, following in (
+            ("alice", "bob"),
+            ("alice", "carol"),
+            ("bob", "dave"),
+            ("bob", "erin"),
+            ("carol", "dave"),
+            ("carol", "alice"),
+            ("dave", "erin"),
+        ):
+            FriendShip.objects.follow(self.users[follower], self.users[following])
+        self.client.login(username="alice", password="testpassword")
+
+    def saved(self, username):
+        rows = FollowRecommendation.objects.filter(user=self.users[username]).order_by("-score", "candidate")
+        return [(row.candidate.username, row.score) for row in rows]
+
+    def test_success_follow_graph(self):
+        """
+        idが連続していないユーザとフォロー関係からFollowGraphを作る。
+        ・フォローしている人・フォロワーを番号の昇順で返す
+        ・存在しないユーザへのフォローは無視する
+        ・友達の友達を共通のフォロー数の多い順(同じならidの小さい順)に返し、自分とフォロー済みのユーザは含めない
+        """
+        graph = recommendations.FollowGraph(
+            [10, 20, 30, 40, 50], [(10, 20), (10, 30), (20, 40), (20, 50), (30, 10), (30, 40), (30, 99)]
+        )
+        self.assertEqual(len(graph), 5)
+        self.assertEqual(graph.index(30), 2)
+        self.assertIsNone(graph.index(99))
+        self.assertEqual(list(graph.following_of(0)), [1, 2])
+        self.assertEqual(list(graph.followers_of(3)), [1, 2])
+        self.assertEqual(list(graph.followers_of(0)), [2])
+        self.assertEqual(graph.recommend(0), [(40, 2), (50, 1)])
+        self.assertEqual(graph.recommend(0, k=1), [(40, 2)])
+        self.assertEqual(graph.recommend(3), [])
+        self.assertEqual(graph.affected([20]), {1, 0})
+
+    def test_success_refresh_full(self):
+        """
+        初めてrefresh_recommendationsコマンドを実行する。
+        ・全ユーザのおすすめが計算されて保存される
+        """
+        call_command("refresh_recommendations", stdout=StringIO())
+
+        run = RecommendationRun.objects.get()
+        self.assertTrue(run.full)
+        self.assertEqual(run.user_count, 6)
+        self.assertEqual(self.saved("alice"), [("dave", 2), ("erin", 1)])
+        self.assertEqual(self.saved("carol"), [("bob", 1), ("erin", 1)])
+        self.assertEqual(self.saved("frank"), [])
+
+    def test_success_refresh_incremental(self):
+        """
+        前回の実行の後にbobがフォローを変えてから、refresh_recommendationsコマンドを実行する。
+        ・bobとbobのフォロワー(alice)だけが計算し直される
+        """
+        call_command("refresh_recommendations", stdout=StringIO())
+        FriendShip.objects.unfollow(self.users["bob"], self.users["erin"])
+        FriendShip.objects.follow(self.users["bob"], self.users["frank"])
+
+        call_command("refresh_recommendations", stdout=StringIO())
+
+        run = RecommendationRun.objects.latest("started_at")
+        self.assertFalse(run.full)
+        self.assertEqual(run.user_count, 2)
+        self.assertEqual(self.saved("alice"), [("dave", 2), ("frank", 1)])
+        self.assertEqual(self.saved("bob"), [("erin", 1)])
+
+    def test_success_home_suggestions(self):
+        """
+        おすすめを計算してからホーム画面にアクセスする。計算の後でdaveをフォローしておく。
+        ・おすすめユーザが表示され、計算の後にフォローしたユーザは除かれる
+        ・おすすめの取得はrecommendation_user_score_idxを使う1回のSQLで、全件走査しない
+        """
+        call_command("refresh_recommendations", stdout=StringIO())
+        FriendShip.objects.follow(self.users["alice"], self.users["dave"])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("tweets:home"))
+
+        self.assertEqual([r.candidate.username for r in response.context["recommendation_list"]], ["erin"])
+        self.assertContains(response, reverse("accounts:user_profile", kwargs={"username": "erin"}))
+        recommendation_queries = [query["sql"] for query in queries if "accounts_followrecommendation" in query["sql"]]
+        self.assertEqual(len(recommendation_queries), 1)
+        with connection.cursor() as db_cursor:
+            db_cursor.execute("EXPLAIN QUERY PLAN " + recommendation_queries[0])
+            plan = [row[-1] for row in db_cursor.fetchall()]
+        self.assertFalse([step for step in plan if step.startswith("SCAN")], plan)
+        self.assertTrue([step for step in plan if "recommendation_user_score_idx" in step], plan)
+
+
+@override_settings(FOLLOW_INDEX_ENABLED=True)
+class TestFollowIndex(TestCase):
+    def setUp(self):
+        # 共有のバージョン番号と、他のテストで読み込んだ内容が残らないようにする
+        caches[settings.FOLLOW_INDEX_CACHE_ALIAS].clear()
+        follow_index.index.clear()
+        self.addCleanup(follow_index.index.clear)
+        self.alice, self.bob, self.carol = (
+            CustomUser.objects.create_user(username=username, password="testpassword")
+            for username in ("alice", "bob", "carol")
+        )
+        FriendShip.objects.follow(self.alice, self.bob)
+        FriendShip.objects.follow(self.bob, self.alice)
+        FriendShip.objects.follow(self.carol, self.bob)
+        self.client.login(username="alice", password="testpassword")
+
+    def test_success_answer_without_queries(self):
+        """
+        インデックスを読み込んでから、フォロー関係を問い合わせる。
+        ・フォロー済みかどうか・フォロー数とフォロワー数・両方向の関係がSQLなしで分かる
+        """
+        follow_index.index.build()
+        with self.assertNumQueries(0):
+            self.assertTrue(follow_index.index.is_following(self.alice.pk, self.bob.pk))
+            self.assertFalse(follow_index.index.is_following(self.alice.pk, self.carol.pk))
+            self.assertEqual(follow_index.index.counts(self.bob.pk), (1, 2))
+            self.assertEqual(follow_index.index.counts(self.carol.pk), (1, 0))
+            self.assertEqual(follow_index.index.relationship(self.alice.pk, self.bob.pk), (True, True))
+            self.assertEqual(follow_index.index.relationship(self.bob.pk, self.carol.pk), (False, True))
+        self.assertEqual(follow_index.index.edge_count, 3)
+
+    def test_success_follow_and_unfollow(self):
+        """
+        フォロー・フォロー解除のリクエストを送信する。
+        ・コミット後にインデックスに取り込まれ、プロフィール画面でフォロー関係のSQLを実行しない
+        ・プロフィール画面のフォロー数・フォロワー数はCustomUserに持たせている値を使う
+        ・フォローしていないユーザのフォロー解除は400になる
+        """
+        follow_index.index.build()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("accounts:follow", kwargs={"username": "carol"}))
+        self.assertEqual(follow_index.index.relationship(self.alice.pk, self.carol.pk), (True, False))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("accounts:user_profile", kwargs={"username": "carol"}))
+        self.assertTrue(response.context["login_user_follows_template_user"])
+        self.assertFalse(response.context["mutual_follow"])
+        self.assertEqual((response.context["following_count"], response.context["follower_count"]), (1, 1))
+        self.assertFalse([query for query in queries if 'FROM "accounts_friendship"' in query["sql"]])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("accounts:unfollow", kwargs={"username": "carol"}))
+        self.assertFalse(follow_index.index.is_following(self.alice.pk, self.carol.pk))
+        response = self.client.post(reverse("accounts:unfollow", kwargs={"username": "carol"}))
+        self.assertEqual(response.status_code, 400)
+
+    def test_success_write_with_stale_index(self):
+        """
+        インデックスを読み込んだ後で、シグナルを送らずに(別のプロセスでの変更の代わり)フォロー関係を変えてから、
+        フォロー・フォロー解除のリクエストを送信する。
+        ・インデックスが古くても、書き込むかどうかはDBで確かめるので正しく処理される
+        """
+        follow_index.index.build()
+        FriendShip.objects.bulk_create([FriendShip(follower=self.alice, following=self.carol)])
+        FriendShip.objects.filter(follower=self.alice, following=self.bob).delete()
+        self.assertFalse(follow_index.index.is_following(self.alice.pk, self.carol.pk))
+        self.assertTrue(follow_index.index.is_following(self.alice.pk, self.bob.pk))
+
+        response = self.client.post(reverse("accounts:follow", kwargs={"username": "carol"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("すでに carolさんをフォローしています。", [str(message) for message in response.context["messages"]])
+        response = self.client.post(reverse("accounts:follow", kwargs={"username": "bob"}))
+        self.assertRedirects(response, reverse("tweets:home"))
+        response = self.client.post(reverse("accounts:unfollow", kwargs={"username": "carol"}))
+        self.assertRedirects(response, reverse("tweets:home"))
+        self.assertFalse(FriendShip.objects.filter(follower=self.alice, following=self.carol).exists())
+
+    def test_success_follow_race(self):
+        """
+        存在確認とフォロー関係の作成の間に、同じフォローが別のリクエストで作られる。
+        ・unique_friendship制約のエラーは「すでにフォローしています」として扱われ、500にならない
+        """
+        with mock.patch.object(QuerySet, "exists", return_value=False):
+            response = self.client.post(reverse("accounts:follow", kwargs={"username": "bob"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("すでに bobさんをフォローしています。", [str(message) for message in response.context["messages"]])
+        self.assertEqual(FriendShip.objects.filter(follower=self.alice, following=self.bob).count(), 1)
+
+    def test_success_rollback_not_recorded(self):
+        """
+        フォローした後でトランザクションをロールバックする。
+        ・インデックスには取り込まれない
+        """
+        follow_index.index.build()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    FriendShip.objects.follow(self.alice, self.carol)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertFalse(follow_index.index.is_following(self.alice.pk, self.carol.pk))
+
+    def test_success_catch_up_other_process(self):
+        """
+        別のプロセスのインデックスを読み込んだ後で、このプロセスでフォロー関係を変える。
+        ・別のプロセスは共有のバージョンが進んだことに気付き、SQLを実行せずに変更内容を取り込む
+        ・一括で書き込んでバージョンだけ進めた場合は、全体を読み込み直す
+        """
+        other = follow_index.FollowIndex(check_interval=0)
+        other.build()
+        with self.captureOnCommitCallbacks(execute=True):
+            FriendShip.objects.follow(self.alice, self.carol)
+            FriendShip.objects.unfollow(self.carol, self.bob)
+        with self.assertNumQueries(0):
+            self.assertEqual(other.relationship(self.carol.pk, self.alice.pk), (False, True))
+            self.assertEqual(other.counts(self.bob.pk), (1, 1))
+        self.assertEqual(other.version, follow_index.index.shared_version())
+
+        FriendShip.objects.bulk_create([FriendShip(follower=self.carol, following=self.bob)])
+        follow_index.invalidate()
+        with self.assertNumQueries(1):
+            self.assertTrue(other.is_following(self.carol.pk, self.bob.pk))
+
+    def test_failure_warm_without_shared_cache(self):
+        """
+        FOLLOW_INDEX_CACHE_ALIASがプロセスごとのキャッシュ(LocMemCache)のままで起動する。
+        ・ImproperlyConfiguredになり、インデックスは読み込まれない
+        ・共有できるキャッシュ(FileBasedCache)にすれば読み込まれる
+        """
+        with self.assertRaises(ImproperlyConfigured):
+            follow_index.warm()
+        self.assertIsNone(follow_index.index.version)
+
+        with tempfile.TemporaryDirectory() as directory:
+            shared = {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": directory}
+            caches_setting = {**settings.CACHES, settings.FOLLOW_INDEX_CACHE_ALIAS: shared}
+            # テストのDB接続は閉じない
+            with self.settings(CACHES=caches_setting), mock.patch.object(follow_index.connections, "close_all"):
+                follow_index.warm()
+        self.assertEqual(follow_index.index.edge_count, 3)
+
+    def test_success_disabled(self):
+        """
+        FOLLOW_INDEX_ENABLEDがFalseのときに問い合わせる。
+        ・インデックスは使わずNoneを返し、プロフィール画面はDBでフォロー関係を調べる
+        """
+        with self.settings(FOLLOW_INDEX_ENABLED=False):
+            self.assertIsNone(follow_index.index.is_following(self.alice.pk, self.bob.pk))
+            response = self.client.get(reverse("accounts:user_profile", kwargs={"username": "bob"}))
+            self.assertTrue(response.context["mutual_follow"])
+        self.assertIsNone(follow_index.index.version)
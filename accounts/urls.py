@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth.views import LoginView, LogoutView
 from django.urls import path
 
@@ -6,6 +7,17 @@ from . import forms, views
 # 逆引きなどのための名称はapp_name:nameなのでaccounts:signupなどとなる．
 # プロジェクトmysiteのurlsからここに来て，もう一度URLを調べpath一覧に一致するurlがあればそのviewメソッド実行
 app_name = "accounts"
+
+# ASGIで動かすときは、読み込みの多いビューを非同期版に差し替える
+if settings.ASYNC_VIEWS:
+    profile_view = views.AsyncUserProfileView
+    following_list_view = views.AsyncFollowingListView
+    follower_list_view = views.AsyncFollowerListView
+else:
+    profile_view = views.UserProfileView
+    following_list_view = views.FollowingListView
+    follower_list_view = views.FollowerListView
+
 urlpatterns = [
     path("signup/", views.SignupView.as_view(), name="signup"),
     path(
@@ -14,9 +26,11 @@ urlpatterns = [
         name="login",
     ),
     path("logout/", LogoutView.as_view(), name="logout"),
-    path("<str:username>/", views.UserProfileView.as_view(), name="user_profile"),
+    # <str:username>/より前に置かないとユーザ名として扱われてしまう
+    path("bulk_follow/", views.BulkFollowView.as_view(), name="bulk_follow"),
+    path("<str:username>/", profile_view.as_view(), name="user_profile"),
     path("<str:username>/follow/", views.FollowView.as_view(), name="follow"),
     path("<str:username>/unfollow/", views.UnFollowView.as_view(), name="unfollow"),
-    path("<str:username>/following_list/", views.FollowingListView.as_view(), name="following_list"),
-    path("<str:username>/follower_list/", views.FollowerListView.as_view(), name="follower_list"),
+    path("<str:username>/following_list/", following_list_view.as_view(), name="following_list"),
+    path("<str:username>/follower_list/", follower_list_view.as_view(), name="follower_list"),
 ]
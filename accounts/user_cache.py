@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+
+CustomUser = get_user_model()
+
+# ログイン中のユーザ(request.user)の行をキャッシュする。AuthenticationMiddlewareはリクエストごとに
+# セッションのユーザのidからユーザを取得するので、accounts/backends.pyのCachedModelBackendからここを使う。
+# キャッシュの保存先・有効期限はsettings.CACHESのUSER_CACHE_ALIASで設定する。
+# 消すタイミングはaccounts/signals.pyでCustomUser・FriendShipの保存/削除を受け取って決めている。
+# フォロー数などを.update()で変えた場合はシグナルが送られないので、呼び出し側でinvalidate()するか、有効期限で切れるのを待つ。
+
+
+def _cache():
+    return caches[settings.USER_CACHE_ALIAS]
+
+
+def _key(user_id):
+    # セッションにはidが文字列で入っているので、数値でも文字列でも同じキーになるようにする
+    return f"user:{user_id}"
+
+
+def get_user(user_id):
+    """
+    idがuser_idのCustomUserを返す。存在しなければNone。
+    """
+    user = _cache().get(_key(user_id))
+    if user is not None:
+        return user
+    user = CustomUser.objects.filter(pk=user_id).first()
+    if user is not None:
+        _cache().set(_key(user_id), user)
+    return user
+
+
+def invalidate(*user_ids):
+    """
+    profile_cache.invalidate()と同じく、すぐに消したうえでトランザクションのコミット後にもう一度消す。
+    """
+    keys = [_key(user_id) for user_id in user_ids]
+    _cache().delete_many(keys)
+    transaction.on_commit(lambda: _cache().delete_many(keys))
@@ -0,0 +1,179 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.http import Http404
+
+CustomUser = get_user_model()
+
+# URLの<str:username>をユーザのidに変換する。プロフィール・フォロー・フォロー解除・フォローリストで共通して使う。
+#
+# ユーザ名からidへの対応は、ユーザ名が変わるか削除されない限り変わらないので、次の2段でキャッシュする。
+# 1. プロセス内のLRUキャッシュ(最大USERNAME_LOCAL_CACHE_SIZE件、USERNAME_LOCAL_CACHE_TIMEOUT秒)
+# 2. settings.CACHESのUSERNAME_CACHE_ALIAS。SHARED_CACHE_URLを設定すると複数のワーカーで共有するRedisCacheになる
+# 存在しないユーザ名も「ない」ことをキャッシュして、404のたびにSQLを実行しないようにする(USERNAME_NOT_FOUND_TIMEOUT秒)。
+# 消すタイミングはaccounts/signals.pyでCustomUserの保存/削除を受け取って決めている。
+# ただし他のワーカーのプロセス内のキャッシュは消せないので、そちらはUSERNAME_LOCAL_CACHE_TIMEOUT秒で切れるのを待つ。
+# 2段目も共有していない(プロセスごとのLocMemCacheの)場合は消したことが伝わらないので、
+# 2段目の有効期限と存在しないユーザ名の有効期限もUSERNAME_LOCAL_CACHE_TIMEOUT秒にして、古い結果を使う時間をそろえる。
+#
+# フォロー数などは.update()で変わり、シグナルが送られないので、キャッシュするのはidだけにしている。
+
+# get_cached_user_id()でキャッシュにないことを表す値(存在しないユーザ名はNoneをキャッシュするため)
+NOT_CACHED = object()
+
+
+class LRUCache:
+    """
+    プロセス内の最大max_entries件のキャッシュ。いっぱいになったら最も長く使われていないものから捨て、
+    timeout秒を過ぎたものは使わない。複数のスレッドから使える。
+    """
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        # timeoutを指定した場合も、self.timeoutより長くはしない
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        expires_at = time.monotonic() + timeout
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+local_cache = LRUCache(settings.USERNAME_LOCAL_CACHE_SIZE, settings.USERNAME_LOCAL_CACHE_TIMEOUT)
+
+
+def _cache():
+    return caches[settings.USERNAME_CACHE_ALIAS]
+
+
+def _key(username):
+    return f"username:{username}"
+
+
+def _timeout(user_id, default):
+    # 存在するユーザ名はそれぞれのキャッシュの有効期限、存在しないユーザ名は短くする
+    return settings.USERNAME_NOT_FOUND_TIMEOUT if user_id is None else default
+
+
+def get_cached_user_id(username):
+    """
+    キャッシュだけを見て、ユーザのid、存在しないとキャッシュされていればNone、キャッシュになければNOT_CACHEDを返す。
+    """
+    key = _key(username)
+    user_id = local_cache.get(key, NOT_CACHED)
+    if user_id is NOT_CACHED:
+        user_id = _cache().get(key, NOT_CACHED)
+        if user_id is not NOT_CACHED:
+            local_cache.set(key, user_id, _timeout(user_id, None))
+    return user_id
+
+
+async def aget_cached_user_id(username):
+    # get_cached_user_id()の非同期版
+    key = _key(username)
+    user_id = local_cache.get(key, NOT_CACHED)
+    if user_id is NOT_CACHED:
+        user_id = await _cache().aget(key, NOT_CACHED)
+        if user_id is not NOT_CACHED:
+            local_cache.set(key, user_id, _timeout(user_id, None))
+    return user_id
+
+
+def set_user_id(username, user_id):
+    # ほかの処理でユーザ名からユーザを取得したときに、その結果(存在しなければNone)をキャッシュしておく
+    key = _key(username)
+    _cache().set(key, user_id, _timeout(user_id, DEFAULT_TIMEOUT))
+    local_cache.set(key, user_id, _timeout(user_id, None))
+
+
+async def aset_user_id(username, user_id):
+    # set_user_id()の非同期版
+    key = _key(username)
+    await _cache().aset(key, user_id, _timeout(user_id, DEFAULT_TIMEOUT))
+    local_cache.set(key, user_id, _timeout(user_id, None))
+
+
+def get_user_id(username):
+    """
+    usernameのユーザのidを返す。ユーザが存在しなければNone。
+    """
+    user_id = get_cached_user_id(username)
+    if user_id is NOT_CACHED:
+        user_id = CustomUser.objects.filter(username=username).values_list("pk", flat=True).first()
+        set_user_id(username, user_id)
+    return user_id
+
+
+async def aget_user_id(username):
+    # get_user_id()の非同期版
+    user_id = await aget_cached_user_id(username)
+    if user_id is NOT_CACHED:
+        user_id = await CustomUser.objects.filter(username=username).values_list("pk", flat=True).afirst()
+        await aset_user_id(username, user_id)
+    return user_id
+
+
+def get_user_id_or_404(username):
+    user_id = get_user_id(username)
+    if user_id is None:
+        raise Http404("No user found matching the query")
+    return user_id
+
+
+def get_user_or_404(username):
+    """
+    idとユーザ名だけを読み込んだCustomUserを返す。フォロー関係の作成・削除やidの比較に使う。
+    ほかのフィールドは遅延読み込みになっていて、参照したときにSQLで読み込まれる。
+    """
+    user_id = get_user_id_or_404(username)
+    return CustomUser.from_db(None, ["id", "username"], [user_id, username])
+
+
+def invalidate(*usernames):
+    """
+    profile_cache.invalidate()と同じく、すぐに消したうえでトランザクションのコミット後にもう一度消す。
+    """
+    keys = [_key(username) for username in usernames]
+
+    def delete():
+        local_cache.delete_many(keys)
+        _cache().delete_many(keys)
+
+    delete()
+    transaction.on_commit(delete)
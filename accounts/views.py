@@ -1,18 +1,26 @@
+import asyncio
+
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, get_user_model, login
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import BadRequest
-from django.db.models import Q
-from django.http import HttpResponseRedirect
-from django.shortcuts import get_object_or_404, render
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.http import Http404, HttpResponseRedirect, JsonResponse
+from django.shortcuts import render
+from django.template.response import TemplateResponse
 from django.urls import reverse_lazy
 from django.views import View
 from django.views.generic import CreateView, DetailView, ListView
 
-from tweets.models import Tweet
+from jobs.queue import enqueue
+from tweets import fragments, pagination, timeline
+from tweets.pagination import KeysetPaginationMixin
 
-from .forms import SignupForm
+from . import follow_index, profile_cache, tasks, user_cache, username_cache
+from .forms import BulkFollowForm, SignupForm
+from .mixins import AsyncLoginRequiredMixin, aget_user
 from .models import FriendShip
 
 CustomUser = get_user_model()
@@ -46,30 +54,50 @@ class UserProfileView(LoginRequiredMixin, DetailView):
     slug_field = "username"  # モデルのフィールドの名前
     slug_url_kwarg = "username"  # urls.pyでのキーワードの名前すなわち任意のユーザ名
 
+    def get_object(self, queryset=None):
+        # 表示ユーザとツイート一覧は見ている人によらないのでキャッシュから取る。
+        # 存在しないユーザ名もusername_cacheにキャッシュされるので、2回目からはSQLを実行せずに404になる
+        self.profile = profile_cache.get_profile(self.kwargs[self.slug_url_kwarg])
+        if self.profile is None:
+            raise Http404("No user found matching the query")
+        return self.profile["user"]
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
         # テンプレートで表示されているユーザ
         user = self.object
-        context["tweet_list"] = Tweet.objects.select_related("user").filter(user=user).order_by("-created_at")
+        # キャッシュにあるのは1ページ目だけなので、2ページ目からはカーソルで取る
+        cursor = self.request.GET.get(KeysetPaginationMixin.cursor_kwarg)
+        page = profile_cache.tweet_page(user, cursor) if cursor else self.profile["tweet_page"]
+        context["page_obj"] = page
+        context["tweet_list"] = fragments.attach_html(page.object_list)
 
-        # filter(follower=user)は,モデルのfollower変数にuserを格納してモデルのfollowerフィールドの該当ユーザに絞る.
         # フォロー数==自分がフォロワーになっている数
         # フォロワー数==自分がフォローされている数
-        context["following_count"] = FriendShip.objects.filter(follower=user).count()
-        context["follower_count"] = FriendShip.objects.filter(following=user).count()
+        # どちらもFriendShipを数えずにCustomUserに持たせている値を使う
+        context["following_count"] = user.following_count
+        context["follower_count"] = user.follower_count
 
         # self.request.userは現在ログインして画面を閲覧しているユーザ。request.userはHTTPrequestを送るユーザという意味。login_user
         # userはtemplateで表示しているユーザ。template_user
-        context["login_user_follows_template_user"] = FriendShip.objects.filter(
-            following=user, follower=self.request.user
-        ).exists()
-        context["template_user_follows_login_user"] = FriendShip.objects.filter(
-            following=self.request.user, follower=user
-        ).exists()
-        context["mutual_follow"] = FriendShip.objects.filter(
-            Q(following=user, follower=self.request.user) & Q(following=self.request.user, follower=user)
-        ).exists()
+        # フォロー関係のインデックス(accounts/follow_index.py)が使えればSQLを実行せずに両方向のフォロー関係を調べる。
+        # 表示に使うだけなので、最大FOLLOW_INDEX_CHECK_INTERVAL秒古くてもよい。
+        # 使えなければ両方向のフォロー関係を1回のクエリでまとめて取り、followerのidでどちら向きかを判定する
+        relationship = (False, False)
+        if user != self.request.user:
+            relationship = follow_index.index.relationship(self.request.user.pk, user.pk)
+        if relationship is None:
+            follower_ids = set(
+                FriendShip.objects.filter(
+                    Q(following=user, follower=self.request.user) | Q(following=self.request.user, follower=user)
+                ).values_list("follower_id", flat=True)
+            )
+            relationship = (self.request.user.pk in follower_ids, user.pk in follower_ids)
+        context["login_user_follows_template_user"], context["template_user_follows_login_user"] = relationship
+        context["mutual_follow"] = (
+            context["login_user_follows_template_user"] and context["template_user_follows_login_user"]
+        )
 
         return context
 
@@ -81,9 +109,9 @@ class FollowView(LoginRequiredMixin, View):
         follower = self.request.user
 
         # フォロー申請されたユーザを格納
-        # POSTで送信されたusername(ユーザ名)をもつCustomUserモデルオブジェクトが見つかればそれを取得。
-        # オブジェクトが見つからない場合、404エラーを返す。
-        following = get_object_or_404(CustomUser, username=self.kwargs["username"])
+        # POSTで送信されたusername(ユーザ名)をもつユーザのidをusername_cacheから取得する(idとユーザ名だけを持つ)。
+        # ユーザが見つからない場合、404エラーを返す。
+        following = username_cache.get_user_or_404(self.kwargs["username"])
 
         # ユーザーが自分自身をフォローしようとしている場合の処理を行う。
         if following == follower:
@@ -94,14 +122,20 @@ class FollowView(LoginRequiredMixin, View):
 
         # すでにフォローしている場合の処理を行う
         # get_or_created()を用いて以下の処理をより簡潔に書き直すこともできる..
+        # 書き込むかどうかは古いかもしれないフォロー関係のインデックスではなく、DBで確かめる
         elif FriendShip.objects.filter(following=following, follower=follower).exists():
-            messages.warning(request, f"すでに { following.username }さんをフォローしています。")
-            # メッセージを表示させるだけなのでレンダリングで戻す
-            return render(request, "tweets/home.html")
+            return self.already_following(request, following)
 
         # 新しいフォロー関係を作成する(フォロー成功)
         else:
-            FriendShip.objects.create(following=following, follower=follower)
+            try:
+                with transaction.atomic():
+                    FriendShip.objects.follow(follower, following)
+                    # フォローしたユーザの最近のツイートを自分の受信箱に入れるのは、ワーカーで行う
+                    enqueue(tasks.backfill_timeline, owner_id=follower.pk, author_ids=[following.pk])
+            except IntegrityError:
+                # 確かめてから作るまでの間に、同じフォローが別のリクエストで作られた(unique_friendship制約)
+                return self.already_following(request, following)
             messages.success(request, f"{ following.username }さんをフォローしました。")
 
             # フォロー後にユーザーをホーム画面にリダイレクトする
@@ -109,16 +143,25 @@ class FollowView(LoginRequiredMixin, View):
             # renderはURLはそのまま画面遷移(リダイレクト)せず画面表示内容(テンプレート)だけ書き変える。同じURLでmessageだけ表示しなおしたい時などに使う
             return HttpResponseRedirect(reverse_lazy("tweets:home"))
 
+    def already_following(self, request, following):
+        messages.warning(request, f"すでに { following.username }さんをフォローしています。")
+        # メッセージを表示させるだけなのでレンダリングで戻す
+        return render(request, "tweets/home.html")
+
 
 class UnFollowView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
         follower = self.request.user
-        following = get_object_or_404(CustomUser, username=self.kwargs["username"])
+        following = username_cache.get_user_or_404(self.kwargs["username"])
+
+        # unfollow()は削除できたかどうかを返すので、存在確認のSELECTをせずにDELETE文1回で判定できる
+        with transaction.atomic():
+            unfollowed = FriendShip.objects.unfollow(follower, following)
+            if unfollowed:
+                # フォロー解除したユーザのツイートを自分の受信箱から取り除く
+                timeline.purge(follower.pk, [following.pk])
 
-        # セイウチ演算子(Walrus operator)を用い、セイウチ演算子：代入文 → 代入式として使えるようにした
-        # 特にif文においては、代入と評価を同時に行うことが出来るようになる。
-        if friend := FriendShip.objects.filter(following=following, follower=follower):
-            friend.delete()
+        if unfollowed:
             messages.success(request, f"{ following.username }さんのフォローを解除しました。")
             return HttpResponseRedirect(reverse_lazy("tweets:home"))
 
@@ -127,31 +170,184 @@ class UnFollowView(LoginRequiredMixin, View):
             raise BadRequest("Invalid request.")
 
 
-class FollowingListView(LoginRequiredMixin, ListView):
-    model = CustomUser
+class BulkFollowView(LoginRequiredMixin, View):
+    """
+    複数のユーザをまとめてフォロー・フォロー解除する。
+    POSTでaction(follow/unfollow)とusernames(カンマ・空白・改行区切り)を受け取り、
+    ユーザ名ごとの結果を{"results": {ユーザ名: 結果}}のJSONで返す。
+    """
+
+    def post(self, request, *args, **kwargs):
+        form = BulkFollowForm(request.POST)
+        if not form.is_valid():
+            return JsonResponse({"errors": form.errors}, status=400)
+
+        follower = self.request.user
+        usernames = form.cleaned_data["usernames"]
+        with transaction.atomic():
+            if form.cleaned_data["action"] == "follow":
+                results, changed_ids = FriendShip.objects.bulk_follow(follower, usernames)
+                if changed_ids:
+                    enqueue(tasks.backfill_timeline, owner_id=follower.pk, author_ids=changed_ids)
+            else:
+                results, changed_ids = FriendShip.objects.bulk_unfollow(follower, usernames)
+                timeline.purge(follower.pk, changed_ids)
+
+        # bulk_createではシグナルが送られないので、プロフィールのキャッシュをここでまとめて消す。
+        # 一括削除はdelete()が送るシグナルで消える
+        if changed_ids and form.cleaned_data["action"] == "follow":
+            profile_cache.invalidate(follower.pk, *changed_ids)
+            user_cache.invalidate(follower.pk, *changed_ids)
+            follow_index.record((follower.pk, pk, True) for pk in changed_ids)
+        return JsonResponse({"results": results})
+
+
+def with_relationship(queryset, field, viewer_id):
+    """
+    querysetのFriendShipのfield("following"か"follower")のユーザと、ログインユーザ(viewer_id)との関係を
+    viewer_follows(ログインユーザがフォローしている)とfollows_viewer(ログインユーザをフォローしている)として付ける。
+    EXISTSのサブクエリにするので、1ページ分の関係が一覧と同じ1回のSQLで取れる(行ごとにSQLを実行しない)。
+    """
+    row_user_id = OuterRef(f"{field}_id")
+    return queryset.annotate(
+        viewer_follows=Exists(FriendShip.objects.filter(follower_id=viewer_id, following_id=row_user_id)),
+        follows_viewer=Exists(FriendShip.objects.filter(follower_id=row_user_id, following_id=viewer_id)),
+    )
+
+
+def following_queryset(user_id, viewer_id):
+    # user_idのユーザがフォローしているFriendShip。並び順はKeysetPaginatorが(created_at, id)の降順にする
+    queryset = FriendShip.objects.select_related("following").filter(follower_id=user_id)
+    return with_relationship(queryset, "following", viewer_id)
+
+
+def follower_queryset(user_id, viewer_id):
+    # user_idのユーザをフォローしているFriendShip
+    queryset = FriendShip.objects.select_related("follower").filter(following_id=user_id)
+    return with_relationship(queryset, "follower", viewer_id)
+
+
+# フォロワーが多いユーザでも重くならないように、(created_at, id)をカーソルにしてpaginate_by件ずつ表示する
+class FollowingListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
+    context_object_name = "following_list"
     template_name = "accounts/following_list.html"
+    paginate_by = 50
+
+    def get_queryset(self):
+        user_id = username_cache.get_user_id_or_404(self.kwargs["username"])
+        return following_queryset(user_id, self.request.user.pk)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["username"] = self.kwargs["username"]
-        context["following_list"] = (
-            FriendShip.objects.select_related("following")
-            .filter(follower__username=self.kwargs["username"])
-            .order_by("-created_at")
-        )
         return context
 
 
-class FollowerListView(LoginRequiredMixin, ListView):
-    model = CustomUser
+class FollowerListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
+    context_object_name = "follower_list"
     template_name = "accounts/follower_list.html"
+    paginate_by = 50
+
+    def get_queryset(self):
+        user_id = username_cache.get_user_id_or_404(self.kwargs["username"])
+        return follower_queryset(user_id, self.request.user.pk)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context["username"] = self.kwargs["username"]
-        context["follower_list"] = (
-            FriendShip.objects.select_related("follower")
-            .filter(following__username=self.kwargs["username"])
-            .order_by("-created_at")
-        )
         return context
+
+
+# ここから下はASGIで動かすときの非同期版のビュー(settings.ASYNC_VIEWSがTrueのときにurls.pyで使われる)。
+# 表示内容は同期版と同じで、DBへの問い合わせを非同期ORM(aget()・afirst()・async for)で行う。
+
+
+class AsyncUserProfileView(AsyncLoginRequiredMixin, View):
+    template_name = "accounts/profile.html"
+
+    async def get(self, request, *args, **kwargs):
+        user = await aget_user(request)
+        username = self.kwargs["username"]
+        # 存在しないとキャッシュされているユーザ名ならSQLを実行せずに404にする
+        if await username_cache.aget_cached_user_id(username) is None:
+            raise Http404("No user found matching the query")
+        # プロフィール本体とフォロー関係は互いに依存しないので同時に問い合わせる。
+        # フォロー関係はユーザのidではなくユーザ名で絞り込むので、プロフィールの取得を待たなくてよい
+        profile, follower_ids = await asyncio.gather(
+            profile_cache.aget_profile(username), self.get_follower_ids(user, username)
+        )
+        if profile is None:
+            raise Http404("No user found matching the query")
+
+        template_user = profile["user"]
+        cursor = request.GET.get(KeysetPaginationMixin.cursor_kwarg)
+        page = await profile_cache.atweet_page(template_user, cursor) if cursor else profile["tweet_page"]
+        context = {
+            "profile": template_user,
+            "object": template_user,
+            "page_obj": page,
+            "tweet_list": await fragments.aattach_html(page.object_list),
+            "following_count": template_user.following_count,
+            "follower_count": template_user.follower_count,
+            "login_user_follows_template_user": user.pk in follower_ids,
+            "template_user_follows_login_user": template_user.pk in follower_ids,
+        }
+        context["mutual_follow"] = (
+            context["login_user_follows_template_user"] and context["template_user_follows_login_user"]
+        )
+        return TemplateResponse(request, self.template_name, context)
+
+    async def get_follower_ids(self, user, username):
+        # 同期版と同じく両方向のフォロー関係を1回のクエリで取る。自分のプロフィールでは問い合わせない
+        if username == user.username:
+            return set()
+        friendships = FriendShip.objects.filter(
+            Q(following__username=username, follower=user) | Q(following=user, follower__username=username)
+        )
+        return {follower_id async for follower_id in friendships.values_list("follower_id", flat=True)}
+
+
+class AsyncFollowListView(AsyncLoginRequiredMixin, View):
+    # 非同期版のフォローリスト・フォロワーリストで共通の処理。get_queryset(user_id, viewer_id)をサブクラスで決める
+    template_name = None
+    context_object_name = None
+    paginate_by = None
+
+    def get_queryset(self, user_id, viewer_id):
+        raise NotImplementedError
+
+    async def get(self, request, *args, **kwargs):
+        user = await aget_user(request)
+        username = self.kwargs["username"]
+        user_id = await username_cache.aget_user_id(username)
+        if user_id is None:
+            raise Http404("No user found matching the query")
+        paginator = pagination.KeysetPaginator(self.get_queryset(user_id, user.pk), self.paginate_by)
+        page = await paginator.apage(request.GET.get(KeysetPaginationMixin.cursor_kwarg))
+        context = {
+            "username": username,
+            self.context_object_name: page.object_list,
+            "object_list": page.object_list,
+            "paginator": paginator,
+            "page_obj": page,
+            "is_paginated": page.has_next(),
+        }
+        return TemplateResponse(request, self.template_name, context)
+
+
+class AsyncFollowingListView(AsyncFollowListView):
+    template_name = FollowingListView.template_name
+    context_object_name = FollowingListView.context_object_name
+    paginate_by = FollowingListView.paginate_by
+
+    def get_queryset(self, user_id, viewer_id):
+        return following_queryset(user_id, viewer_id)
+
+
+class AsyncFollowerListView(AsyncFollowListView):
+    template_name = FollowerListView.template_name
+    context_object_name = FollowerListView.context_object_name
+    paginate_by = FollowerListView.paginate_by
+
+    def get_queryset(self, user_id, viewer_id):
+        return follower_queryset(user_id, viewer_id)
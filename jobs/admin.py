@@ -0,0 +1,6 @@
+from django.contrib import admin
+
+from .models import Job
+
+# 失敗し続けて止まったジョブ(status="dead")のlast_errorを確かめられるようにする
+admin.site.register(Job)
@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+from django.utils.module_loading import autodiscover_modules
+
+
+class JobsConfig(AppConfig):
+    default_auto_field = "django.db.models.BigAutoField"
+    name = "jobs"
+
+    def ready(self):
+        # 各アプリのtasks.pyを読み込み、@taskを付けた関数をワーカーから呼べるように登録する
+        autodiscover_modules("tasks")
@@ -0,0 +1,93 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+import signal
+import socket
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections, connections
+
+from jobs import queue
+
+
+def run_in_thread(job):
+    # スレッドプールのスレッドで1件実行する。スレッドごとのDB接続はCONN_MAX_AGEを過ぎたら閉じる
+    close_old_connections()
+    try:
+        return queue.execute(job)
+    except DatabaseError:
+        # 失敗も記録できなかった。ジョブは借りる期限が切れたらまた取り出される
+        return False
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = "ジョブ(jobs.models.Job)を取り出してスレッドプールで実行し続ける。SIGINT・SIGTERMで実行中のジョブを終えてから止まる。"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--threads", type=int, default=settings.JOB_WORKER_THREADS, help="同時に実行するジョブの数"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.JOB_BATCH_SIZE, help="1回の取り出しで取るジョブの最大数"
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.JOB_POLL_INTERVAL,
+            help="実行できるジョブがないときに、次に取り出しに行くまでの秒数",
+        )
+        parser.add_argument("--once", action="store_true", help="今実行できるジョブがなくなったら終了する")
+
+    def handle(self, *args, **options):
+        threads = options["threads"]
+        if threads < 1 or options["batch_size"] < 1:
+            raise CommandError("--threadsと--batch-sizeは1以上にしてください。")
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        stop = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *args: stop.set())
+
+        succeeded = failed = 0
+        running = set()
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="runworker") as executor:
+            while not stop.is_set():
+                done = {future for future in running if future.done()}
+                for future in done:
+                    if future.result():
+                        succeeded += 1
+                    else:
+                        failed += 1
+                running -= done
+
+                # 空いているスレッドの分だけ取り出す。待たせている間に借りる期限が切れないように、余分には取らない
+                free = threads - len(running)
+                try:
+                    jobs = queue.claim(worker_id, min(free, options["batch_size"])) if free else []
+                except DatabaseError as e:
+                    # DBが一時的に使えない(SQLiteのロック待ちの時間切れなど)ときは、止まらずに待ってから取り出し直す
+                    self.stderr.write(f"ジョブを取り出せませんでした: {e}")
+                    stop.wait(options["poll_interval"])
+                    continue
+                for job in jobs:
+                    running.add(executor.submit(run_in_thread, job))
+                if jobs:
+                    continue
+                if running:
+                    wait(running, timeout=options["poll_interval"], return_when=FIRST_COMPLETED)
+                elif options["once"]:
+                    break
+                else:
+                    stop.wait(options["poll_interval"])
+
+            # 止めるときは実行中のジョブが終わるのを待つ
+            for future in running:
+                if future.result():
+                    succeeded += 1
+                else:
+                    failed += 1
+        connections.close_all()
+        self.stdout.write(f"成功: {succeeded}件 失敗: {failed}件")
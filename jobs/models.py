@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+
+def default_max_attempts():
+    return settings.JOB_MAX_ATTEMPTS
+
+
+class Job(models.Model):
+    """
+    バックグラウンドで実行するジョブ。taskは@taskを付けた関数の名前、kwargsはその引数(JSONにできる値)。
+    ワーカー(runworkerコマンド)が取り出すとstatusをrunningにしてlocked_untilまで借り、
+    成功したら行を削除する。失敗したらrun_atを延ばしてpendingに戻し、max_attempts回失敗したらdeadにして残す。
+    locked_untilを過ぎてもrunningのまま(ワーカーが落ちた)のジョブは、ほかのワーカーが取り出し直す。
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DEAD = "dead"
+    STATUS_CHOICES = [(PENDING, "待ち"), (RUNNING, "実行中"), (DEAD, "失敗")]
+
+    task = models.CharField(max_length=200)
+    kwargs = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # この日時を過ぎたら実行してよい。失敗したときは次に試す日時にする
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0, verbose_name="実行した回数")
+    max_attempts = models.PositiveIntegerField(default=default_max_attempts)
+    # 取り出したワーカーと、取り出すたびに変わる印。成功・失敗の書き込みは自分が取り出したジョブにだけ行う
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # 実行できるジョブを古い順に取り出す(status, run_at)の範囲検索用
+            models.Index(fields=["status", "run_at", "id"], name="job_status_run_at_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.task} ({self.status})"
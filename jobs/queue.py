@@ -0,0 +1,123 @@
+from datetime import timedelta
+import traceback
+import uuid
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+# DBのテーブル(Job)だけを使うジョブキュー。RedisなどのブローカーなしでWebのプロセスとワーカーの間でジョブを受け渡す。
+#
+# 登録: 関数に@taskを付け、enqueue(関数, 引数=値)で登録する。呼び出し元のトランザクションの中で登録するので、
+#       ロールバックされたらジョブも登録されず、コミットされたらワーカーから見えるようになる。
+# 取り出し: claim()でまとめて取り出す。SELECT ... FOR UPDATE SKIP LOCKEDが使えるDB(PostgreSQLなど)では、
+#       ほかのワーカーがロックしている行を飛ばして選ぶ。SQLiteでは選ぶのと書き換えるのをUPDATE文1回で行う。
+# 実行: execute()で1件ずつ実行する。ジョブの関数とジョブの削除は同じトランザクションで行う。
+#       ワーカーが落ちると同じジョブがもう一度実行されることがあるので、関数は何度実行しても同じ結果になるように書く。
+
+# ジョブの名前 -> 関数
+_registry = {}
+
+
+def task(func):
+    # ジョブとして実行できる関数にする。名前は「モジュール名.関数名」
+    func.task_name = f"{func.__module__}.{func.__qualname__}"
+    _registry[func.task_name] = func
+    return func
+
+
+def enqueue(func, *, delay=0, max_attempts=None, **kwargs):
+    """
+    @taskを付けた関数funcをkwargsで呼ぶジョブを登録する。delay秒後から実行できる。
+    """
+    job = Job(task=func.task_name, kwargs=kwargs, run_at=timezone.now() + timedelta(seconds=delay))
+    if max_attempts is not None:
+        job.max_attempts = max_attempts
+    job.save()
+    return job
+
+
+def backoff(attempts):
+    # attempts回目の失敗の後、次に試すまでの秒数。1回ごとに2倍にし、JOB_RETRY_MAX_DELAY秒で止める
+    return min(settings.JOB_RETRY_BASE_DELAY * 2 ** (attempts - 1), settings.JOB_RETRY_MAX_DELAY)
+
+
+def claim(worker_id, limit):
+    """
+    実行できるジョブを古い順に最大limit件取り出し、JOB_LEASE_SECONDS秒の間このワーカーのものにする。
+    """
+    now = timezone.now()
+    lock = f"{worker_id}:{uuid.uuid4().hex}"
+    # 実行待ちで実行日時を過ぎたもの、または取り出したワーカーが期限までに終わらせなかったもの
+    available = Q(status=Job.PENDING, run_at__lte=now) | Q(status=Job.RUNNING, locked_until__lt=now)
+    changes = {
+        "status": Job.RUNNING,
+        "locked_by": lock,
+        "locked_until": now + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+        "attempts": F("attempts") + 1,
+    }
+    using = router.db_for_write(Job)
+    candidates = Job.objects.using(using).filter(available).order_by("run_at", "id")
+    with transaction.atomic(using=using):
+        if connections[using].features.has_select_for_update_skip_locked:
+            pks = list(candidates.select_for_update(skip_locked=True).values_list("pk", flat=True)[:limit])
+            Job.objects.using(using).filter(pk__in=pks).update(**changes)
+        else:
+            # SQLiteは書き込みが一度に1つだけなので、UPDATE文1回で選んで書き換えれば2つのワーカーが同じジョブを取らない
+            Job.objects.using(using).filter(available, pk__in=candidates.values("pk")[:limit]).update(**changes)
+    return list(Job.objects.using(using).filter(locked_by=lock, status=Job.RUNNING).order_by("run_at", "id"))
+
+
+def _mine(job):
+    # 自分が取り出したままのジョブ。期限切れでほかのワーカーに取られていたら該当しない
+    return Job.objects.filter(pk=job.pk, locked_by=job.locked_by, status=Job.RUNNING)
+
+
+def fail(job, error):
+    # 失敗を記録する。max_attempts回目ならdeadにし、それ以外は待ってから実行し直す
+    if job.attempts >= job.max_attempts:
+        changes = {"status": Job.DEAD, "locked_until": None}
+    else:
+        changes = {"status": Job.PENDING, "run_at": timezone.now() + timedelta(seconds=backoff(job.attempts))}
+    _mine(job).update(last_error=error, **changes)
+
+
+def execute(job):
+    """
+    claim()で取り出したジョブを実行する。成功したらTrue、失敗したらFalseを返す。
+    """
+    if job.attempts > job.max_attempts:
+        # 実行中にワーカーが落ち続け、fail()を通らずに回数を超えた
+        fail(job, "ワーカーが期限までに終わらせられませんでした。")
+        return False
+    func = _registry.get(job.task)
+    if func is None:
+        fail(job, f"登録されていないタスクです: {job.task}")
+        return False
+    try:
+        with transaction.atomic():
+            func(**job.kwargs)
+            _mine(job).delete()
+    except Exception:
+        fail(job, traceback.format_exc())
+        return False
+    return True
+
+
+def run_pending(worker_id="inline", batch_size=None):
+    """
+    今実行できるジョブを、このスレッドで順に全部実行する。実行した件数を返す。
+    テストや、ワーカーを動かしていない環境で手動で実行するときに使う。
+    """
+    batch_size = batch_size or settings.JOB_BATCH_SIZE
+    count = 0
+    while True:
+        jobs = claim(worker_id, batch_size)
+        if not jobs:
+            return count
+        for job in jobs:
+            execute(job)
+        count += len(jobs)
@@ -0,0 +1,141 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import queue
+from .models import Job
+
+# テスト用のタスクが呼ばれた引数
+calls = []
+
+
+@queue.task
+def record_call(value):
+    calls.append(value)
+
+
+@queue.task
+def always_fail():
+    raise ValueError("失敗しました")
+
+
+@override_settings(JOB_RETRY_BASE_DELAY=10, JOB_RETRY_MAX_DELAY=30, JOB_MAX_ATTEMPTS=3)
+class TestJobQueue(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_success_run(self):
+        """
+        ジョブを登録して実行する。
+        ・タスクが登録した引数で呼ばれ、成功したジョブは削除される
+        ・ロールバックしたトランザクションの中で登録したジョブは残らない
+        """
+        queue.enqueue(record_call, value="a")
+        try:
+            with transaction.atomic():
+                queue.enqueue(record_call, value="b")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        self.assertEqual(queue.run_pending(), 1)
+        self.assertEqual(calls, ["a"])
+        self.assertFalse(Job.objects.exists())
+
+    def test_success_retry_with_backoff_and_dead_letter(self):
+        """
+        失敗し続けるジョブを実行する。
+        ・失敗するたびに待つ時間が倍になり(最大JOB_RETRY_MAX_DELAY秒)、実行待ちに戻る
+        ・JOB_MAX_ATTEMPTS回失敗したらdeadになり、エラーが残る
+        """
+        job = queue.enqueue(always_fail)
+        for attempts, delay in ((1, 10), (2, 20)):
+            self.assertEqual(queue.run_pending(), 1)
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (Job.PENDING, attempts))
+            self.assertAlmostEqual((job.run_at - timezone.now()).total_seconds(), delay, delta=2)
+            # 待つ時間の間は取り出されない
+            self.assertEqual(queue.run_pending(), 0)
+            Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+
+        self.assertEqual(queue.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DEAD, 3))
+        self.assertIn("ValueError: 失敗しました", job.last_error)
+        self.assertEqual(queue.run_pending(), 0)
+        self.assertEqual(queue.backoff(5), 30)
+
+    def test_success_claim_batch(self):
+        """
+        5件のジョブを3件ずつ取り出す。
+        ・古い順に3件取り出され、取り出したジョブはほかのワーカーに取り出されない
+        ・借りる期限を過ぎたジョブはほかのワーカーが取り出し直せる
+        ・実行日時が先のジョブは取り出されない
+        """
+        jobs = [queue.enqueue(record_call, value=i) for i in range(5)]
+        queue.enqueue(record_call, delay=60, value="later")
+
+        first = queue.claim("worker1", 3)
+        self.assertEqual([job.pk for job in first], [job.pk for job in jobs[:3]])
+        self.assertEqual({job.status for job in first}, {Job.RUNNING})
+        second = queue.claim("worker2", 3)
+        self.assertEqual([job.pk for job in second], [job.pk for job in jobs[3:]])
+
+        Job.objects.filter(pk=first[0].pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        reclaimed = queue.claim("worker2", 3)
+        self.assertEqual([(job.pk, job.attempts) for job in reclaimed], [(first[0].pk, 2)])
+        # 期限切れで取られたジョブは、元のワーカーが終えても結果を書き込まない
+        self.assertTrue(queue.execute(first[0]))
+        self.assertTrue(Job.objects.filter(pk=first[0].pk, status=Job.RUNNING).exists())
+
+    def test_success_claim_with_skip_locked(self):
+        """
+        SELECT ... FOR UPDATE SKIP LOCKEDが使えるDBの場合の取り出し方で取り出す。
+        ・SQLiteの場合と同じく古い順に取り出される
+        """
+        jobs = [queue.enqueue(record_call, value=i) for i in range(3)]
+        with mock.patch.object(connection.features, "has_select_for_update_skip_locked", True):
+            claimed = queue.claim("worker1", 2)
+        self.assertEqual([job.pk for job in claimed], [job.pk for job in jobs[:2]])
+
+    def test_failure_unknown_task(self):
+        """
+        登録されていないタスクのジョブを実行する。
+        ・失敗として記録される
+        """
+        job = Job.objects.create(task="jobs.tests.missing")
+        self.assertEqual(queue.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertIn("jobs.tests.missing", job.last_error)
+
+
+@override_settings(JOB_RETRY_BASE_DELAY=0)
+class TestRunWorkerCommand(TransactionTestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_success_run_until_empty(self):
+        """
+        スレッドプールのワーカーで20件のジョブを実行する(--onceで実行できるジョブがなくなったら終了)。
+        ・すべてのジョブが1回ずつ実行され、成功したジョブは削除される
+        ・max_attempts回失敗したジョブはdeadとして残る
+        テストのSQLiteはメモリ上の共有キャッシュで、書き込みが重なると待たずにロックのエラーになるため1スレッドで実行する。
+        """
+        for i in range(20):
+            queue.enqueue(record_call, value=i)
+        queue.enqueue(always_fail, max_attempts=3)
+
+        out = StringIO()
+        call_command(
+            "runworker", "--once", "--threads", "1", "--batch-size", "2", "--poll-interval", "0.01", stdout=out
+        )
+
+        self.assertEqual(sorted(calls), list(range(20)))
+        self.assertEqual(list(Job.objects.values_list("task", "status")), [(always_fail.task_name, Job.DEAD)])
+        self.assertEqual(out.getvalue().strip(), "成功: 20件 失敗: 3件")
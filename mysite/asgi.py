@@ -13,4 +13,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Djangoの準備(get_asgi_application)が終わってから読み込む
+from accounts import follow_index  # noqa: E402
+from tweets.sse import LiveTimelineApp  # noqa: E402
+
+# フォロー関係のインデックスを使う設定なら、最初のリクエストの前に読み込んでおく
+follow_index.warm()
+
+# 新しいツイートのSSE(settings.LIVE_TIMELINE_PATH)だけを手前で受け取り、それ以外はDjangoに渡す
+application = LiveTimelineApp(django_application)
@@ -0,0 +1,109 @@
+import asyncio
+from contextvars import ContextVar
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.decorators import sync_and_async_middleware
+
+# 読み取りをレプリカ(settings.REPLICA_DATABASE)に、書き込みをプライマリ(default)に振り分ける。
+#
+# レプリカから読むのは、GETなどのリクエストの処理中だけ。POSTなどのリクエスト、管理コマンド、
+# トランザクションの中の読み取りは、書き込みと同じプライマリから読む。
+# リクエストの途中で書き込んだら、そのリクエストの残りの読み取りもプライマリから行い、
+# セッションに印を付けて、REPLICA_STICKY_SECONDS秒の間はそのユーザの読み取りをすべてプライマリから行う。
+# レプリカへの反映が遅れていても、自分のツイートやフォローがすぐに見えるようにするため。
+
+# プライマリから読む期限(UNIX時間)を入れるセッションのキー
+PRIMARY_UNTIL_SESSION_KEY = "_db_primary_until"
+
+# 常にプライマリから読むアプリ。ログイン直後のセッションがレプリカにまだないとログアウトしたように見えるため
+PRIMARY_ONLY_APPS = {"sessions"}
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class RequestState:
+    # 処理中のリクエスト1件の振り分けの状態
+    __slots__ = ("use_replica", "wrote")
+
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+# sync_to_asyncで別スレッドに移っても引き継がれるようにcontextvarに入れる
+_current_request = ContextVar("db_router_current_request", default=None)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _current_request.get()
+        if state is None or not state.use_replica or settings.REPLICA_DATABASE is None:
+            return DEFAULT_DB_ALIAS
+        if model._meta.app_label in PRIMARY_ONLY_APPS or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return settings.REPLICA_DATABASE
+
+    def db_for_write(self, model, **hints):
+        state = _current_request.get()
+        if state is not None and model._meta.app_label not in PRIMARY_ONLY_APPS:
+            state.use_replica = False
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # プライマリとレプリカは同じデータなので、どちらから読んだオブジェクトどうしでも関連付けてよい
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # レプリカはプライマリのコピーなのでマイグレーションしない
+        return db == DEFAULT_DB_ALIAS
+
+
+def _request_state(request):
+    # セッションを読むとSQLを実行することがあるので、非同期のミドルウェアからはsync_to_asyncで呼ぶ
+    session = getattr(request, "session", None)
+    primary_until = session.get(PRIMARY_UNTIL_SESSION_KEY, 0) if session is not None else 0
+    return RequestState(request.method in SAFE_METHODS and time.time() >= primary_until)
+
+
+def _finish(request, state):
+    session = getattr(request, "session", None)
+    if state.wrote and session is not None:
+        session[PRIMARY_UNTIL_SESSION_KEY] = time.time() + settings.REPLICA_STICKY_SECONDS
+
+
+@sync_and_async_middleware
+def replica_middleware(get_response):
+    """
+    SessionMiddlewareより後に置く。レプリカがない場合は何もしない。
+    """
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            if settings.REPLICA_DATABASE is None:
+                return await get_response(request)
+            state = await sync_to_async(_request_state)(request)
+            token = _current_request.set(state)
+            try:
+                return await get_response(request)
+            finally:
+                _current_request.reset(token)
+                _finish(request, state)
+
+    else:
+
+        def middleware(request):
+            if settings.REPLICA_DATABASE is None:
+                return get_response(request)
+            state = _request_state(request)
+            token = _current_request.set(state)
+            try:
+                return get_response(request)
+            finally:
+                _current_request.reset(token)
+                _finish(request, state)
+
+    return middleware
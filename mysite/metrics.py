@@ -0,0 +1,249 @@
+import asyncio
+from bisect import bisect_left
+from contextvars import ContextVar
+import hmac
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+
+# ビュー(URLの名前)ごとのリクエスト数・処理時間のヒストグラム・SQLの回数と時間を集計し、
+# /metricsでPrometheusのテキスト形式で返す。DEBUGをTrueにしなくても(connection.queriesを使わずに)数える。
+#
+# 集計はスレッドごとの辞書に書き込み、書き込むのはそのスレッドだけなのでロックを取らない。
+# /metricsを読むときに全スレッドの分を足し合わせる。
+
+# 処理時間のヒストグラムの区切り(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# URLが見つからなかったリクエストのビュー名
+UNRESOLVED = "<unresolved>"
+
+
+class RequestStats:
+    # 処理中のリクエスト1件で実行したSQLの回数と時間
+    __slots__ = ("queries", "sql_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+class ViewStats:
+    # 1つのビューの集計。バケットは累積していない回数で持ち、出力するときに累積する
+    __slots__ = ("requests", "latency_buckets", "latency_sum", "queries", "sql_seconds")
+
+    def __init__(self):
+        self.requests = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+    def observe(self, latency, request_stats):
+        self.requests += 1
+        self.latency_buckets[bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+        self.queries += request_stats.queries
+        self.sql_seconds += request_stats.sql_seconds
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.latency_buckets = [a + b for a, b in zip(self.latency_buckets, other.latency_buckets)]
+        self.latency_sum += other.latency_sum
+        self.queries += other.queries
+        self.sql_seconds += other.sql_seconds
+
+
+class Registry:
+    """
+    スレッドごとの集計({ビュー名: ViewStats})をまとめて持つ。
+    ロックを取るのはスレッドが最初に記録するときと、/metricsで読むときだけ。
+    終了したスレッドの分はretiredに足し込んで手放す(runserverのようにリクエストごとにスレッドを作る場合のため)。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (スレッド, そのスレッドの集計)
+        self._threads = []
+        self._retired = {}
+
+    def _thread_stats(self):
+        stats = getattr(self._local, "stats", None)
+        if stats is None:
+            stats = self._local.stats = {}
+            with self._lock:
+                self._retire_finished_threads()
+                self._threads.append((threading.current_thread(), stats))
+        return stats
+
+    def _retire_finished_threads(self):
+        alive = []
+        for thread, stats in self._threads:
+            if thread.is_alive():
+                alive.append((thread, stats))
+            else:
+                _merge_into(self._retired, stats)
+        self._threads = alive
+
+    def observe(self, view_name, latency, request_stats):
+        stats = self._thread_stats()
+        view_stats = stats.get(view_name)
+        if view_stats is None:
+            view_stats = stats[view_name] = ViewStats()
+        view_stats.observe(latency, request_stats)
+
+    def collect(self):
+        # 全スレッドの集計を足し合わせた{ビュー名: ViewStats}を返す
+        with self._lock:
+            self._retire_finished_threads()
+            total = {}
+            _merge_into(total, self._retired)
+            for _, stats in self._threads:
+                # 他のスレッドが書き込み中でも壊れないように、辞書をコピーしてから読む
+                _merge_into(total, stats.copy())
+        return total
+
+
+def _merge_into(total, stats):
+    for view_name, view_stats in stats.items():
+        if view_name not in total:
+            total[view_name] = ViewStats()
+        total[view_name].merge(view_stats)
+
+
+registry = Registry()
+
+# 処理中のリクエストのRequestStats。sync_to_asyncで別スレッドに移っても引き継がれるようにcontextvarに入れる
+_current_request = ContextVar("metrics_current_request", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    # connection.execute_wrapper()と同じ形の関数。リクエストの処理中ならSQLの回数と時間を数える
+    request_stats = _current_request.get()
+    if request_stats is None:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_stats.queries += 1
+        request_stats.sql_seconds += time.perf_counter() - started_at
+
+
+def install_query_recorder(connection, **kwargs):
+    # with connection.execute_wrapper(...)で囲むとそのスレッドの接続にしか効かず、
+    # 非同期ビューのSQLは別スレッドの接続で実行されるので、すべての接続に常に付けておく
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+def _view_name(request):
+    resolver_match = getattr(request, "resolver_match", None)
+    if resolver_match is None:
+        return UNRESOLVED
+    return resolver_match.view_name
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    MIDDLEWAREの先頭に置いて、他のミドルウェアも含めた処理時間を測る。
+    """
+    # このミドルウェアが読み込まれる前に開かれていた接続にも付ける
+    for connection in connections.all():
+        install_query_recorder(connection)
+
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            request_stats = RequestStats()
+            token = _current_request.set(request_stats)
+            started_at = time.perf_counter()
+            try:
+                return await get_response(request)
+            finally:
+                registry.observe(_view_name(request), time.perf_counter() - started_at, request_stats)
+                _current_request.reset(token)
+
+    else:
+
+        def middleware(request):
+            request_stats = RequestStats()
+            token = _current_request.set(request_stats)
+            started_at = time.perf_counter()
+            try:
+                return get_response(request)
+            finally:
+                registry.observe(_view_name(request), time.perf_counter() - started_at, request_stats)
+                _current_request.reset(token)
+
+    return middleware
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(stats):
+    lines = [
+        "# HELP django_view_requests_total Requests handled, by view.",
+        "# TYPE django_view_requests_total counter",
+    ]
+    views = sorted(stats)
+    for view_name in views:
+        lines.append(f'django_view_requests_total{{view="{_label(view_name)}"}} {stats[view_name].requests}')
+
+    lines += [
+        "# HELP django_view_latency_seconds Request latency including middleware, by view.",
+        "# TYPE django_view_latency_seconds histogram",
+    ]
+    for view_name in views:
+        view_stats = stats[view_name]
+        label = _label(view_name)
+        cumulative = 0
+        for bound, count in zip([*LATENCY_BUCKETS, "+Inf"], view_stats.latency_buckets):
+            cumulative += count
+            lines.append(f'django_view_latency_seconds_bucket{{view="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'django_view_latency_seconds_sum{{view="{label}"}} {view_stats.latency_sum}')
+        lines.append(f'django_view_latency_seconds_count{{view="{label}"}} {view_stats.requests}')
+
+    lines += [
+        "# HELP django_view_sql_queries_total SQL queries executed, by view.",
+        "# TYPE django_view_sql_queries_total counter",
+    ]
+    for view_name in views:
+        lines.append(f'django_view_sql_queries_total{{view="{_label(view_name)}"}} {stats[view_name].queries}')
+
+    lines += [
+        "# HELP django_view_sql_seconds_total Time spent executing SQL, by view.",
+        "# TYPE django_view_sql_seconds_total counter",
+    ]
+    for view_name in views:
+        lines.append(f'django_view_sql_seconds_total{{view="{_label(view_name)}"}} {stats[view_name].sql_seconds}')
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    """
+    集計にはユーザ名などは含まれないが、外部に公開しないように
+    METRICS_ALLOWED_IPSから、Authorization: Bearer <METRICS_TOKEN>を付けたアクセスだけを許す。
+    同じマシンのリバースプロキシの後ろでは外部からのリクエストもREMOTE_ADDRが127.0.0.1になるので、
+    IPアドレスだけでは判断しない。METRICS_TOKENを設定していなければ誰にも見せない。
+    """
+    token = settings.METRICS_TOKEN
+    if not token or request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        raise PermissionDenied
+    # 文字列の比較にかかる時間からトークンを推測されないように、compare_digestで比べる
+    if not hmac.compare_digest(request.META.get("HTTP_AUTHORIZATION", "").encode(), f"Bearer {token}".encode()):
+        raise PermissionDenied
+    return HttpResponse(render_metrics(registry.collect()), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,338 @@
+from abc import ABC, abstractmethod
+import asyncio
+from functools import lru_cache
+from hashlib import blake2b
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.module_loading import import_string
+
+from accounts.mixins import aget_user
+
+try:
+    import fcntl
+except ImportError:
+    # WindowsにはないのでFileLockStoreは使えない
+    fcntl = None
+
+# 書き込みの多いURL(settings.RATE_LIMITSに書いたURLの名前)へのPOSTを、ユーザごと・IPアドレスごとのトークンバケットで制限する。
+# バケットは最大capacity個のトークンを持ち、per秒ごとにcapacity個の割合で補充される。リクエストのたびに1個
+# (RATE_LIMITSに"cost"があればその数)使い、足りなければ429を返してRetry-Afterヘッダで何秒待てばよいかを伝える。
+# バケットの状態はsettings.RATE_LIMIT_STOREのストアに置く。ワーカープロセスが複数ある場合は、
+# 同じマシンのプロセスで共有できるFileLockStoreにしないと、プロセスの数だけ多く通してしまう。
+
+# 429のときに返す本文
+TOO_MANY_REQUESTS_MESSAGE = "リクエストが多すぎます。しばらく待ってからもう一度お試しください。"
+# 1回のリクエストで使うトークンがcapacityより多く、待っても通せないときに返す本文
+TOO_LARGE_MESSAGE = "一度に指定する数が多すぎます。分けて送ってください。"
+
+
+def take_tokens(levels, now, limits, cost=1):
+    """
+    バケットごとの前回の残り(残り, 更新した時刻)に、nowまでに補充された分を足してcost個ずつ使う。
+    limitsはバケットごとの(capacity, 1秒あたりに補充する数)。(新しい残りのリスト, 待つ秒数)を返す。
+    1つでも足りないバケットがあればどれからも使わず、全部にcost個たまるまでの秒数を返す。
+    costがcapacityより多いバケットがあれば、いくら待ってもたまらないのでmath.infを返す。
+    """
+    tokens = [
+        min(capacity, left + (now - updated_at) * rate) for (left, updated_at), (capacity, rate) in zip(levels, limits)
+    ]
+    if any(cost > capacity for capacity, _ in limits):
+        return tokens, math.inf
+    wait = max(((cost - left) / rate for left, (_, rate) in zip(tokens, limits) if left < cost), default=0.0)
+    if wait:
+        return tokens, wait
+    return [left - cost for left in tokens], 0.0
+
+
+class BaseStore(ABC):
+    """
+    バケットの状態を持つ場所。take()は渡されたバケットをまとめて排他して読み書きする。
+    Redisなどを使う場合はこれを継承したクラスを作り、settings.RATE_LIMIT_STOREに書く。
+    """
+
+    # take()がファイルやネットワークを待つ(ブロックする)ならTrue。非同期のミドルウェアでは別のスレッドで呼ぶ
+    blocking = True
+
+    @abstractmethod
+    def take(self, buckets, cost=1):
+        # buckets([(キー, capacity, 1秒あたりに補充する数)])からトークンをcost個ずつ使う。
+        # 通してよければ0、だめなら待つ秒数を返す
+        pass
+
+
+class InProcessStore(BaseStore):
+    """
+    プロセス内の辞書に持つ。開発用のサーバやワーカーが1つの場合に使う。
+    max_entriesを超えたら、満タンまで補充済みのバケット(消しても結果が変わらないもの)から消す。
+    """
+
+    # 辞書を読み書きするだけなので、イベントループのスレッドで呼んでもよい
+    blocking = False
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # キー -> [残りのトークン, 更新した時刻, 満タンになる時刻]
+        self._buckets = {}
+
+    def take(self, buckets, cost=1):
+        now = time.monotonic()
+        limits = [(capacity, rate) for _, capacity, rate in buckets]
+        with self._lock:
+            entries = []
+            for key, capacity, _ in buckets:
+                entry = self._buckets.get(key)
+                if entry is None:
+                    if len(self._buckets) >= self.max_entries:
+                        self._prune(now)
+                    entry = self._buckets[key] = [capacity, now, now]
+                entries.append(entry)
+            tokens, wait = take_tokens([(entry[0], entry[1]) for entry in entries], now, limits, cost)
+            for entry, left, (capacity, rate) in zip(entries, tokens, limits):
+                entry[:] = [left, now, now + (capacity - left) / rate]
+            return wait
+
+    def _prune(self, now):
+        full = [key for key, entry in self._buckets.items() if entry[2] <= now]
+        for key in full:
+            del self._buckets[key]
+        # それでも多ければ古く作られたものから消す
+        while len(self._buckets) >= self.max_entries:
+            del self._buckets[next(iter(self._buckets))]
+
+
+class FileLockStore(BaseStore):
+    """
+    同じマシンのワーカープロセスどうしで、pathのファイルをメモリにマップ(mmap)して共有する。
+    ファイルはslots個の枠(キーのハッシュ・残りのトークン・更新した時刻)の表で、
+    読み書きの間はファイル全体をflockで排他する。キーのハッシュから決まる枠をPROBE個まで順に探し、
+    空きがなければその中で一番長く使われていない枠を使い回す(そのキーのバケットは満タンからやり直しになる)。
+    """
+
+    SLOT = struct.Struct("<Qdd")
+    PROBE = 8
+
+    def __init__(self, path=None, slots=65536):
+        if fcntl is None:
+            raise ImproperlyConfigured("FileLockStoreはfcntlが使えるOS(LinuxやmacOS)でだけ使えます。")
+        self.path = path or os.path.join(tempfile.gettempdir(), "mysite-ratelimit")
+        self.slots = slots
+        # flockは同じファイルを開いたプロセスどうしの排他なので、同じプロセスのスレッドどうしはこちらで排他する
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # fork前に開いたファイルを子プロセスで使い回さないように、プロセスごとに開き直す
+        if self._pid == os.getpid():
+            return
+        # 親プロセスから受け継いだものは閉じる(子プロセスで閉じても親プロセスのものは閉じない)
+        if self._map is not None:
+            self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+        size = self.SLOT.size * self.slots
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._pid = os.getpid()
+
+    def _hash(self, key):
+        # 0は空きの枠を表すので使わない
+        return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def _find(self, key_hash, capacity, now, taken):
+        # (枠の位置, 残り, 更新した時刻)。同じtake()で先に選んだ枠(taken)は使い回さない
+        oldest = None
+        for i in range(self.PROBE):
+            offset = (key_hash + i) % self.slots * self.SLOT.size
+            slot_hash, left, updated_at = self.SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, left, updated_at
+            if slot_hash == 0:
+                return offset, capacity, now
+            if offset not in taken and (oldest is None or updated_at < oldest[1]):
+                oldest = (offset, updated_at)
+        return oldest[0], capacity, now
+
+    def take(self, buckets, cost=1):
+        key_hashes = [self._hash(key) for key, _, _ in buckets]
+        limits = [(capacity, rate) for _, capacity, rate in buckets]
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                # 複数のプロセスで同じ時計を使うため、monotonicではなく時刻を使う
+                now = time.time()
+                slots = []
+                for key_hash, (capacity, _) in zip(key_hashes, limits):
+                    slots.append(self._find(key_hash, capacity, now, {offset for offset, _, _ in slots}))
+                tokens, wait = take_tokens([(left, updated_at) for _, left, updated_at in slots], now, limits, cost)
+                for key_hash, (offset, _, _), left in zip(key_hashes, slots, tokens):
+                    self.SLOT.pack_into(self._map, offset, key_hash, left, now)
+                return wait
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = import_string(settings.RATE_LIMIT_STORE)(**settings.RATE_LIMIT_STORE_OPTIONS)
+        return _store
+
+
+def reset_store():
+    # 次のget_store()で設定からストアを作り直す。テストではテストごとに呼んで、ほかのテストのバケットを残さない
+    global _store
+    with _store_lock:
+        _store = None
+
+
+@receiver(setting_changed)
+def reset_store_on_setting_changed(setting, **kwargs):
+    # override_settingsでストアの設定を変えたら、変えた設定でストアを作り直す
+    if setting in ("RATE_LIMIT_STORE", "RATE_LIMIT_STORE_OPTIONS"):
+        reset_store()
+
+
+def client_ip(request):
+    """
+    リクエストを送ってきたIPアドレス。リバースプロキシの後ろで動かす場合は、
+    settings.RATE_LIMIT_PROXY_COUNTに間にあるプロキシの数を書き、X-Forwarded-Forのその位置から取る。
+    (クライアントが自分で書いたX-Forwarded-Forの値は信用しない)
+    """
+    count = settings.RATE_LIMIT_PROXY_COUNT
+    if count:
+        forwarded = [ip.strip() for ip in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",") if ip.strip()]
+        if len(forwarded) >= count:
+            return forwarded[-count]
+    return request.META.get("REMOTE_ADDR", "")
+
+
+@lru_cache(maxsize=10000)
+def _view_name(path):
+    # resolve()はURLのパターンを順に正規表現で照合するので1回20マイクロ秒ほどかかる。同じパスの結果は使い回す
+    try:
+        return resolve(path).view_name
+    except Resolver404:
+        return None
+
+
+def _limits(request):
+    """
+    制限するリクエストなら(バケットの名前, {"user"または"ip": (capacity, per)}, 使うトークンの数)、
+    制限しないならNone。RATE_LIMITSに"bucket"があればそのURLの名前のバケットと制限を使い、
+    "cost"があればその関数(request -> int)でトークンの数を決める。
+    """
+    if not settings.RATE_LIMIT_ENABLED or request.method not in settings.RATE_LIMIT_METHODS:
+        return None
+    view_name = _view_name(request.path_info)
+    limits = settings.RATE_LIMITS.get(view_name)
+    if not limits:
+        return None
+    cost = import_string(limits["cost"])(request) if "cost" in limits else 1
+    bucket = limits.get("bucket")
+    if bucket is not None:
+        return bucket, settings.RATE_LIMITS[bucket], cost
+    return view_name, limits, cost
+
+
+def buckets_for(view_name, limits, user, ip):
+    # ユーザのバケットとIPアドレスのバケット。ログインしていないユーザはIPアドレスのバケットだけを使う
+    buckets = []
+    for kind, value in (("user", user.pk if user.is_authenticated else None), ("ip", ip)):
+        limit = limits.get(kind)
+        if limit is not None and value is not None:
+            capacity, per = limit
+            buckets.append((f"{view_name}:{kind}:{value}", capacity, capacity / per))
+    return buckets
+
+
+def check(view_name, limits, user, ip, cost=1):
+    """
+    ユーザのバケットとIPアドレスのバケットからトークンをcost個使う。通してよければ0、だめなら待つ秒数を返す。
+    """
+    buckets = buckets_for(view_name, limits, user, ip)
+    if not buckets:
+        return 0.0
+    return get_store().take(buckets, cost)
+
+
+async def acheck(view_name, limits, user, ip, cost=1):
+    # check()の非同期版。flockなどで待つストアは、イベントループを止めないように別のスレッドで呼ぶ。
+    # ストアはスレッドの間で排他しているので、DBの処理と同じスレッド(thread_sensitive)に並ばせない
+    buckets = buckets_for(view_name, limits, user, ip)
+    if not buckets:
+        return 0.0
+    store = get_store()
+    if store.blocking:
+        return await sync_to_async(store.take, thread_sensitive=False)(buckets, cost)
+    return store.take(buckets, cost)
+
+
+def too_many_requests(wait):
+    if math.isinf(wait):
+        # 待っても通せないので、Retry-Afterは付けない
+        return HttpResponse(TOO_LARGE_MESSAGE, status=429, content_type="text/plain; charset=utf-8")
+    response = HttpResponse(TOO_MANY_REQUESTS_MESSAGE, status=429, content_type="text/plain; charset=utf-8")
+    # Retry-Afterは整数の秒数なので切り上げる
+    response["Retry-After"] = str(max(1, math.ceil(wait)))
+    return response
+
+
+@sync_and_async_middleware
+def ratelimit_middleware(get_response):
+    """
+    request.userを使うので、AuthenticationMiddlewareより後に置く。
+    制限しないリクエスト(GETや、RATE_LIMITSにないURL)ではURLの名前も調べずにそのまま通す。
+    """
+    if asyncio.iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            found = _limits(request)
+            if found is not None:
+                bucket, limits, cost = found
+                user = await aget_user(request)
+                wait = await acheck(bucket, limits, user, client_ip(request), cost)
+                if wait:
+                    return too_many_requests(wait)
+            return await get_response(request)
+
+    else:
+
+        def middleware(request):
+            found = _limits(request)
+            if found is not None:
+                bucket, limits, cost = found
+                wait = check(bucket, limits, request.user, client_ip(request), cost)
+                if wait:
+                    return too_many_requests(wait)
+            return get_response(request)
+
+    return middleware
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,14 +42,21 @@ INSTALLED_APPS = [
     "accounts.apps.AccountsConfig",
     "tweets.apps.TweetsConfig",
     "welcome.apps.WelcomeConfig",
+    "jobs.apps.JobsConfig",
 ]
 
 MIDDLEWARE = [
+    # ビューごとの処理時間とSQLを数える。他のミドルウェアの時間も含めるために先頭に置く
+    "mysite.metrics.metrics_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    # 読み取りをレプリカに振り分ける(mysite/db_router.py)。セッションを使うのでSessionMiddlewareより後に置く
+    "mysite.db_router.replica_middleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # 書き込みの多いURLへのPOSTの回数を制限する(mysite/ratelimit.py)。request.userを使うのでAuthenticationMiddlewareより後に置く
+    "mysite.ratelimit.ratelimit_middleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -89,6 +97,186 @@ DATABASES = {
     }
 }
 
+# 読み取り専用のレプリカ。環境変数DJANGO_REPLICA_DBにSQLiteのファイルを指定すると、
+# GETなどのリクエストの読み取りをそちらから行う(mysite/db_router.py)。
+# 手元で試すときは python manage.py copy_replica_database でdb.sqlite3をコピーして作る
+REPLICA_DATABASE = "replica" if os.environ.get("DJANGO_REPLICA_DB") else None
+if REPLICA_DATABASE:
+    DATABASES[REPLICA_DATABASE] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.environ["DJANGO_REPLICA_DB"],
+        # テストでは別のデータベースを作らず、defaultをそのまま使う
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["mysite.db_router.PrimaryReplicaRouter"]
+
+# 書き込んだユーザは、この秒数の間はすべての読み取りをプライマリ(default)から行う
+REPLICA_STICKY_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+# LocMemCacheは有効期限(TIMEOUT秒)を過ぎたものと、MAX_ENTRIESを超えた分を最も使われていないものから捨てる(LRU)
+# 複数プロセスで共有したい場合はBACKENDをRedisCacheなどに変える
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # プロフィールはシグナルで消しても、ほかのプロセスのLocMemCacheには伝わらないので、
+    # SHARED_CACHE_URLを設定していなければ数秒で切れるようにする
+    "profile": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "profile",
+        "TIMEOUT": 5,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    # ユーザ名の変更・削除もほかのプロセスには伝わらないので、プロセス内のLRUキャッシュ
+    # (USERNAME_LOCAL_CACHE_TIMEOUT)と同じ秒数で切れるようにする
+    "usernames": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "usernames",
+        "TIMEOUT": 10,
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+    "sessions": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "sessions",
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+    "users": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "users",
+        "TIMEOUT": 300,
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+    "fragments": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "fragments",
+        "TIMEOUT": 86400,
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+    "follow_index": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "follow_index",
+    },
+}
+
+# 全ワーカープロセスで共有するキャッシュ(RedisのURL。例: redis://127.0.0.1:6379/0)。
+# セッションとログイン中のユーザは、ログアウトやパスワードの変更をすぐに全プロセスに反映させる必要があるので、
+# これを設定したときだけキャッシュに置く。LocMemCacheに置くと、ほかのプロセスには消したことが伝わらず、
+# 有効期限が切れるまでログインしたままになってしまう。フォロー関係のインデックスの変更の受け渡しと、
+# プロフィールとユーザ名からidへの変換のキャッシュ(消したことが全プロセスに伝わるので有効期限を長くできる)にも使う
+SHARED_CACHE_URL = os.environ.get("DJANGO_SHARED_CACHE_URL")
+if SHARED_CACHE_URL:
+    shared_aliases = (("sessions", 300), ("users", 300), ("follow_index", None), ("profile", 300), ("usernames", 3600))
+    for alias, timeout in shared_aliases:
+        CACHES[alias] = {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": SHARED_CACHE_URL,
+            "KEY_PREFIX": alias,
+            "TIMEOUT": timeout,
+        }
+
+# SHARED_CACHE_URLを設定した場合、セッションはキャッシュから読み、書き込むときはキャッシュとDBの両方に書く(cached_db)。
+# キャッシュから消えてもDBから読み直せるので、再起動でログアウトされない。
+# 書き込むのはセッションの内容が変わったリクエストだけ(SESSION_SAVE_EVERY_REQUESTはFalseのまま)。
+# 設定していなければ、セッションは毎回DBから読む
+# SHARED_CACHE_URLを設定した場合は、ログイン中のユーザもリクエストごとにDBから取得せずに、
+# キャッシュから取得する(accounts/backends.py)
+if SHARED_CACHE_URL:
+    SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+    AUTHENTICATION_BACKENDS = ["accounts.backends.CachedModelBackend"]
+else:
+    SESSION_ENGINE = "django.contrib.sessions.backends.db"
+    AUTHENTICATION_BACKENDS = ["django.contrib.auth.backends.ModelBackend"]
+SESSION_CACHE_ALIAS = "sessions"
+USER_CACHE_ALIAS = "users"
+
+# Trueにすると、ホーム・ツイート詳細・プロフィール・フォローリストを非同期版のビューで動かす。
+# ASGI(mysite/asgi.py)で動かすときだけTrueにする。WSGIではかえって遅くなる
+ASYNC_VIEWS = os.environ.get("DJANGO_ASYNC_VIEWS") == "1"
+
+# プロフィール画面(accounts:user_profile)のキャッシュに使うCACHESのキー
+PROFILE_CACHE_ALIAS = "profile"
+
+# ツイート1件分の表示用のHTML(tweets/fragments.py)のキャッシュに使うCACHESのキー
+TWEET_FRAGMENT_CACHE_ALIAS = "fragments"
+
+# URLのユーザ名からユーザのidへの変換(accounts/username_cache.py)に使うCACHESのキー。
+# その手前にプロセス内のLRUキャッシュ(最大USERNAME_LOCAL_CACHE_SIZE件、USERNAME_LOCAL_CACHE_TIMEOUT秒)を置く。
+# 存在しないユーザ名はUSERNAME_NOT_FOUND_TIMEOUT秒だけキャッシュする。共有のキャッシュがなければ、
+# 登録したユーザのプロフィールがほかのプロセスで404のままにならないように、プロセス内のキャッシュと同じ秒数にする
+USERNAME_CACHE_ALIAS = "usernames"
+USERNAME_LOCAL_CACHE_SIZE = 10000
+USERNAME_LOCAL_CACHE_TIMEOUT = 10
+USERNAME_NOT_FOUND_TIMEOUT = 60 if SHARED_CACHE_URL else USERNAME_LOCAL_CACHE_TIMEOUT
+
+# Trueにすると、フォロー関係をプロセス内のメモリに持ち(accounts/follow_index.py)、
+# プロフィール画面のフォロー関係の表示をSQLなしで行う。フォロー1本あたり数十バイトのメモリを使う。
+# 他のプロセスでの変更はFOLLOW_INDEX_CACHE_ALIASのキャッシュのバージョン番号で、最大FOLLOW_INDEX_CHECK_INTERVAL秒遅れて取り込む。
+# 遅れることがあるので表示にだけ使い、フォロー・フォロー解除の書き込みではDBで確かめる。
+# SHARED_CACHE_URLを設定してそのキャッシュを共有しないと、ほかのプロセスの変更が伝わらないので、起動時にエラーにする
+FOLLOW_INDEX_ENABLED = os.environ.get("DJANGO_FOLLOW_INDEX") == "1"
+FOLLOW_INDEX_CACHE_ALIAS = "follow_index"
+FOLLOW_INDEX_CHECK_INTERVAL = 1.0
+
+# バックグラウンドのジョブ(jobs/queue.py)。runworkerコマンドで実行する。
+# ワーカーはJOB_WORKER_THREADS個のスレッドで実行し、1回に最大JOB_BATCH_SIZE件取り出して、
+# 実行できるジョブがなければJOB_POLL_INTERVAL秒待つ。取り出したジョブはJOB_LEASE_SECONDS秒の間に終わらなければ
+# ほかのワーカーが取り出し直す。失敗したらJOB_RETRY_BASE_DELAY秒から倍々に(最大JOB_RETRY_MAX_DELAY秒)待って実行し直し、
+# JOB_MAX_ATTEMPTS回失敗したらstatusをdeadにして残す
+JOB_WORKER_THREADS = 4
+JOB_BATCH_SIZE = 10
+JOB_POLL_INTERVAL = 1.0
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BASE_DELAY = 1.0
+JOB_RETRY_MAX_DELAY = 3600
+
+# いいね数の更新(tweets/favorites.pyのFavoriteCounter)
+# 1つのツイートへのいいねがFAVORITE_FLUSH_INTERVAL秒間にFAVORITE_HOT_THRESHOLD回を超えたら、
+# それ以降はメモリにためてFAVORITE_FLUSH_INTERVAL秒ごとにまとめて書き込む
+FAVORITE_HOT_THRESHOLD = 10
+FAVORITE_FLUSH_INTERVAL = 1.0
+
+# 新しいツイートのSSE(tweets/sse.py)。ASGI(mysite/asgi.py)で動かしたときだけ使える
+LIVE_TIMELINE_PATH = "/tweets/live/"
+# ワーカープロセスが複数ある場合は"tweets.live.UnixSocketBroker"にする
+LIVE_BROKER = "tweets.live.InProcessBroker"
+LIVE_BROKER_OPTIONS = {}
+# 1つの接続にためておくイベントの最大数。あふれたら古いものから捨てる
+LIVE_QUEUE_SIZE = 100
+# この秒数の間イベントがなければ、接続が切れていないか確かめるためのコメント行を送る
+LIVE_HEARTBEAT_INTERVAL = 15
+
+# /metrics(mysite/metrics.py)にアクセスできるIPアドレス。Prometheusのサーバから読めるようにする
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+# /metricsにはAuthorization: Bearer <このトークン>も必要(Prometheusのauthorizationに書く)。
+# 設定しなければ/metricsは誰にも見せない
+METRICS_TOKEN = os.environ.get("DJANGO_METRICS_TOKEN")
+
+# 書き込みの多いURLへのリクエストの回数の制限(mysite/ratelimit.py)。
+# RATE_LIMITSは{URLの名前: {"user"または"ip": (回数, 秒)}}で、ログインしているユーザごと・IPアドレスごとに
+# 「秒」の間に「回数」までにする。超えたら429を返す。
+# {"bucket": URLの名前}は、そのURLと同じバケット(制限)から使う。{"cost": 関数}は、1回のリクエストで
+# 使うトークンの数を関数(request -> int)で決める。一括フォローはフォローと同じバケットからユーザ名の数だけ使う。
+# テストではmysite.testing.TestCaseがテストごとにバケットを空にする
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_METHODS = ["POST"]
+RATE_LIMITS = {
+    "tweets:create": {"user": (10, 60), "ip": (30, 60)},
+    "accounts:follow": {"user": (30, 60), "ip": (60, 60)},
+    "accounts:bulk_follow": {"bucket": "accounts:follow", "cost": "accounts.forms.bulk_follow_cost"},
+    "accounts:signup": {"ip": (5, 3600)},
+}
+# バケットの状態を置く場所。ワーカープロセスが複数ある場合は"mysite.ratelimit.FileLockStore"にする
+RATE_LIMIT_STORE = "mysite.ratelimit.InProcessStore"
+RATE_LIMIT_STORE_OPTIONS = {}
+# リバースプロキシの後ろで動かす場合は、間にあるプロキシの数にする(X-Forwarded-ForからクライアントのIPアドレスを取る)
+RATE_LIMIT_PROXY_COUNT = 0
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
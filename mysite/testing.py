@@ -0,0 +1,45 @@
+import importlib
+
+from django import test
+from django.test import override_settings
+from django.urls import clear_url_caches
+
+from mysite import ratelimit
+
+# accountsとtweetsのテスト、ベンチマーク(tweets/benchmark.py)で共通して使う部品。
+
+
+class TestCase(test.TestCase):
+    # テストはどれも127.0.0.1から送るので、回数の制限(mysite/ratelimit.py)のバケットをテストごとに作り直し、
+    # ほかのテストのリクエストまで数えないようにする(django.core.mail.outboxをテストごとに空にするのと同じ)
+    def _pre_setup(self):
+        super()._pre_setup()
+        ratelimit.reset_store()
+
+
+def reload_urlconfs():
+    # urls.pyはsettings.ASYNC_VIEWSを読み込み時に見ているので、設定を変えたら読み込み直す
+    for module in ("accounts.urls", "tweets.urls", "mysite.urls"):
+        importlib.reload(importlib.import_module(module))
+    clear_url_caches()
+
+
+@override_settings(ASYNC_VIEWS=True)
+class AsyncViewsTestCase(TestCase):
+    # 非同期版のビューを使うURL設定でテストする
+    @classmethod
+    def setUpClass(cls):
+        # override_settingsはtearDownClass()の後のクリーンアップで元に戻されるので、
+        # それより後に実行されるように先に登録して、元の設定でURL設定を読み込み直す
+        cls.addClassCleanup(reload_urlconfs)
+        super().setUpClass()
+        reload_urlconfs()
+
+
+# settings.SHARED_CACHE_URLを設定したときの、セッションとログインユーザをキャッシュから取る設定。
+# テストは1つのプロセスで動くので、LocMemCacheでも全リクエストで同じキャッシュを共有できる。
+# ログインした後で認証バックエンドを変えるとログアウトした扱いになるので、クラスに付けてsetUp()から有効にする
+cached_sessions = override_settings(
+    SESSION_ENGINE="django.contrib.sessions.backends.cached_db",
+    AUTHENTICATION_BACKENDS=["accounts.backends.CachedModelBackend"],
+)
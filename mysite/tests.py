@@ -0,0 +1,419 @@
+import math
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.models import Session
+from django.db import router
+from django.http import HttpResponse
+from django.test import SimpleTestCase, override_settings
+from django.test.client import RequestFactory
+from django.urls import reverse
+
+from accounts.models import FriendShip
+from tweets.models import Tweet
+
+from . import db_router, metrics, ratelimit
+from .testing import TestCase
+
+CustomUser = get_user_model()
+
+
+@override_settings(METRICS_TOKEN="testtoken")
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.client.login(username="testuser1", password="testpassword1")
+        Tweet.objects.create(user=self.user1, content="testpost")
+        self.url = reverse("metrics")
+
+    def collect(self, view_name):
+        # 他のテストの分も集計に残っているので、テストの前後の差で確かめる
+        return metrics.registry.collect().get(view_name, metrics.ViewStats())
+
+    def test_success_count_requests_and_queries(self):
+        """
+        ホーム画面に2回アクセスする。
+        ・tweets:homeのリクエスト数が2増える
+        ・SQLの回数と時間が数えられ、処理時間がヒストグラムに入る
+        """
+        before = self.collect("tweets:home")
+        self.client.get(reverse("tweets:home"))
+        self.client.get(reverse("tweets:home"))
+        after = self.collect("tweets:home")
+
+        self.assertEqual(after.requests - before.requests, 2)
+        self.assertGreater(after.queries - before.queries, 0)
+        self.assertGreater(after.sql_seconds, before.sql_seconds)
+        self.assertEqual(sum(after.latency_buckets) - sum(before.latency_buckets), 2)
+
+    def test_success_count_unresolved(self):
+        """
+        存在しないURLにアクセスする。
+        ・URLの名前の代わりに<unresolved>として数えられる
+        """
+        before = self.collect(metrics.UNRESOLVED)
+        self.client.get("/no/such/page/")
+        self.assertEqual(self.collect(metrics.UNRESOLVED).requests - before.requests, 1)
+
+    def test_success_collect_from_finished_thread(self):
+        """
+        別のスレッドで記録してからスレッドを終了させる。
+        ・終了したスレッドの分も集計に含まれ、何度読んでも二重に数えられない
+        """
+        before = self.collect("test:thread")
+        thread = threading.Thread(target=metrics.registry.observe, args=("test:thread", 0.02, metrics.RequestStats()))
+        thread.start()
+        thread.join()
+        self.assertEqual(self.collect("test:thread").requests - before.requests, 1)
+        self.assertEqual(self.collect("test:thread").requests - before.requests, 1)
+
+    def test_success_get_metrics(self):
+        """
+        /metricsにアクセスする。
+        ・Prometheusのテキスト形式で、ビューごとのリクエスト数・ヒストグラム・SQLの回数と時間が返る
+        """
+        self.client.get(reverse("tweets:home"))
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer testtoken")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        body = response.content.decode()
+        self.assertIn("# TYPE django_view_latency_seconds histogram", body)
+        self.assertIn('django_view_requests_total{view="tweets:home"}', body)
+        self.assertIn('django_view_latency_seconds_bucket{view="tweets:home",le="+Inf"}', body)
+        self.assertIn('django_view_sql_queries_total{view="tweets:home"}', body)
+        self.assertIn('django_view_sql_seconds_total{view="tweets:home"}', body)
+
+    def test_failure_get_metrics_from_other_host(self):
+        """
+        METRICS_ALLOWED_IPSにないIPアドレスから/metricsにアクセスする。
+        ・403エラーになる
+        """
+        response = self.client.get(self.url, REMOTE_ADDR="192.0.2.1", HTTP_AUTHORIZATION="Bearer testtoken")
+        self.assertEqual(response.status_code, 403)
+
+    def test_failure_get_metrics_through_proxy(self):
+        """
+        同じマシンのリバースプロキシを通して、外部のIPアドレスから/metricsにアクセスする。
+        ・REMOTE_ADDRが127.0.0.1でも、トークンがなかったり違ったりすれば403エラーになる
+        ・METRICS_TOKENを設定していなければ、どんなトークンでも403エラーになる
+        """
+        forwarded = {"REMOTE_ADDR": "127.0.0.1", "HTTP_X_FORWARDED_FOR": "192.0.2.1"}
+        self.assertEqual(self.client.get(self.url, **forwarded).status_code, 403)
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer wrongtoken", **forwarded)
+        self.assertEqual(response.status_code, 403)
+        with override_settings(METRICS_TOKEN=None):
+            response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer testtoken", **forwarded)
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer ", **forwarded)
+            self.assertEqual(response.status_code, 403)
+
+
+@override_settings(REPLICA_DATABASE="replica", REPLICA_STICKY_SECONDS=10)
+class TestReplicaRouter(SimpleTestCase):
+    # SQLは実行せず、ミドルウェアの中でrouterがどのデータベースを選ぶかだけを確かめる
+    def request(self, method="get", session=None, write=False):
+        request = getattr(RequestFactory(), method)("/")
+        request.session = {} if session is None else session
+        chosen = {}
+
+        def view(request):
+            chosen["before_write"] = router.db_for_read(Tweet)
+            if write:
+                chosen["write"] = router.db_for_write(Tweet)
+                chosen["after_write"] = router.db_for_read(Tweet)
+            chosen["session"] = router.db_for_read(Session)
+            return HttpResponse()
+
+        db_router.replica_middleware(view)(request)
+        return chosen, request.session
+
+    def test_success_read_from_replica(self):
+        """
+        GETのリクエストで読み取る。
+        ・レプリカから読む
+        ・セッションはプライマリから読む
+        ・セッションに印は付かない
+        """
+        chosen, session = self.request()
+        self.assertEqual(chosen["before_write"], "replica")
+        self.assertEqual(chosen["session"], "default")
+        self.assertNotIn(db_router.PRIMARY_UNTIL_SESSION_KEY, session)
+
+    def test_success_post_reads_from_primary(self):
+        """
+        POSTのリクエストで読み取る。
+        ・プライマリから読む
+        """
+        chosen, _ = self.request(method="post")
+        self.assertEqual(chosen["before_write"], "default")
+
+    def test_success_stick_to_primary_after_write(self):
+        """
+        リクエストの途中で書き込む。
+        ・書き込みはプライマリに行う
+        ・書き込んだ後の読み取りはプライマリから行う
+        ・REPLICA_STICKY_SECONDS秒後までプライマリから読む印がセッションに付く
+        """
+        chosen, session = self.request(write=True)
+        self.assertEqual(chosen["write"], "default")
+        self.assertEqual(chosen["after_write"], "default")
+        self.assertAlmostEqual(session[db_router.PRIMARY_UNTIL_SESSION_KEY], time.time() + 10, delta=1)
+
+    def test_success_pinned_session(self):
+        """
+        書き込んだ後の期限内・期限切れのセッションでGETのリクエストを送る。
+        ・期限内はプライマリから読む
+        ・期限が過ぎたらレプリカから読む
+        """
+        pinned = {db_router.PRIMARY_UNTIL_SESSION_KEY: time.time() + 5}
+        self.assertEqual(self.request(session=pinned)[0]["before_write"], "default")
+        expired = {db_router.PRIMARY_UNTIL_SESSION_KEY: time.time() - 1}
+        self.assertEqual(self.request(session=expired)[0]["before_write"], "replica")
+
+    def test_success_async_view(self):
+        """
+        非同期のビューでsync_to_asyncを通して読み取る。
+        ・レプリカから読む
+        """
+
+        async def view(request):
+            return HttpResponse(await sync_to_async(router.db_for_read)(Tweet))
+
+        request = RequestFactory().get("/")
+        request.session = {}
+        response = async_to_sync(db_router.replica_middleware(view))(request)
+        self.assertEqual(response.content, b"replica")
+
+    def test_success_outside_request(self):
+        """
+        リクエストの外(管理コマンドなど)で読み取る。
+        ・プライマリから読む
+        """
+        self.assertEqual(router.db_for_read(Tweet), "default")
+
+    @override_settings(REPLICA_DATABASE=None)
+    def test_success_without_replica(self):
+        """
+        レプリカがない設定で書き込む。
+        ・プライマリから読む
+        ・セッションに印は付かない
+        """
+        chosen, session = self.request(write=True)
+        self.assertEqual(chosen["before_write"], "default")
+        self.assertNotIn(db_router.PRIMARY_UNTIL_SESSION_KEY, session)
+
+
+@override_settings(
+    RATE_LIMITS={
+        "tweets:create": {"user": (2, 60), "ip": (3, 60)},
+        "accounts:signup": {"ip": (1, 60)},
+        "accounts:follow": {"user": (3, 60), "ip": (10, 60)},
+        "accounts:bulk_follow": {"bucket": "accounts:follow", "cost": "accounts.forms.bulk_follow_cost"},
+    },
+)
+class TestRateLimit(TestCase):
+    def setUp(self):
+        CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.url = reverse("tweets:create")
+
+    def test_failure_user_limit(self):
+        """
+        同じユーザで3回ツイートする。
+        ・2回目までは投稿でき、3回目は429になる
+        ・Retry-Afterにトークンが1個補充されるまでの秒数(60秒に2個なので30秒)が入る
+        ・GETのリクエストは制限されない
+        """
+        for _ in range(2):
+            self.assertEqual(self.client.post(self.url, {"content": "testtweet"}).status_code, 302)
+        response = self.client.post(self.url, {"content": "testtweet"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "30")
+        self.assertEqual(Tweet.objects.count(), 2)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_failure_ip_limit(self):
+        """
+        同じIPアドレスから2人のユーザで合わせて4回ツイートする。
+        ・4回目はIPアドレスの制限で429になる
+        ・別のIPアドレスからは投稿できる
+        """
+        for _ in range(2):
+            self.client.post(self.url, {"content": "testtweet"})
+        self.client.login(username="testuser2", password="testpassword2")
+        self.assertEqual(self.client.post(self.url, {"content": "testtweet"}).status_code, 302)
+        self.assertEqual(self.client.post(self.url, {"content": "testtweet"}).status_code, 429)
+        response = self.client.post(self.url, {"content": "testtweet"}, REMOTE_ADDR="192.0.2.1")
+        self.assertEqual(response.status_code, 302)
+
+    def test_failure_signup_limit(self):
+        """
+        ログインせずに同じIPアドレスから2回サインアップする。
+        ・2回目は429になり、ユーザは作られない
+        """
+        self.client.logout()
+        url = reverse("accounts:signup")
+        data = {"email": "test@example.com", "password1": "testpassword", "password2": "testpassword"}
+        self.client.post(url, {"username": "newuser1", **data})
+        response = self.client.post(url, {"username": "newuser2", **data})
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(CustomUser.objects.filter(username="newuser2").exists())
+
+    def test_failure_bulk_follow_shares_follow_limit(self):
+        """
+        フォローを2回した後で、一括フォローを送る。
+        ・一括フォローはフォローと同じバケットからユーザ名の数だけトークンを使い、残りが足りなければ429になる
+        ・残りのトークンで足りる数なら通る
+        ・capacityより多いユーザ名はいくら待っても通らないので、Retry-Afterを付けずに429を返す
+        """
+        for i in range(3, 6):
+            CustomUser.objects.create_user(username=f"testuser{i}", password=f"testpassword{i}")
+        for username in ("testuser2", "testuser3"):
+            url = reverse("accounts:follow", kwargs={"username": username})
+            self.assertEqual(self.client.post(url).status_code, 302)
+        url = reverse("accounts:bulk_follow")
+        response = self.client.post(url, {"action": "follow", "usernames": "testuser4 testuser5"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "20")
+        self.assertFalse(FriendShip.objects.filter(following__username__in=["testuser4", "testuser5"]).exists())
+        response = self.client.post(url, {"action": "follow", "usernames": "testuser4"})
+        self.assertEqual(response.status_code, 200)
+        self.client.login(username="testuser2", password="testpassword2")
+        response = self.client.post(url, {"action": "follow", "usernames": "testuser3 testuser4 testuser5 testuser1"})
+        self.assertEqual(response.status_code, 429)
+        self.assertNotIn("Retry-After", response)
+
+    @override_settings(RATE_LIMIT_PROXY_COUNT=1)
+    def test_success_client_ip_behind_proxy(self):
+        """
+        プロキシの後ろで、X-Forwarded-Forを付けて送る。
+        ・最後のプロキシが付けたIPアドレスで数え、クライアントが自分で書いた値は使わない
+        """
+        request = RequestFactory().post("/", HTTP_X_FORWARDED_FOR="10.0.0.1, 192.0.2.1", REMOTE_ADDR="127.0.0.1")
+        self.assertEqual(ratelimit.client_ip(request), "192.0.2.1")
+        request = RequestFactory().post("/", REMOTE_ADDR="127.0.0.1")
+        self.assertEqual(ratelimit.client_ip(request), "127.0.0.1")
+
+    def test_failure_async_middleware(self):
+        """
+        非同期のビューの前でサインアップのPOSTを2回送る。
+        ・2回目は429になり、ビューは呼ばれない
+        """
+        calls = []
+
+        async def view(request):
+            calls.append(request)
+            return HttpResponse()
+
+        middleware = ratelimit.ratelimit_middleware(view)
+        responses = []
+        for _ in range(2):
+            request = RequestFactory().post(reverse("accounts:signup"))
+            request.user = AnonymousUser()
+            responses.append(async_to_sync(middleware)(request))
+        self.assertEqual([response.status_code for response in responses], [200, 429])
+        self.assertEqual(len(calls), 1)
+
+    def test_success_async_middleware_blocking_store(self):
+        """
+        FileLockStoreを使う設定で、非同期のビューの前でサインアップのPOSTを送る。
+        ・設定を変えるとストアが作り直される
+        ・flockで待つtake()はイベントループとは別のスレッドで呼ばれる
+        """
+        threads = []
+        take = ratelimit.FileLockStore.take
+
+        def record_thread(store, buckets, cost=1):
+            threads.append(threading.get_ident())
+            return take(store, buckets, cost)
+
+        async def view(request):
+            threads.append(threading.get_ident())
+            return HttpResponse()
+
+        middleware = ratelimit.ratelimit_middleware(view)
+        request = RequestFactory().post(reverse("accounts:signup"))
+        request.user = AnonymousUser()
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            RATE_LIMIT_STORE="mysite.ratelimit.FileLockStore",
+            RATE_LIMIT_STORE_OPTIONS={"path": f"{directory}/ratelimit"},
+        ), mock.patch.object(ratelimit.FileLockStore, "take", autospec=True, side_effect=record_thread):
+            self.assertIsInstance(ratelimit.get_store(), ratelimit.FileLockStore)
+            self.assertEqual(async_to_sync(middleware)(request).status_code, 200)
+        self.assertEqual(len(threads), 2)
+        self.assertNotEqual(threads[0], threads[1])
+        self.assertIsInstance(ratelimit.get_store(), ratelimit.InProcessStore)
+
+
+class TestRateLimitStores(SimpleTestCase):
+    def test_success_take_tokens(self):
+        """
+        トークンバケットの計算をする。
+        ・補充された分を足して1個使い、capacityより多くはたまらない
+        ・1つでも足りないバケットがあればどれからも使わず、全部に1個たまるまでの秒数を返す
+        """
+        self.assertEqual(ratelimit.take_tokens([(0, 0)], 100, [(3, 0.5)]), ([2], 0.0))
+        self.assertEqual(ratelimit.take_tokens([(2, 10), (0.5, 10)], 10.5, [(3, 0.5), (3, 0.5)]), ([2.25, 0.75], 0.5))
+        self.assertEqual(ratelimit.take_tokens([(3, 0)], 0, [(3, 0.5)], cost=2), ([1], 0.0))
+        self.assertEqual(ratelimit.take_tokens([(1, 0)], 0, [(3, 0.5)], cost=2), ([1], 2.0))
+        self.assertEqual(ratelimit.take_tokens([(3, 0)], 0, [(3, 0.5)], cost=4), ([3], math.inf))
+
+    def test_success_in_process_store_prune(self):
+        """
+        max_entriesを超えてバケットを作る。
+        ・満タンまで補充されたバケットから消される
+        """
+        store = ratelimit.InProcessStore(max_entries=2)
+        self.assertEqual(store.take([("a", 1, 1000)]), 0)
+        self.assertEqual(store.take([("b", 1, 0.001)]), 0)
+        time.sleep(0.01)
+        store.take([("c", 1, 1)])
+        self.assertEqual(sorted(store._buckets), ["b", "c"])
+        self.assertGreater(store.take([("b", 1, 0.001)]), 0)
+
+    def test_success_file_lock_store_shared(self):
+        """
+        同じファイルを使う2つのFileLockStore(別々のプロセスの代わり)から同じキーのトークンを使う。
+        ・片方で使ったトークンはもう片方からも減って見える
+        ・1つでも足りないバケットがあれば、ほかのバケットからも使わない
+        ・枠が足りないときは一番長く使われていない枠が使い回される
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = f"{directory}/ratelimit"
+            first = ratelimit.FileLockStore(path=path, slots=ratelimit.FileLockStore.PROBE)
+            second = ratelimit.FileLockStore(path=path, slots=ratelimit.FileLockStore.PROBE)
+            self.assertEqual(first.take([("user:1", 2, 0.001)]), 0)
+            self.assertEqual(second.take([("user:1", 2, 0.001)]), 0)
+            self.assertGreater(first.take([("ip:1", 2, 0.001), ("user:1", 2, 0.001)]), 0)
+            self.assertEqual(second.take([("ip:1", 2, 0.001)]), 0)
+            self.assertEqual(second.take([("ip:1", 2, 0.001)]), 0)
+
+            # 残りの枠を埋めてから、もう1つ別のキーを使う
+            for i in range(ratelimit.FileLockStore.PROBE):
+                second.take([(f"user:{i + 2}", 2, 0.001)])
+            self.assertEqual(first.take([("user:1", 2, 0.001)]), 0)
+
+    def test_success_file_lock_store_reopen(self):
+        """
+        fork()した子プロセスの代わりに、プロセスidが変わったことにしてトークンを使う。
+        ・ファイルが開き直され、親プロセスから受け継いだファイルとmmapは閉じられる
+        ・開き直してもバケットの状態は引き継がれる
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            store = ratelimit.FileLockStore(path=f"{directory}/ratelimit", slots=ratelimit.FileLockStore.PROBE)
+            self.assertEqual(store.take([("user:1", 1, 0.001)]), 0)
+            old_fd, old_map = store._fd, store._map
+            store._pid = None
+            with mock.patch.object(ratelimit.os, "close", wraps=os.close) as close:
+                self.assertGreater(store.take([("user:1", 1, 0.001)]), 0)
+            self.assertTrue(old_map.closed)
+            close.assert_called_once_with(old_fd)
+            store._map.close()
+            os.close(store._fd)
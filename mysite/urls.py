@@ -16,9 +16,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from . import metrics
+
 # pathの第一引数は((ホームURL)/(第一引数)にアクセスされた時の動作．includeは各app(accountsやtweets)のurls.pyにつないでいる)
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics.metrics_view, name="metrics"),
     path("accounts/", include("accounts.urls")),
     path("tweets/", include("tweets.urls")),
     path("", include("welcome.urls")),
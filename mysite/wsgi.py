@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
 
 application = get_wsgi_application()
+
+# Djangoの準備(get_wsgi_application)が終わってから読み込む
+from accounts import follow_index  # noqa: E402
+
+# フォロー関係のインデックスを使う設定なら、最初のリクエストの前に読み込んでおく
+follow_index.warm()
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import Tweet
+from .models import Favorite, Tweet
 
 # Register your models here.
 admin.site.register(Tweet)
+admin.site.register(Favorite)
@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+import random
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test import override_settings
+
+from accounts.models import FriendShip
+
+from . import timeline
+from .models import Tweet
+
+CustomUser = get_user_model()
+
+# ベンチマーク用の管理コマンド(benchmark_views, benchmark_async_views)で共通して使う部品。
+
+# ベンチマークのリクエストで使うホスト名。DEBUG=FalseでもALLOWED_HOSTSに入れて通す
+HOST = "localhost"
+
+
+@contextmanager
+def benchmark_database():
+    """
+    テスト用の一時的なデータベースを作ってその中で実行する。開発用のdb.sqlite3には触れない。
+    本番と同じくDEBUG=Falseにして、connection.queriesにSQLがたまらないようにする。
+    同じユーザで何度も投稿するので、回数の制限(mysite/ratelimit.py)は切っておく。
+    """
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with override_settings(DEBUG=False, ALLOWED_HOSTS=[HOST], RATE_LIMIT_ENABLED=False):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def seed_world(users, tweets_per_user, follows_per_user, seed=0):
+    """
+    users人のユーザと、1人あたりtweets_per_user件のツイート・follows_per_user人へのフォローを作る。
+    フォロー先はseedから決まる乱数で選ぶので、同じ引数なら毎回同じデータになる。
+    作ったユーザのリストを返す。users[0]の受信箱(TimelineEntry)も作っておく。
+    """
+    rng = random.Random(seed)
+    # パスワードのハッシュ化は遅いので1回だけ計算して全員で使い回す
+    password = make_password("benchmarkpassword")
+    follows_per_user = min(follows_per_user, users - 1)
+    edges = []
+    for follower in range(users):
+        followings = rng.sample(range(users - 1), follows_per_user)
+        # 自分自身を除いた番号に直す
+        edges.extend((follower, following + (following >= follower)) for following in followings)
+
+    following_counts = [0] * users
+    follower_counts = [0] * users
+    for follower, following in edges:
+        following_counts[follower] += 1
+        follower_counts[following] += 1
+
+    user_list = CustomUser.objects.bulk_create(
+        [
+            CustomUser(
+                username=f"benchuser{i}",
+                password=password,
+                following_count=following_counts[i],
+                follower_count=follower_counts[i],
+            )
+            for i in range(users)
+        ],
+        batch_size=1000,
+    )
+    Tweet.objects.bulk_create(
+        [
+            Tweet(user=user, content=f"benchmark tweet {i} by {user.username}")
+            for user in user_list
+            for i in range(tweets_per_user)
+        ],
+        batch_size=1000,
+    )
+    FriendShip.objects.bulk_create(
+        [FriendShip(follower=user_list[follower], following=user_list[following]) for follower, following in edges],
+        batch_size=1000,
+    )
+    timeline.rebuild(user_list[0].pk)
+    return user_list
@@ -0,0 +1,134 @@
+import atexit
+from collections import defaultdict
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+
+from .models import Favorite, Tweet
+
+# いいねの追加・取り消しと、Tweet.favorite_count(集計済みのいいね数)の更新をまとめたモジュール。
+
+
+class FavoriteCounter:
+    """
+    Tweet.favorite_countの増減を行う。
+
+    ふつうはいいねのたびにF()式のUPDATEをすぐ発行する。
+    ただし1つのツイートにflush_interval秒間でhot_threshold回を超えるいいねが来た場合(バズっているツイート)は、
+    それ以降の増減をメモリにためておき、flush_interval秒後にまとめて1回のUPDATEで反映する。
+    こうすることで、同じ行のロック待ちにいいねが一列に並ぶのを防ぐ。
+
+    ためている間の増減はこのプロセスのメモリにしかないので、表示されるいいね数は最大flush_interval秒遅れる。
+    プロセスが落ちてためていた分が失われた場合はreconcile_favorite_countsコマンドで直す。
+    """
+
+    def __init__(self, hot_threshold=None, flush_interval=None):
+        self.hot_threshold = settings.FAVORITE_HOT_THRESHOLD if hot_threshold is None else hot_threshold
+        self.flush_interval = settings.FAVORITE_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._lock = threading.Lock()
+        # ツイートid -> ためている増減
+        self._pending = defaultdict(int)
+        # ツイートid -> (数え始めた時刻, その時刻からのいいね回数)
+        self._recent = {}
+        self._timer = None
+
+    def add(self, tweet_id, delta):
+        now = time.monotonic()
+        with self._lock:
+            started_at, hits = self._recent.get(tweet_id, (now, 0))
+            if now - started_at >= self.flush_interval:
+                started_at, hits = now, 0
+            self._recent[tweet_id] = (started_at, hits + 1)
+
+            buffered = hits + 1 > self.hot_threshold
+            if buffered:
+                self._pending[tweet_id] += delta
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_interval, self._flush_in_background)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if not buffered:
+            self._apply({tweet_id: delta})
+
+    def flush(self):
+        # ためている増減をすべてDBに反映する
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            # 数え始めてからflush_interval秒たったものは忘れる
+            now = time.monotonic()
+            self._recent = {
+                tweet_id: recent for tweet_id, recent in self._recent.items() if now - recent[0] < self.flush_interval
+            }
+        self._apply({tweet_id: delta for tweet_id, delta in pending.items() if delta})
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            # タイマーのスレッドで開いたDB接続を閉じる
+            connections.close_all()
+
+    def _apply(self, deltas):
+        if not deltas:
+            return
+        # 複数ツイートの増減をCASE式で1回のUPDATEにまとめる。
+        # 他のプロセスでためている分との前後関係でマイナスにならないようにGreatestで0以上にする
+        delta = Case(
+            *[When(pk=tweet_id, then=Value(delta)) for tweet_id, delta in deltas.items()],
+            output_field=IntegerField(),
+        )
+        Tweet.objects.filter(pk__in=deltas).update(favorite_count=Greatest(F("favorite_count") + delta, 0))
+
+
+favorite_counter = FavoriteCounter()
+# プロセス終了時にためている分を書き込む
+atexit.register(favorite_counter.flush)
+
+
+def like(user, tweet):
+    # いいねを追加する。既にいいねしていればFalseを返す
+    try:
+        with transaction.atomic():
+            Favorite.objects.create(user=user, tweet=tweet)
+    except IntegrityError:
+        return False
+    favorite_counter.add(tweet.pk, 1)
+    return True
+
+
+def unlike(user, tweet):
+    # いいねを取り消す。いいねしていなければFalseを返す
+    deleted, _ = Favorite.objects.filter(user=user, tweet=tweet).delete()
+    if deleted:
+        favorite_counter.add(tweet.pk, -1)
+    return bool(deleted)
+
+
+def _liked_tweet_ids(user, tweets):
+    return Favorite.objects.filter(user=user, tweet__in=[tweet.pk for tweet in tweets]).values_list(
+        "tweet_id", flat=True
+    )
+
+
+def mark_liked_by(user, tweets):
+    # ページ内のツイートについて、userがいいねしているかを1回のクエリで調べてtweet.liked_by_meに入れる
+    liked_ids = set(_liked_tweet_ids(user, tweets))
+    for tweet in tweets:
+        tweet.liked_by_me = tweet.pk in liked_ids
+    return tweets
+
+
+async def amark_liked_by(user, tweets):
+    # mark_liked_by()の非同期版
+    liked_ids = {tweet_id async for tweet_id in _liked_tweet_ids(user, tweets)}
+    for tweet in tweets:
+        tweet.liked_by_me = tweet.pk in liked_ids
+    return tweets
@@ -0,0 +1,59 @@
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+
+from accounts.models import FriendShip
+
+from .models import TimelineEntry, Tweet
+
+# ホーム画面(HTML)とJSONのAPIで共通して使うフィードの定義。
+# all: 全ユーザのツイート
+# timeline: 自分の受信箱(TimelineEntry)のツイート
+# following: フォロー中のユーザと自分のツイートをその場でFriendShipから絞り込んだもの
+FEEDS = ("all", "timeline", "following")
+
+
+def validate_feed(feed):
+    if feed not in FEEDS:
+        raise BadRequest("Invalid feed.")
+    return feed
+
+
+def feed_queryset(feed, user):
+    if feed == "timeline":
+        return TimelineEntry.objects.select_related("tweet__user").filter(owner=user)
+    queryset = Tweet.objects.select_related("user")
+    if feed == "following":
+        # フォロー中のユーザはunique_friendship制約の(follower, following)インデックスから、
+        # ツイートはユーザごとにtweet_user_created_at_idxから取り出すので全件走査にはならない
+        following = FriendShip.objects.filter(follower=user).values("following")
+        return queryset.filter(Q(user__in=following) | Q(user=user))
+    return queryset
+
+
+def keyset_fields(feed):
+    # カーソルページングに使う(日時, id)のフィールド名
+    if feed == "timeline":
+        return ("created_at", "tweet_id")
+    return ("created_at", "id")
+
+
+def feed_projection(feed):
+    # JSONで返すときに取り出すフィールド。(JSONのキー, values_list()に渡すフィールド名)の組
+    if feed == "timeline":
+        return [
+            ("id", "tweet_id"),
+            ("username", "tweet__user__username"),
+            ("content", "tweet__content"),
+            ("favorite_count", "tweet__favorite_count"),
+            ("created_at", "created_at"),
+        ]
+    return TWEET_PROJECTION
+
+
+TWEET_PROJECTION = [
+    ("id", "id"),
+    ("username", "user__username"),
+    ("content", "content"),
+    ("favorite_count", "favorite_count"),
+    ("created_at", "created_at"),
+]
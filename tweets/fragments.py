@@ -0,0 +1,84 @@
+from functools import lru_cache
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+from .models import Tweet
+
+# ツイート1件分のHTML(templates/tweets/tweet_fragment.html)を描画した結果をキャッシュする。
+# ツイートは投稿後に編集できないので、変わるのは削除されたときと投稿者のユーザ名が変わったときだけ。
+# キャッシュの保存先・有効期限はsettings.CACHESのTWEET_FRAGMENT_CACHE_ALIASで設定する。
+# 消すタイミングはaccounts/signals.pyでTweetの削除とCustomUserのユーザ名の変更を受け取って決めている。
+#
+# 1ページ分はget_many()でまとめて取り出し、なかったものだけ描画してset_many()でまとめて保存する。
+
+FRAGMENT_TEMPLATE = "tweets/tweet_fragment.html"
+
+
+@lru_cache(maxsize=None)
+def template_version():
+    # テンプレートの内容から作るので、テンプレートを変えてデプロイすると古い断片は使われなくなる
+    source = get_template(FRAGMENT_TEMPLATE).template.source
+    return hashlib.sha1(source.encode()).hexdigest()[:8]
+
+
+def _cache():
+    return caches[settings.TWEET_FRAGMENT_CACHE_ALIAS]
+
+
+def _key(tweet_id):
+    return f"tweet_html:{template_version()}:{tweet_id}"
+
+
+def _attach(tweets, cached):
+    # キャッシュにあったものを付け、なかったものは描画して{キー: HTML}で返す
+    template = get_template(FRAGMENT_TEMPLATE)
+    rendered = {}
+    for tweet in tweets:
+        key = _key(tweet.pk)
+        html = cached.get(key)
+        if html is None:
+            html = rendered[key] = str(template.render({"tweet": tweet}))
+        tweet.html = mark_safe(html)
+    return rendered
+
+
+def attach_html(tweets):
+    """
+    tweetsの各ツイートにhtml(表示用のHTML)を付けて、リストで返す。
+    キャッシュにないツイートはtweet.userを使って描画するので、select_relatedなどで読み込んでおく。
+    """
+    tweets = list(tweets)
+    cached = _cache().get_many([_key(tweet.pk) for tweet in tweets])
+    rendered = _attach(tweets, cached)
+    if rendered:
+        _cache().set_many(rendered)
+    return tweets
+
+
+async def aattach_html(tweets):
+    # attach_html()の非同期版
+    tweets = list(tweets)
+    cached = await _cache().aget_many([_key(tweet.pk) for tweet in tweets])
+    rendered = _attach(tweets, cached)
+    if rendered:
+        await _cache().aset_many(rendered)
+    return tweets
+
+
+def invalidate(*tweet_ids):
+    """
+    profile_cache.invalidate()と同じく、すぐに消したうえでトランザクションのコミット後にもう一度消す。
+    """
+    keys = [_key(tweet_id) for tweet_id in tweet_ids]
+    _cache().delete_many(keys)
+    transaction.on_commit(lambda: _cache().delete_many(keys))
+
+
+def invalidate_user(user_id):
+    # ユーザ名が変わったときに、そのユーザのすべてのツイートの断片を消す
+    invalidate(*Tweet.objects.filter(user_id=user_id).values_list("pk", flat=True))
@@ -0,0 +1,213 @@
+import asyncio
+from collections import defaultdict
+import json
+import os
+import socket
+import tempfile
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+# 新しいツイートを、接続中のフォロワーにサーバ送信イベント(tweets/sse.py)で届けるためのモジュール。
+#
+# TweetCreateViewがコミットしたツイートをpublish_tweet()でブローカーに渡し、
+# ブローカーが各プロセスのHubに配り、Hubがそのツイートの投稿者をフォローしている接続のキューに入れる。
+# 1プロセスの中だけで配るならInProcessBroker、同じマシンの複数のワーカープロセスに配るならUnixSocketBrokerを
+# settings.LIVE_BROKERで選ぶ。Redisなどを使う場合はBaseBrokerを継承したクラスを作る。
+
+
+class Subscription:
+    """
+    1つの接続(ブラウザのEventSource)が受け取るイベントのキュー。
+    キューはqueue_size件までで、あふれたら古いものから捨てて、捨てた数をdroppedに数える。
+    読むのが遅い接続のためにメモリが増え続けたり、配る側が待たされたりしないようにするため。
+    """
+
+    def __init__(self, author_ids, queue_size, loop):
+        self.author_ids = frozenset(author_ids)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.loop = loop
+        self.dropped = 0
+
+    def put(self, event):
+        # イベントループのスレッドから呼ぶ
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    def put_threadsafe(self, event):
+        # ほかのスレッドから呼ぶ
+        self.loop.call_soon_threadsafe(self.put, event)
+
+    def take_dropped(self):
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class Hub:
+    """
+    プロセス内の接続を、フォローしている投稿者のidごとにまとめて持つ。
+    接続ごとにスレッドは使わず、接続は非同期のコルーチンとキューだけなので、
+    何もしていない接続が数千あってもメモリしか使わない。
+    """
+
+    def __init__(self, queue_size=None):
+        self.queue_size = settings.LIVE_QUEUE_SIZE if queue_size is None else queue_size
+        self._lock = threading.Lock()
+        # 投稿者のid -> その投稿者のツイートを受け取る接続
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, author_ids):
+        # 実行中のイベントループから呼ぶ。フォロー関係は接続した時点のものを使う
+        subscription = Subscription(author_ids, self.queue_size, asyncio.get_running_loop())
+        with self._lock:
+            for author_id in subscription.author_ids:
+                self._subscriptions[author_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for author_id in subscription.author_ids:
+                subscriptions = self._subscriptions.get(author_id)
+                if subscriptions is None:
+                    continue
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[author_id]
+
+    def connection_count(self):
+        with self._lock:
+            return len(set().union(*self._subscriptions.values()))
+
+    def dispatch(self, event):
+        # ブローカーから呼ばれる。どのスレッドから呼ばれてもよい
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(event["author_id"], ()))
+        for subscription in subscriptions:
+            subscription.put_threadsafe(event)
+
+
+class BaseBroker:
+    """
+    イベントをすべてのプロセスのHubに届ける仕組み。
+    publish()はツイートを投稿したプロセスから、start()はSSEの接続を受けるプロセスで1回だけ呼ばれる。
+    """
+
+    def start(self, dispatch):
+        # 受け取ったイベントをdispatch(event)に渡し始める
+        raise NotImplementedError
+
+    def publish(self, event):
+        raise NotImplementedError
+
+
+class InProcessBroker(BaseBroker):
+    # 同じプロセスの中だけで配る。開発用のサーバやワーカーが1つの場合に使う
+
+    def __init__(self):
+        self._dispatch = None
+
+    def start(self, dispatch):
+        self._dispatch = dispatch
+
+    def publish(self, event):
+        if self._dispatch is not None:
+            self._dispatch(event)
+
+
+class UnixSocketBroker(BaseBroker):
+    """
+    同じマシンのワーカープロセスどうしで、directoryに置いたUnixドメインソケットを使って配る。
+    start()したプロセスはdirectoryに自分用のソケットを作り、受信用のスレッドを1つ立てる。
+    publish()はdirectoryにあるすべてのソケットにイベントを送る。Redisなどを用意するまでの代わり。
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "mysite-live")
+        os.makedirs(self.directory, exist_ok=True)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._receiver = None
+        self.path = None
+
+    def start(self, dispatch):
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex}.sock")
+        self._receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._receiver.bind(self.path)
+        thread = threading.Thread(target=self._receive, args=(self._receiver, dispatch), daemon=True)
+        thread.start()
+
+    def stop(self):
+        if self._receiver is not None:
+            # shutdown()で受信待ちのスレッドを起こしてから閉じる
+            self._receiver.shutdown(socket.SHUT_RDWR)
+            self._receiver.close()
+            self._receiver = None
+            os.unlink(self.path)
+
+    def _receive(self, receiver, dispatch):
+        while True:
+            try:
+                data = receiver.recv(65536)
+            except OSError:
+                return
+            if not data:
+                # stop()でソケットが閉じられた
+                return
+            dispatch(json.loads(data))
+
+    def publish(self, event):
+        data = json.dumps(event, cls=DjangoJSONEncoder).encode()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 終了したプロセスのソケットが残っていたら消す
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+
+_hub = None
+_broker = None
+_setup_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _setup_lock:
+        if _broker is None:
+            _broker = import_string(settings.LIVE_BROKER)(**settings.LIVE_BROKER_OPTIONS)
+        return _broker
+
+
+def get_hub():
+    # SSEの接続を受けるプロセスで最初に呼ばれたときに、Hubを作ってブローカーからの受信を始める
+    global _hub
+    broker = get_broker()
+    with _setup_lock:
+        if _hub is None:
+            _hub = Hub()
+            broker.start(_hub.dispatch)
+        return _hub
+
+
+def tweet_event(tweet):
+    # 接続先に送るツイートの要約。ツイートは140文字までなので本文はそのまま送る
+    return {
+        "id": tweet.pk,
+        "author_id": tweet.user_id,
+        "username": tweet.user.username,
+        "content": tweet.content,
+        "created_at": tweet.created_at,
+    }
+
+
+def publish_tweet(tweet):
+    # コミット後に呼ぶ(transaction.on_commit)。ロールバックされたツイートを配らないようにするため
+    get_broker().publish(tweet_event(tweet))
@@ -0,0 +1,132 @@
+import asyncio
+import statistics
+import time
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from mysite.testing import reload_urlconfs
+from tweets import benchmark
+from tweets.models import Tweet
+
+# 同期版と非同期版のビューを、同じASGIアプリケーションに同時接続数concurrencyでリクエストを送って比べる。
+# データは一時的なテスト用データベースに作るので、開発用のdb.sqlite3には触れない。
+
+
+async def asgi_get(application, path, cookie):
+    # ASGIサーバの代わりにscopeを組み立ててアプリケーションを直接呼び出し、ステータスコードを返す
+    path, _, query_string = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query_string.encode(),
+        "root_path": "",
+        "headers": [(b"host", benchmark.HOST.encode()), (b"cookie", cookie.encode())],
+        "client": ("127.0.0.1", 0),
+        "server": (benchmark.HOST, 80),
+    }
+    disconnected = asyncio.Event()
+    request_sent = False
+    status = None
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await application(scope, receive, send)
+    disconnected.set()
+    return status
+
+
+async def run_load(application, path, cookie, requests, concurrency):
+    # concurrency個のクライアントが、合計requests回のリクエストを送り終わるまで順に送り続ける
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client():
+        for _ in remaining:
+            started_at = time.perf_counter()
+            status = await asgi_get(application, path, cookie)
+            latencies.append(time.perf_counter() - started_at)
+            if status != 200:
+                raise RuntimeError(f"{path} returned {status}")
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return time.perf_counter() - started_at, latencies
+
+
+class Command(BaseCommand):
+    help = "ASGIで同時にリクエストを受けたときの、同期版と非同期版のビューの秒間リクエスト数と遅延を比べる。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200, help="作成するユーザ数")
+        parser.add_argument("--tweets-per-user", type=int, default=20, help="1ユーザあたりのツイート数")
+        parser.add_argument("--follows-per-user", type=int, default=20, help="1ユーザあたりのフォロー数")
+        parser.add_argument("--requests", type=int, default=300, help="1つのURLに送るリクエスト数")
+        parser.add_argument("--concurrency", type=int, default=20, help="同時に接続するクライアント数")
+
+    def handle(self, *args, **options):
+        try:
+            with benchmark.benchmark_database():
+                paths, cookie = self.seed(options)
+                results = [self.run_mode(async_views, paths, cookie, options) for async_views in (False, True)]
+        finally:
+            reload_urlconfs()
+
+        self.stdout.write(f"{'view':<16}{'mode':<7}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for name in paths:
+            for mode, result in zip(("sync", "async"), results):
+                elapsed, latencies = result[name]
+                self.stdout.write(
+                    f"{name:<16}{mode:<7}{len(latencies) / elapsed:>9.1f}"
+                    f"{statistics.median(latencies) * 1000:>9.1f}"
+                    f"{benchmark.percentile(latencies, 95) * 1000:>9.1f}"
+                    f"{benchmark.percentile(latencies, 99) * 1000:>9.1f}"
+                )
+
+    def seed(self, options):
+        users = benchmark.seed_world(options["users"], options["tweets_per_user"], options["follows_per_user"])
+        viewer, other = users[0], users[1]
+
+        client = Client()
+        client.force_login(viewer)
+        cookie = f"{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}"
+        tweet = Tweet.objects.filter(user=other).first()
+        paths = {
+            "home": "/tweets/home/?feed=timeline",
+            "detail": f"/tweets/{tweet.pk}/",
+            "profile": f"/accounts/{other.username}/",
+            "following_list": f"/accounts/{other.username}/following_list/",
+            "follower_list": f"/accounts/{other.username}/follower_list/",
+        }
+        return paths, cookie
+
+    def run_mode(self, async_views, paths, cookie, options):
+        with override_settings(ASYNC_VIEWS=async_views):
+            reload_urlconfs()
+            application = get_asgi_application()
+            results = {}
+            for name, path in paths.items():
+                # 1回目のキャッシュ作成などが結果に入らないように、先に数回送っておく
+                asyncio.run(run_load(application, path, cookie, options["concurrency"], options["concurrency"]))
+                results[name] = asyncio.run(
+                    run_load(application, path, cookie, options["requests"], options["concurrency"])
+                )
+        return results
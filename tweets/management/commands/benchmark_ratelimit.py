@@ -0,0 +1,78 @@
+import tempfile
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+
+from mysite import ratelimit
+
+CustomUser = get_user_model()
+
+# 回数の制限のミドルウェア(mysite/ratelimit.py)が1リクエストあたりに足す時間を測る。
+# DBやビューの時間を含めないように、何もしないビューの前にミドルウェアだけを置いて、ビューを直接呼んだ時間との差を出す。
+# 制限に引っかからないように、測っている間はどのURLも十分大きな回数まで通す。
+
+# 測っている間だけ使う制限。capacityを大きくして、すべてのリクエストを通す
+LIMIT = (10**9, 1)
+
+
+def view(request):
+    return HttpResponse()
+
+
+class Command(BaseCommand):
+    help = "回数の制限のミドルウェア(mysite/ratelimit.py)が1リクエストあたりに足す時間を、ストアごとに表示する。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=100000, help="1つの測定で送るリクエストの数")
+        parser.add_argument("--users", type=int, default=1000, help="リクエストを送るユーザとIPアドレスの数")
+
+    def handle(self, *args, **options):
+        count = options["requests"]
+        if count < 1 or options["users"] < 1:
+            raise CommandError("--requestsと--usersは1以上にしてください。")
+        factory = RequestFactory()
+        users = [CustomUser(pk=i + 1, username=f"benchuser{i}") for i in range(options["users"])]
+
+        def requests(method, url_name):
+            # ユーザとIPアドレスを順に変えたリクエスト。作る時間は測る時間に入れない
+            request_list = []
+            for i in range(count):
+                user = users[i % len(users)]
+                request = getattr(factory, method)(
+                    reverse(url_name), REMOTE_ADDR=f"10.0.{user.pk // 256}.{user.pk % 256}"
+                )
+                request.user = user if url_name != "accounts:signup" else AnonymousUser()
+                request_list.append(request)
+            return request_list
+
+        def measure(handler, request_list):
+            started_at = time.perf_counter()
+            for request in request_list:
+                handler(request)
+            return (time.perf_counter() - started_at) / len(request_list)
+
+        limits = {name: {"user": LIMIT, "ip": LIMIT} for name in ("tweets:create", "accounts:follow")}
+        limits["accounts:signup"] = {"ip": LIMIT}
+        with tempfile.TemporaryDirectory() as directory:
+            stores = [
+                ("InProcessStore", ratelimit.InProcessStore()),
+                ("FileLockStore", ratelimit.FileLockStore(path=f"{directory}/ratelimit")),
+            ]
+            with override_settings(RATE_LIMIT_ENABLED=True, RATE_LIMITS=limits):
+                middleware = ratelimit.ratelimit_middleware(view)
+                get_requests = requests("get", "tweets:create")
+                baseline = measure(view, get_requests)
+                self.stdout.write(f"ビューを直接呼ぶ: 1回あたり{baseline * 1e6:.2f}マイクロ秒")
+                overhead = measure(middleware, get_requests) - baseline
+                self.stdout.write(f"GET(制限しない): 1回あたり+{overhead * 1e6:.2f}マイクロ秒")
+                for name, store in stores:
+                    ratelimit._store = store
+                    for url_name in ("tweets:create", "accounts:signup"):
+                        overhead = measure(middleware, requests("post", url_name)) - baseline
+                        self.stdout.write(f"POST {url_name}({name}): 1回あたり+{overhead * 1e6:.2f}マイクロ秒")
+                ratelimit._store = None
@@ -0,0 +1,264 @@
+from importlib import import_module
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts.models import FriendShip
+from tweets import benchmark, favorites
+from tweets.models import Tweet
+
+# accounts/urls.pyとtweets/urls.pyのすべてのURLを、テスト用のClientで順にリクエストして時間を測る。
+# 結果をJSONで保存しておき、次の実行で--baselineに渡すと、悪化していた場合にエラーで終了する。
+
+# 測る内容。URLを追加したらここにも追加する(追加していないとコマンドがエラーになる)
+# name: 結果のキー, url_name: URLの名前, method: get/post, kwargs: URLの引数を返す関数,
+# data: 送るデータを返す関数, setup: 毎回のリクエストの前に状態を戻す関数, status: 期待するステータスコード
+
+
+class Scenario:
+    def __init__(self, url_name, name=None, method="get", kwargs=None, data=None, setup=None, status=200):
+        self.url_name = url_name
+        self.name = name or url_name
+        self.method = method
+        self.kwargs = kwargs or (lambda world: {})
+        self.data = data or (lambda world: {})
+        self.setup = setup or (lambda world: None)
+        self.status = status
+
+
+class World:
+    # ベンチマーク用に作ったデータ。viewerとしてログインし、otherのページなどを見る
+    def __init__(self, users, client):
+        self.users = users
+        self.client = client
+        self.viewer, self.other, self.target = users[0], users[1], users[2]
+        self.tweet = Tweet.objects.filter(user=self.other).order_by("-created_at").first()
+        self.bulk_usernames = [user.username for user in users[3:53]]
+        self.tweet_to_delete = None
+
+
+def _unfollow_target(world):
+    FriendShip.objects.unfollow(world.viewer, world.target)
+
+
+def _follow_target(world):
+    FriendShip.objects.unfollow(world.viewer, world.target)
+    FriendShip.objects.follow(world.viewer, world.target)
+
+
+def _create_tweet_to_delete(world):
+    world.tweet_to_delete = Tweet.objects.create(user=world.viewer, content="benchmark tweet to delete")
+
+
+def _login(world):
+    world.client.force_login(world.viewer)
+
+
+def _other(world):
+    return {"username": world.other.username}
+
+
+SCENARIOS = [
+    Scenario("accounts:signup"),
+    Scenario("accounts:login"),
+    Scenario("accounts:logout", method="post", setup=_login, status=302),
+    Scenario(
+        "accounts:bulk_follow",
+        method="post",
+        data=lambda world: {"action": "follow", "usernames": " ".join(world.bulk_usernames)},
+        setup=lambda world: FriendShip.objects.bulk_unfollow(world.viewer, world.bulk_usernames),
+    ),
+    Scenario("accounts:user_profile", kwargs=_other),
+    Scenario(
+        "accounts:follow",
+        method="post",
+        kwargs=lambda world: {"username": world.target.username},
+        setup=_unfollow_target,
+        status=302,
+    ),
+    Scenario(
+        "accounts:unfollow",
+        method="post",
+        kwargs=lambda world: {"username": world.target.username},
+        setup=_follow_target,
+        status=302,
+    ),
+    Scenario("accounts:following_list", kwargs=_other),
+    Scenario("accounts:follower_list", kwargs=_other),
+    Scenario("tweets:home"),
+    Scenario("tweets:home", name="tweets:home?feed=timeline", data=lambda world: {"feed": "timeline"}),
+    Scenario("tweets:home", name="tweets:home?feed=following", data=lambda world: {"feed": "following"}),
+    Scenario("tweets:create", method="post", data=lambda world: {"content": "benchmark"}, status=302),
+    Scenario("tweets:search", data=lambda world: {"q": "benchmark tweet"}),
+    Scenario("tweets:detail", kwargs=lambda world: {"pk": world.tweet.pk}),
+    Scenario(
+        "tweets:delete",
+        method="post",
+        kwargs=lambda world: {"pk": world.tweet_to_delete.pk},
+        setup=_create_tweet_to_delete,
+        status=302,
+    ),
+    Scenario(
+        "tweets:like",
+        method="post",
+        kwargs=lambda world: {"pk": world.tweet.pk},
+        setup=lambda world: favorites.unlike(world.viewer, world.tweet),
+        status=302,
+    ),
+    Scenario(
+        "tweets:unlike",
+        method="post",
+        kwargs=lambda world: {"pk": world.tweet.pk},
+        setup=lambda world: favorites.like(world.viewer, world.tweet),
+        status=302,
+    ),
+    Scenario("tweets:api_home"),
+    Scenario("tweets:api_user_tweets", kwargs=_other),
+]
+
+
+def route_names():
+    # accounts/urls.pyとtweets/urls.pyにあるURLの名前
+    names = set()
+    for app in ("accounts", "tweets"):
+        for pattern in import_module(f"{app}.urls").urlpatterns:
+            names.add(f"{app}:{pattern.name}")
+    return names
+
+
+def find_regressions(baseline, results, threshold, query_tolerance):
+    """
+    baselineより悪化した項目を「名前: 内容」の文字列のリストで返す。
+    p95の遅延とピークメモリはthreshold(割合)を超えて増えたら、1リクエストのSQLの回数はquery_toleranceを超えて増えたら悪化とする。
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ("p95_ms", "peak_memory_kib"):
+            if result[key] > base[key] * (1 + threshold):
+                regressions.append(f"{name}: {key} {base[key]:.1f} -> {result[key]:.1f}")
+        if result["queries"] > base["queries"] + query_tolerance:
+            regressions.append(f"{name}: queries {base['queries']:.1f} -> {result['queries']:.1f}")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = "すべての画面・APIの遅延(p50/p95/p99)・1リクエストのSQLの回数・ピークメモリを測り、JSONで保存する。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000, help="作成するユーザ数")
+        parser.add_argument("--tweets-per-user", type=int, default=20, help="1ユーザあたりのツイート数")
+        parser.add_argument("--follows-per-user", type=int, default=50, help="1ユーザあたりのフォロー数")
+        parser.add_argument("--seed", type=int, default=0, help="データを作る乱数のシード")
+        parser.add_argument("--iterations", type=int, default=50, help="1つのURLで測るリクエスト数")
+        parser.add_argument("--warmup", type=int, default=5, help="測る前に送って捨てるリクエスト数")
+        parser.add_argument("--memory-iterations", type=int, default=3, help="ピークメモリを測るリクエスト数")
+        parser.add_argument("--output", help="結果を保存するJSONファイル")
+        parser.add_argument("--baseline", help="比べる前回の結果のJSONファイル")
+        parser.add_argument("--threshold", type=float, default=0.25, help="p95とピークメモリの悪化とみなす増加の割合")
+        parser.add_argument("--query-tolerance", type=float, default=0.5, help="SQLの回数の悪化とみなす増加")
+
+    def handle(self, *args, **options):
+        missing = route_names() - {scenario.url_name for scenario in SCENARIOS}
+        if missing:
+            raise CommandError(f"測る内容がないURLがあります: {', '.join(sorted(missing))}")
+
+        with benchmark.benchmark_database():
+            users = benchmark.seed_world(
+                options["users"], options["tweets_per_user"], options["follows_per_user"], seed=options["seed"]
+            )
+            world = World(users, Client(HTTP_HOST=benchmark.HOST))
+            results = {}
+            for scenario in SCENARIOS:
+                results[scenario.name] = self.measure(world, scenario, options)
+                # いいねの増減がためられていたら、次のURLの結果に入らないように書き込んでおく
+                favorites.favorite_counter.flush()
+
+        report = {
+            "environment": {
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+            },
+            "options": {
+                key: options[key]
+                for key in ("users", "tweets_per_user", "follows_per_user", "seed", "iterations", "warmup")
+            },
+            "results": results,
+        }
+        self.print_results(results)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)["results"]
+            regressions = find_regressions(baseline, results, options["threshold"], options["query_tolerance"])
+            if regressions:
+                raise CommandError("前回より悪化しています:\n" + "\n".join(regressions))
+            self.stdout.write(self.style.SUCCESS("前回から悪化した項目はありません。"))
+
+    def request(self, world, scenario):
+        scenario.setup(world)
+        url = reverse(scenario.url_name, kwargs=scenario.kwargs(world))
+        with CaptureQueriesContext(connection) as queries:
+            started_at = time.perf_counter()
+            response = getattr(world.client, scenario.method)(url, scenario.data(world))
+            if response.streaming:
+                b"".join(response.streaming_content)
+            elapsed = time.perf_counter() - started_at
+        if response.status_code != scenario.status:
+            raise CommandError(f"{scenario.name}: ステータスコードが{response.status_code}でした")
+        return elapsed, len(queries)
+
+    def measure(self, world, scenario, options):
+        world.client.force_login(world.viewer)
+        latencies = []
+        query_counts = []
+        for i in range(options["warmup"] + options["iterations"]):
+            elapsed, query_count = self.request(world, scenario)
+            if i >= options["warmup"]:
+                latencies.append(elapsed)
+                query_counts.append(query_count)
+
+        # tracemallocを動かすと遅くなるので、メモリは時間とは別に測る
+        peak_memory = 0
+        tracemalloc.start()
+        try:
+            for _ in range(options["memory_iterations"]):
+                scenario.setup(world)
+                tracemalloc.reset_peak()
+                current, _ = tracemalloc.get_traced_memory()
+                self.request(world, scenario)
+                peak_memory = max(peak_memory, tracemalloc.get_traced_memory()[1] - current)
+        finally:
+            tracemalloc.stop()
+
+        return {
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p95_ms": benchmark.percentile(latencies, 95) * 1000,
+            "p99_ms": benchmark.percentile(latencies, 99) * 1000,
+            "queries": statistics.mean(query_counts),
+            "max_queries": max(query_counts),
+            "peak_memory_kib": peak_memory / 1024,
+        }
+
+    def print_results(self, results):
+        self.stdout.write(f"{'name':<30}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'peak KiB':>10}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<30}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+                f"{result['queries']:>9.1f}{result['peak_memory_kib']:>10.1f}"
+            )
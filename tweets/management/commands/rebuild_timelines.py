@@ -0,0 +1,26 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from tweets import timeline
+
+CustomUser = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "フォロー関係とツイートから受信箱(TimelineEntry)を作り直す。ユーザ名を省略すると全ユーザが対象。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("usernames", nargs="*", help="作り直すユーザのユーザ名")
+
+    def handle(self, *args, **options):
+        users = CustomUser.objects.order_by("pk")
+        if options["usernames"]:
+            users = users.filter(username__in=options["usernames"])
+            missing = set(options["usernames"]) - set(users.values_list("username", flat=True))
+            if missing:
+                raise CommandError(f"存在しないユーザです: {', '.join(sorted(missing))}")
+
+        user_ids = list(users.values_list("pk", flat=True))
+        for user_id in user_ids:
+            timeline.rebuild(user_id)
+        self.stdout.write(self.style.SUCCESS(f"{len(user_ids)}人の受信箱を作り直しました。"))
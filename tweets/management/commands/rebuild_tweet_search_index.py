@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+
+from tweets.models import Tweet
+from tweets.search import FTS_TABLE, fts_available
+
+
+class Command(BaseCommand):
+    help = "ツイートの全文検索の索引(FTS5)を1つのトランザクションで空にして、ツイートのidの範囲ごとに作り直す。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="1回のINSERTで索引に入れるツイート数")
+
+    def handle(self, *args, **options):
+        using = router.db_for_write(Tweet)
+        if not fts_available(using):
+            raise CommandError("このデータベースではFTS5の全文検索が使えません。")
+
+        connection = connections[using]
+        count = 0
+        last_pk = 0
+        # 作り直し全体を1つのトランザクションにする。
+        # ・ほかの接続からはコミットするまで元の索引が見え、作り直している間に検索結果が空にならない
+        # ・'delete-all'で書き込みのロックを取るので、作り直している間のツイートのINSERT・UPDATE・DELETEは
+        #   コミットまで待たされ、トリガーが入れた行とidが重なったり、まだ入れていない行をトリガーが消そうとしたりしない
+        # ・途中で失敗しても元の索引に戻る
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                # 外部コンテンツテーブルの索引だけを消す
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')")
+            while True:
+                pks = list(
+                    Tweet.objects.using(using)
+                    .filter(pk__gt=last_pk)
+                    .order_by("pk")
+                    .values_list("pk", flat=True)[: options["batch_size"]]
+                )
+                if not pks:
+                    break
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"INSERT INTO {FTS_TABLE}(rowid, content) "
+                        "SELECT id, content FROM tweets_tweet WHERE id > %s AND id <= %s",
+                        [last_pk, pks[-1]],
+                    )
+                count += len(pks)
+                last_pk = pks[-1]
+        self.stdout.write(self.style.SUCCESS(f"{count}件のツイートを索引に入れました。"))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from tweets.models import Favorite, Tweet
+
+
+def favorite_count():
+    # Favoriteをツイートごとに数えるサブクエリ。該当行がないとNULLになるので0にする
+    counts = Favorite.objects.filter(tweet=OuterRef("pk")).order_by().values("tweet")
+    return Coalesce(Subquery(counts.annotate(count=Count("pk")).values("count")), 0)
+
+
+class Command(BaseCommand):
+    help = "Tweetのいいね数をFavoriteから集計し直し、ずれている行だけまとめて更新する。"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="1回のUPDATEで調べるツイート数")
+
+    def handle(self, *args, **options):
+        fixed = 0
+        last_pk = 0
+        while True:
+            # pkの範囲ごとに区切り、1バッチにつきUPDATE文1回で直す
+            pks = list(
+                Tweet.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", flat=True)[: options["batch_size"]]
+            )
+            if not pks:
+                break
+
+            with transaction.atomic():
+                fixed += (
+                    Tweet.objects.filter(pk__gt=last_pk, pk__lte=pks[-1])
+                    .annotate(actual_favorite_count=favorite_count())
+                    .exclude(favorite_count=F("actual_favorite_count"))
+                    .update(favorite_count=favorite_count())
+                )
+            last_pk = pks[-1]
+        self.stdout.write(self.style.SUCCESS(f"{fixed}件のツイートのいいね数を修正しました。"))
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.13 on 2026-10-17 14:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("tweets", "0004_timelineentry"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="tweet",
+            index=models.Index(fields=["user", "-created_at", "-id"], name="tweet_user_created_at_idx"),
+        ),
+        migrations.AlterField(
+            model_name="tweet",
+            name="user",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="投稿者",
+            ),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.1.13 on 2026-10-17 14:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("tweets", "0005_tweet_user_created_at_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tweet",
+            name="favorite_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="いいね数"),
+        ),
+        migrations.CreateModel(
+            name="Favorite",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "tweet",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="favorites", to="tweets.tweet"
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="favorites",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="favorite",
+            constraint=models.UniqueConstraint(fields=("user", "tweet"), name="unique_favorite"),
+        ),
+    ]
@@ -0,0 +1,67 @@
+from django.db import DatabaseError, migrations
+
+# ツイート本文の全文検索用に、SQLiteのFTS5仮想テーブルtweets_tweet_ftsを作る。
+# 本文はtweets_tweetにあるので外部コンテンツテーブル(content=...)にして二重に持たないようにし、
+# tweets_tweetへのINSERT/DELETE/UPDATEはトリガーで索引に反映する。
+# 日本語は単語の区切りに空白がないので、3文字単位で索引を作るtrigramトークナイザを使う。
+# SQLite以外のDBや、FTS5が使えないSQLiteでは何もしない(検索はLIKEによる検索に切り替わる)。
+
+CREATE_TABLE = """
+CREATE VIRTUAL TABLE tweets_tweet_fts USING fts5(
+    content, content='tweets_tweet', content_rowid='id', tokenize='trigram'
+)
+"""
+
+CREATE_TRIGGERS = [
+    """
+    CREATE TRIGGER tweets_tweet_fts_insert AFTER INSERT ON tweets_tweet BEGIN
+        INSERT INTO tweets_tweet_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER tweets_tweet_fts_delete AFTER DELETE ON tweets_tweet BEGIN
+        INSERT INTO tweets_tweet_fts(tweets_tweet_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER tweets_tweet_fts_update AFTER UPDATE OF content ON tweets_tweet BEGIN
+        INSERT INTO tweets_tweet_fts(tweets_tweet_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO tweets_tweet_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute(CREATE_TABLE)
+        except DatabaseError:
+            # FTS5(またはtrigramトークナイザ)が組み込まれていないSQLite
+            return
+        for sql in CREATE_TRIGGERS:
+            cursor.execute(sql)
+        # 既存のツイートを索引に入れる
+        cursor.execute("INSERT INTO tweets_tweet_fts(tweets_tweet_fts) VALUES ('rebuild')")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for name in ("tweets_tweet_fts_insert", "tweets_tweet_fts_delete", "tweets_tweet_fts_update"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute("DROP TABLE IF EXISTS tweets_tweet_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tweets", "0006_favorite"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,58 @@
+from django.db import migrations
+
+# 大量にINSERTするとき(generate_social_graph)に、そのトランザクションで入れたツイートだけ
+# 1行ずつ索引に入れるのを止められるようにする。
+# tweets_tweet_fts_deferredに行があるトランザクションの中ではINSERTのトリガーが何もしない。
+# 行はコミットする前に消す(tweets.search.deferred_indexing)ので、ほかの接続からは見えず、
+# ほかの接続からのINSERTは今まで通りトリガーで索引に入る。
+
+CREATE_DEFERRED_TABLE = "CREATE TABLE tweets_tweet_fts_deferred (id INTEGER PRIMARY KEY)"
+
+CREATE_INSERT_TRIGGER = """
+CREATE TRIGGER tweets_tweet_fts_insert AFTER INSERT ON tweets_tweet
+WHEN NOT EXISTS (SELECT 1 FROM tweets_tweet_fts_deferred) BEGIN
+    INSERT INTO tweets_tweet_fts(rowid, content) VALUES (new.id, new.content);
+END
+"""
+
+# 0007_tweet_search_indexで作ったトリガー
+OLD_INSERT_TRIGGER = """
+CREATE TRIGGER tweets_tweet_fts_insert AFTER INSERT ON tweets_tweet BEGIN
+    INSERT INTO tweets_tweet_fts(rowid, content) VALUES (new.id, new.content);
+END
+"""
+
+
+def has_search_index(schema_editor):
+    # SQLite以外のDBや、FTS5が使えず0007で索引を作らなかったSQLiteでは何もしない
+    connection = schema_editor.connection
+    return connection.vendor == "sqlite" and "tweets_tweet_fts" in connection.introspection.table_names()
+
+
+def add_deferred_table(apps, schema_editor):
+    if not has_search_index(schema_editor):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(CREATE_DEFERRED_TABLE)
+        cursor.execute("DROP TRIGGER tweets_tweet_fts_insert")
+        cursor.execute(CREATE_INSERT_TRIGGER)
+
+
+def remove_deferred_table(apps, schema_editor):
+    if not has_search_index(schema_editor):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP TRIGGER tweets_tweet_fts_insert")
+        cursor.execute(OLD_INSERT_TRIGGER)
+        cursor.execute("DROP TABLE IF EXISTS tweets_tweet_fts_deferred")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tweets", "0007_tweet_search_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(add_deferred_table, remove_deferred_table),
+    ]
@@ -5,8 +5,55 @@ from django.db import models
 
 
 class Tweet(models.Model):
+    # userだけのインデックスはtweet_user_created_at_idxの先頭列で代用できるので作らない
     user = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="投稿者"
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="投稿者", db_index=False
     )  # settings.AUTH_USER_MODELはCustomUserモデル
     content = models.TextField(max_length=140, verbose_name="ツイート内容")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="投稿日時")
+    # いいね数。表示のたびにFavoriteをCOUNT(*)しないように集計済みの値を持つ。更新はtweets/favorites.pyで行う
+    favorite_count = models.PositiveIntegerField(default=0, verbose_name="いいね数")
+
+    class Meta:
+        indexes = [
+            # ホーム画面のカーソルページング(created_at, idの降順)用の複合インデックス
+            models.Index(fields=["-created_at", "-id"], name="tweet_created_at_id_idx"),
+            # フォロー中のユーザのツイートを新しい順に取り出すための(user, created_at, id)の複合インデックス
+            models.Index(fields=["user", "-created_at", "-id"], name="tweet_user_created_at_idx"),
+        ]
+
+
+class Favorite(models.Model):
+    # userだけのインデックスはunique_favoriteの(user, tweet)インデックスで代用できるので作らない
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="favorites", db_index=False
+    )
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name="favorites")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # 同じユーザが同じツイートに2回いいねできないようにする
+            models.UniqueConstraint(fields=["user", "tweet"], name="unique_favorite"),
+        ]
+
+
+class TimelineEntry(models.Model):
+    """
+    ユーザごとに実体化したホームタイムライン(受信箱)。
+    ツイート投稿時にフォロワー全員分の行を書き込んでおくことで(fan-out-on-write)、
+    ホーム画面の読み込みはownerで絞った(created_at, tweet)の範囲検索1回で済む。
+    created_atはtweetのcreated_atを複製したもので、並び替えのためにJOINしなくてよいようにしている。
+    """
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="timeline_entries")
+    tweet = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name="timeline_entries")
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["owner", "tweet"], name="unique_timeline_entry"),
+        ]
+        indexes = [
+            models.Index(fields=["owner", "-created_at", "-tweet"], name="timeline_owner_created_at_idx"),
+        ]
@@ -0,0 +1,109 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+
+# OFFSETによるページングは深いページほど読み飛ばす行数が増えて遅くなる。
+# ここでは(created_at, id)の組をカーソルとして「前のページの最後の行より古いもの」を
+# 条件にすることで、インデックスの範囲検索だけでどのページも同じコストで取得できるようにする。
+
+
+def encode_cursor(created_at, pk):
+    # URLにそのまま載せられるようにurlsafeなbase64にする
+    raw = f"{created_at.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+# カーソルのidとして受け付ける最大値(SQLiteのINTEGERの最大値)。これより大きいとSQLの実行時にOverflowErrorになる
+MAX_CURSOR_PK = 2**63 - 1
+
+
+def decode_cursor(cursor):
+    # 不正なカーソルは400エラーにする
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, pk = raw.split("|")
+        created_at, pk = datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise BadRequest("Invalid cursor.")
+    if not 1 <= pk <= MAX_CURSOR_PK:
+        raise BadRequest("Invalid cursor.")
+    return created_at, pk
+
+
+def keyset_queryset(queryset, cursor, fields=("created_at", "id")):
+    # querysetを(日時, id)の降順に並べ、cursorが指す行より後(古いもの)だけに絞る
+    time_field, id_field = fields
+    queryset = queryset.order_by(f"-{time_field}", f"-{id_field}")
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{f"{time_field}__lt": created_at}) | Q(**{time_field: created_at, f"{id_field}__lt": pk})
+        )
+    return queryset
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    querysetを(created_at, id)の降順でper_page件ずつ切り出す。
+    fieldsには並び替えに使う(日時のフィールド名, 一意なidのフィールド名)を渡す。
+    per_page + 1件取得して、余った1件があれば次のページがあると判定する(COUNT(*)は発行しない)。
+    """
+
+    def __init__(self, queryset, per_page, fields=("created_at", "id")):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.fields = fields
+
+    def page(self, cursor=None):
+        object_list = list(keyset_queryset(self.queryset, cursor, self.fields)[: self.per_page + 1])
+        return self._make_page(object_list)
+
+    async def apage(self, cursor=None):
+        # 非同期ビュー用。取得する行と判定はpage()と同じ
+        queryset = keyset_queryset(self.queryset, cursor, self.fields)[: self.per_page + 1]
+        return self._make_page([obj async for obj in queryset])
+
+    def _make_page(self, object_list):
+        time_field, id_field = self.fields
+        next_cursor = None
+        if len(object_list) > self.per_page:
+            object_list = object_list[: self.per_page]
+            last = object_list[-1]
+            next_cursor = encode_cursor(getattr(last, time_field), getattr(last, id_field))
+        return KeysetPage(object_list, next_cursor)
+
+
+class KeysetPaginationMixin:
+    """
+    ListViewのpaginate_queryset()を置き換えて、?cursor=...によるページングにする。
+    テンプレートではpage_obj.next_cursorで次のページのカーソルを参照できる。
+    """
+
+    cursor_kwarg = "cursor"
+    keyset_fields = ("created_at", "id")
+
+    def get_keyset_fields(self):
+        return self.keyset_fields
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size, fields=self.get_keyset_fields())
+        page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        return paginator, page, page.object_list, page.has_next()
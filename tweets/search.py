@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+
+from django.db import connections, router, transaction
+from django.db.models import Max, Q
+
+from .models import Tweet
+
+# ツイート本文の全文検索。SQLiteのFTS5仮想テーブル(migrations/0007_tweet_search_index.py)を使い、
+# bm25による関連度と投稿日時の新しさを合わせた順に並べる。
+# FTS5が使えない環境ではLIKEによる検索(新しい順)に切り替える。
+
+FTS_TABLE = "tweets_tweet_fts"
+
+# 行がある間はINSERTのトリガーが索引を更新しない(migrations/0008_tweet_search_index_deferred.py)
+DEFERRED_TABLE = "tweets_tweet_fts_deferred"
+
+# trigramトークナイザは3文字未満の語を索引から探せない
+MIN_FTS_TERM_LENGTH = 3
+
+# 投稿からこの日数がたつと、関連度(bm25)の重みが半分になる
+RECENCY_HALF_LIFE_DAYS = 30
+
+# DBのエイリアス -> FTS5のテーブルがあるかどうか
+_fts_available = {}
+
+
+def fts_available(using):
+    if using not in _fts_available:
+        connection = connections[using]
+        if connection.vendor != "sqlite":
+            _fts_available[using] = False
+        else:
+            _fts_available[using] = FTS_TABLE in connection.introspection.table_names()
+    return _fts_available[using]
+
+
+@contextmanager
+def deferred_indexing(using=None):
+    """
+    ブロックの中でINSERTしたツイートだけ、索引を1行ずつ更新するトリガーを止めておき、
+    ブロックの終わりにまとめて索引に入れる(1行ずつより10倍ほど速い)。ブロック全体が1つのトランザクションになる。
+    トリガーは外さないので、ほかの接続からのINSERT・UPDATE・DELETEは今まで通り索引に反映される。
+    ブロックの中で入れたツイートをブロックの中でUPDATE・DELETEすると索引が壊れるので、INSERTだけに使う。
+    """
+    using = using or router.db_for_write(Tweet)
+    if not fts_available(using):
+        with transaction.atomic(using=using):
+            yield
+        return
+    connection = connections[using]
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            # 書き込みのロックを取ってからidの最大値を読むので、これより大きいidはこのトランザクションで入れたものだけになる。
+            # tweets_tweet_fts_deferredに入れた行はコミットする前に消すので、ほかの接続からは見えない
+            cursor.execute(f"INSERT INTO {DEFERRED_TABLE} DEFAULT VALUES")
+            marker = cursor.lastrowid
+        last_id = Tweet.objects.using(using).aggregate(last_id=Max("id"))["last_id"] or 0
+        yield
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}(rowid, content) SELECT id, content FROM tweets_tweet WHERE id > %s",
+                [last_id],
+            )
+            cursor.execute(f"DELETE FROM {DEFERRED_TABLE} WHERE id = %s", [marker])
+
+
+def split_terms(query):
+    # 空白で区切った語をすべて含むツイートを探す
+    return [term for term in query.split() if term]
+
+
+def _fts_match(terms):
+    # FTS5の構文として解釈されないように、語をダブルクォートで囲む
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_tweet_ids(query, offset, limit):
+    """
+    queryに一致するツイートのidを、関連度と新しさの順にoffset件目からlimit件返す。
+    """
+    terms = split_terms(query)
+    if not terms:
+        return []
+    using = router.db_for_read(Tweet)
+    long_terms = [term for term in terms if len(term) >= MIN_FTS_TERM_LENGTH]
+    if not long_terms or not fts_available(using):
+        return _search_tweet_ids_with_like(terms, offset, limit)
+
+    # 3文字以上の語はFTS5の索引で絞り込み、3文字未満の語はその結果に対してLIKEで絞り込む
+    short_terms = [term for term in terms if len(term) < MIN_FTS_TERM_LENGTH]
+    short_conditions = "".join(" AND t.content LIKE %s ESCAPE '\\'" for _ in short_terms)
+    sql = f"""
+        SELECT t.id
+        FROM {FTS_TABLE} f
+        INNER JOIN tweets_tweet t ON t.id = f.rowid
+        WHERE {FTS_TABLE} MATCH %s{short_conditions}
+        ORDER BY bm25({FTS_TABLE}) / (1 + (julianday('now') - julianday(t.created_at)) / %s), t.id DESC
+        LIMIT %s OFFSET %s
+    """
+    params = [_fts_match(long_terms), *[f"%{_escape_like(term)}%" for term in short_terms]]
+    params += [RECENCY_HALF_LIFE_DAYS, limit, offset]
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _search_tweet_ids_with_like(terms, offset, limit):
+    condition = Q()
+    for term in terms:
+        condition &= Q(content__icontains=term)
+    tweets = Tweet.objects.filter(condition).order_by("-created_at", "-id")
+    return list(tweets.values_list("id", flat=True)[offset : offset + limit])
+
+
+def search(query, page_number, per_page):
+    """
+    page_numberページ目(1始まり)の(ツイートのリスト, 次のページがあるか)を返す。
+    件数を数えないように、per_page + 1件取得して次のページの有無を判定する。
+    """
+    ids = search_tweet_ids(query, (page_number - 1) * per_page, per_page + 1)
+    tweets = Tweet.objects.select_related("user").in_bulk(ids[:per_page])
+    return [tweets[pk] for pk in ids[:per_page] if pk in tweets], len(ids) > per_page
@@ -0,0 +1,137 @@
+import asyncio
+from importlib import import_module
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+from django.http import parse_cookie
+
+from accounts.models import FriendShip
+
+from . import live
+
+# 新しいツイートをサーバ送信イベント(Server-Sent Events)で届けるASGIアプリケーション。
+# Django 4.1のStreamingHttpResponseは非同期のイテレータを扱えず、接続ごとにスレッドを使ってしまうので、
+# settings.LIVE_TIMELINE_PATHへのリクエストだけをDjangoの手前(mysite/asgi.py)で受け取ってここで処理する。
+# ブラウザからは new EventSource("/tweets/live/") で接続し、"tweet"イベントで新しいツイートのJSONを受け取る。
+
+
+def format_event(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False)}")
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+class _SessionRequest:
+    # django.contrib.auth.get_user()はrequest.sessionしか使わないので、セッションだけを持つ代わりのオブジェクト
+    def __init__(self, session):
+        self.session = session
+
+
+def _load_subscriber(cookie_header):
+    # セッションのクッキーからログインユーザを調べ、(ユーザのid, ツイートを受け取る投稿者のid)を返す
+    close_old_connections()
+    try:
+        session_key = parse_cookie(cookie_header).get(settings.SESSION_COOKIE_NAME)
+        session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        user = get_user(_SessionRequest(session))
+        if not user.is_authenticated:
+            return None, []
+        following_ids = FriendShip.objects.filter(follower=user).values_list("following_id", flat=True)
+        return user.pk, [user.pk, *following_ids]
+    finally:
+        close_old_connections()
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class LiveTimelineApp:
+    """
+    settings.LIVE_TIMELINE_PATHへのGETをSSEの接続として処理し、それ以外のリクエストはapplicationに渡す。
+    接続中はフォロー中のユーザと自分の新しいツイートを"tweet"イベントで送り、
+    キューがあふれて捨てたイベントがあれば、次のイベントの前に"overflow"イベントで捨てた数を送る。
+    何も送らない間もLIVE_HEARTBEAT_INTERVAL秒ごとにコメント行を送り、切れた接続を検出する。
+    """
+
+    def __init__(self, application, path=None, heartbeat_interval=None):
+        self.application = application
+        self.path = settings.LIVE_TIMELINE_PATH if path is None else path
+        self.heartbeat_interval = (
+            settings.LIVE_HEARTBEAT_INTERVAL if heartbeat_interval is None else heartbeat_interval
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.application(scope, receive, send)
+        if scope["method"] != "GET":
+            return await self.send_error(send, 405, "Method Not Allowed")
+
+        headers = dict(scope.get("headers", []))
+        user_id, author_ids = await sync_to_async(_load_subscriber)(headers.get(b"cookie", b"").decode("latin-1"))
+        if user_id is None:
+            return await self.send_error(send, 403, "Forbidden")
+
+        hub = live.get_hub()
+        subscription = hub.subscribe(author_ids)
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", b"text/event-stream; charset=utf-8"),
+                        (b"cache-control", b"no-cache"),
+                        # nginxなどのプロキシにイベントをため込ませない
+                        (b"x-accel-buffering", b"no"),
+                    ],
+                }
+            )
+            # 切断されたときにブラウザが再接続するまでの待ち時間(ミリ秒)
+            await send({"type": "http.response.body", "body": b"retry: 3000\n\n", "more_body": True})
+            await self.stream(subscription, disconnect, send)
+        finally:
+            hub.unsubscribe(subscription)
+            disconnect.cancel()
+
+    async def stream(self, subscription, disconnect, send):
+        while True:
+            next_event = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait(
+                {next_event, disconnect}, timeout=self.heartbeat_interval, return_when=asyncio.FIRST_COMPLETED
+            )
+            if next_event not in done:
+                next_event.cancel()
+            if disconnect in done:
+                return
+
+            if next_event in done:
+                body = b""
+                dropped = subscription.take_dropped()
+                if dropped:
+                    body += format_event("overflow", {"dropped": dropped})
+                event = next_event.result()
+                body += format_event("tweet", event, event_id=event["id"])
+            else:
+                body = b": ping\n\n"
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+
+    async def send_error(self, send, status, message):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+            }
+        )
+        await send({"type": "http.response.body", "body": message.encode()})
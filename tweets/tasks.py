@@ -0,0 +1,14 @@
+from jobs.queue import task
+
+from . import timeline
+from .models import Tweet
+
+# バックグラウンドのジョブ(jobs/queue.py)として実行する処理。runworkerコマンドのワーカーで実行される。
+
+
+@task
+def fan_out_tweet(tweet_id):
+    # ジョブを実行するまでに削除されたツイートは配らない
+    tweet = Tweet.objects.filter(pk=tweet_id).first()
+    if tweet is not None:
+        timeline.fan_out_tweet(tweet)
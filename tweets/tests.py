@@ -1,8 +1,36 @@
+import asyncio
+import base64
+from datetime import timedelta
+from io import StringIO
+import json
+import os
+import socket
+import tempfile
+import threading
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import SESSION_KEY, get_user_model
-from django.test import TestCase
-from django.urls import reverse
+from django.core.asgi import get_asgi_application
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished
+from django.db import DatabaseError, close_old_connections, connection
+from django.db.models import QuerySet
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from accounts.models import FriendShip
+from jobs import queue
+from mysite.testing import AsyncViewsTestCase, TestCase, cached_sessions
 
-from .models import Tweet
+from . import benchmark, favorites, fragments, live, search, timeline
+from .management.commands.benchmark_views import route_names
+from .models import Favorite, TimelineEntry, Tweet
+from .sse import LiveTimelineApp
 
 CustomUser = get_user_model()
 
@@ -46,6 +74,245 @@ class TestHomeView(TestCase):
         context["tweet_list"]はホーム画面で表示されるツイート一覧のコンテキスト形式
         """
 
+    def test_success_get_with_cursor(self):
+        """
+        カーソルで次のページを取得する。
+        ・1ページ目はpaginate_by件で、次のページのカーソルがある
+        ・カーソルをたどると重複も漏れもなく全ツイートを新しい順に取得できる
+        """
+        Tweet.objects.bulk_create([Tweet(user=self.user1, content=f"testpost{i}") for i in range(30)])
+        expected = list(Tweet.objects.order_by("-created_at", "-id"))
+
+        response = self.client.get(self.url)
+        page_obj = response.context["page_obj"]
+        self.assertEqual(len(response.context["tweet_list"]), 20)
+        self.assertTrue(page_obj.has_next())
+
+        response = self.client.get(self.url, {"cursor": page_obj.next_cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context["page_obj"].has_next())
+        self.assertEqual(
+            list(page_obj.object_list) + list(response.context["tweet_list"]),
+            expected,
+        )
+
+    def test_failure_get_with_invalid_cursor(self):
+        """
+        不正なカーソルでリクエストを送信する。
+        ・Response Status Code: 400
+        """
+        response = self.client.get(self.url, {"cursor": "invalid"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_failure_get_with_out_of_range_cursor(self):
+        """
+        idがSQLiteのINTEGERに入らない・正でないカーソルでリクエストを送信する。
+        ・ホーム画面・プロフィール画面・フォローリストのどれも500ではなく400になる
+        """
+        urls = [
+            self.url,
+            reverse("accounts:user_profile", kwargs={"username": "testuser1"}),
+            reverse("accounts:following_list", kwargs={"username": "testuser1"}),
+        ]
+        for pk in ("99999999999999999999999", "0", "-1"):
+            cursor = base64.urlsafe_b64encode(f"2020-01-01T00:00:00+00:00|{pk}".encode()).decode()
+            for url in urls:
+                with self.subTest(url=url, pk=pk):
+                    self.assertEqual(self.client.get(url, {"cursor": cursor}).status_code, 400)
+
+    def test_success_get_with_timeline_feed(self):
+        """
+        受信箱(TimelineEntry)のフィードを取得する。
+        ・フォロー中のユーザと自分のツイートだけが新しい順に含まれる
+        """
+        user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        user3 = CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+        FriendShip.objects.create(follower=self.user1, following=user2)
+        own_tweet = Tweet.objects.create(user=self.user1, content="own")
+        followed_tweet = Tweet.objects.create(user=user2, content="followed")
+        other_tweet = Tweet.objects.create(user=user3, content="other")
+        for tweet in (own_tweet, followed_tweet, other_tweet):
+            timeline.fan_out_tweet(tweet)
+
+        response = self.client.get(self.url, {"feed": "timeline"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["tweet_list"], [followed_tweet, own_tweet])
+
+    def test_success_get_with_following_feed(self):
+        """
+        フォロー中のユーザのフィードを取得する。
+        ・フォロー中のユーザと自分のツイートだけが新しい順に含まれる
+        """
+        user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        user3 = CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+        FriendShip.objects.create(follower=self.user1, following=user2)
+        Tweet.objects.create(user=user2, content="followed")
+        Tweet.objects.create(user=user3, content="other")
+
+        response = self.client.get(self.url, {"feed": "following"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.context["tweet_list"],
+            list(Tweet.objects.filter(user__in=[self.user1, user2]).order_by("-created_at", "-id")),
+        )
+
+    def test_following_feed_query_plan_has_no_full_scan(self):
+        """
+        数千人をフォローしているユーザのフォロー中フィードを取得する。
+        ・1ページ目もカーソル指定時も、Tweet・FriendShipを全件走査(SCAN)するクエリがない
+        """
+        others = CustomUser.objects.bulk_create(CustomUser(username=f"other{i}") for i in range(2000))
+        FriendShip.objects.bulk_create(FriendShip(follower=self.user1, following=other) for other in others)
+        Tweet.objects.bulk_create(Tweet(user=other, content="testpost") for other in others[::10] * 3)
+
+        response = self.client.get(self.url, {"feed": "following"})
+        cursor = response.context["page_obj"].next_cursor
+        self.assertIsNotNone(cursor)
+
+        for params in ({"feed": "following"}, {"feed": "following", "cursor": cursor}):
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(self.url, params)
+            feed_queries = [query["sql"] for query in queries if 'FROM "tweets_tweet"' in query["sql"]]
+            self.assertEqual(len(feed_queries), 1)
+            with connection.cursor() as db_cursor:
+                db_cursor.execute("EXPLAIN QUERY PLAN " + feed_queries[0])
+                plan = [row[-1] for row in db_cursor.fetchall()]
+            self.assertFalse([step for step in plan if step.startswith("SCAN")], plan)
+            self.assertTrue([step for step in plan if "tweet_user_created_at_idx" in step], plan)
+
+    def test_success_get_with_liked_by_me(self):
+        """
+        いいねしたツイートを含むページを取得する。
+        ・ページ内の各ツイートにいいね済みかどうかが付いている
+        ・ツイートの件数によらずクエリ数が変わらない
+        """
+        Tweet.objects.bulk_create([Tweet(user=self.user1, content=f"testpost{i}") for i in range(5)])
+        liked = Tweet.objects.order_by("-created_at", "-id").first()
+        favorites.like(self.user1, liked)
+
+        response = self.client.get(self.url)
+        for tweet in response.context["tweet_list"]:
+            self.assertEqual(tweet.liked_by_me, tweet == liked)
+
+        # ツイートを増やしてもクエリ数は変わらない
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        Tweet.objects.bulk_create([Tweet(user=self.user1, content=f"testpost{i}") for i in range(10)])
+        with self.assertNumQueries(len(queries)):
+            self.client.get(self.url)
+
+    def test_failure_get_with_invalid_feed(self):
+        """
+        存在しないフィードを指定する。
+        ・Response Status Code: 400
+        """
+        response = self.client.get(self.url, {"feed": "invalid"})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestHomeFeedJSONView(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.url = reverse("tweets:api_home")
+        Tweet.objects.bulk_create([Tweet(user=self.user1, content=f"testpost{i}") for i in range(5)])
+        Tweet.objects.bulk_create([Tweet(user=self.user2, content=f"otherpost{i}") for i in range(5)])
+
+    def get_json(self, url, params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return json.loads(b"".join(response.streaming_content))
+
+    def test_success_get_with_cursor(self):
+        """
+        カーソルをたどって全ツイートを取得する。
+        ・ホーム画面と同じ順番で重複も漏れもなく取得できる
+        ・最後のページではnext_cursorがnull
+        """
+        data = self.get_json(self.url, {"limit": 4})
+        ids = [tweet["id"] for tweet in data["tweets"]]
+        while data["next_cursor"]:
+            data = self.get_json(self.url, {"limit": 4, "cursor": data["next_cursor"]})
+            ids += [tweet["id"] for tweet in data["tweets"]]
+
+        self.assertEqual(ids, list(Tweet.objects.order_by("-created_at", "-id").values_list("id", flat=True)))
+        self.assertEqual(
+            set(data["tweets"][0]),
+            {"id", "username", "content", "favorite_count", "created_at"},
+        )
+
+    def test_success_get_with_timeline_feed(self):
+        """
+        受信箱(TimelineEntry)のフィードをJSONで取得する。
+        ・受信箱に入っているツイートだけが含まれる
+        """
+        tweet = Tweet.objects.filter(user=self.user1).first()
+        timeline.fan_out_tweet(tweet)
+
+        data = self.get_json(self.url, {"feed": "timeline"})
+
+        self.assertEqual([item["id"] for item in data["tweets"]], [tweet.pk])
+        self.assertEqual(data["tweets"][0]["username"], "testuser1")
+
+    def test_success_get_user_tweets(self):
+        """
+        ユーザーのツイートをJSONで取得する。
+        ・そのユーザーのツイートだけが含まれる
+        """
+        data = self.get_json(reverse("tweets:api_user_tweets", kwargs={"username": "testuser2"}), {"limit": 100})
+        self.assertEqual({item["username"] for item in data["tweets"]}, {"testuser2"})
+        self.assertEqual(len(data["tweets"]), 5)
+
+    async def test_success_get_under_asgi(self):
+        """
+        ASGIサーバの代わりにDjangoのASGIアプリケーションを呼び出して、JSONを最後まで受け取る。
+        ・レスポンスの途中でDBを読んで失敗せず(SynchronousOnlyOperationにならず)、全体がJSONとして読める
+        """
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": self.url,
+            "query_string": b"limit=4",
+            "headers": [
+                (b"host", b"testserver"),
+                (b"cookie", f"{settings.SESSION_COOKIE_NAME}={session_key}".encode()),
+            ],
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            messages.append(message)
+
+        # レスポンスの後でテストのトランザクション中のDB接続を閉じないようにする(テスト用のClientと同じ)
+        request_finished.disconnect(close_old_connections)
+        self.addCleanup(request_finished.connect, close_old_connections)
+        await get_asgi_application()(scope, receive, send)
+
+        self.assertEqual(messages[0]["status"], 200)
+        data = json.loads(b"".join(message.get("body", b"") for message in messages[1:]))
+        self.assertEqual(len(data["tweets"]), 4)
+        self.assertIsNotNone(data["next_cursor"])
+
+    def test_failure_get(self):
+        """
+        不正なリクエストを送信する。
+        ・limitやcursorが不正なら400、存在しないユーザーなら404、ログインしていなければ403
+        """
+        self.assertEqual(self.client.get(self.url, {"limit": 0}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {"cursor": "invalid"}).status_code, 400)
+        url = reverse("tweets:api_user_tweets", kwargs={"username": "not_exist_user"})
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
 
 class TestTweetCreateView(TestCase):
     def setUp(self):
@@ -96,6 +363,36 @@ class TestTweetCreateView(TestCase):
         self.assertTrue(Tweet.objects.filter(content=test_tweet["content"]).exists())
         self.assertIn(SESSION_KEY, self.client.session)
 
+    def test_success_post_fans_out_to_followers(self):
+        """
+        フォロワーがいるユーザがツイートする。
+        ・リクエストの中では受信箱に配らず、ジョブを登録する
+        ・ジョブを実行すると投稿者とフォロワーの受信箱にツイートが追加されている
+        ・フォローしていないユーザの受信箱には追加されていない
+        """
+        follower = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        stranger = CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+        FriendShip.objects.create(follower=follower, following=self.user1)
+
+        self.client.post(self.url, {"content": "testtweet"})
+
+        tweet = Tweet.objects.get(content="testtweet")
+        self.assertFalse(TimelineEntry.objects.exists())
+        self.assertEqual(queue.run_pending(), 1)
+        self.assertTrue(TimelineEntry.objects.filter(owner=self.user1, tweet=tweet).exists())
+        self.assertTrue(TimelineEntry.objects.filter(owner=follower, tweet=tweet).exists())
+        self.assertFalse(TimelineEntry.objects.filter(owner=stranger).exists())
+
+    def test_success_post_publishes_after_commit(self):
+        """
+        ツイートする。
+        ・コミット後にSSEで配るためにpublish_tweet()が呼ばれる
+        """
+        with mock.patch("tweets.live.publish_tweet") as publish_tweet:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(self.url, {"content": "testtweet"})
+        publish_tweet.assert_called_once_with(Tweet.objects.get(content="testtweet"))
+
     def test_failure_post_with_empty_content(self):
         """
         contentがブランクのデータでリクエストを送信する。
@@ -176,6 +473,8 @@ class TestTweetDeleteView(TestCase):
         self.client.login(username="testuser1", password="testpassword1")
         self.post1 = Tweet.objects.create(user=self.user1, content="testpost1")
         self.post2 = Tweet.objects.create(user=self.user2, content="testpost2")
+        FriendShip.objects.create(follower=self.user2, following=self.user1)
+        timeline.fan_out_tweet(self.post1)
 
     def test_success_post(self):
         """
@@ -194,6 +493,8 @@ class TestTweetDeleteView(TestCase):
         )
         # self.assertEqual(Tweet.objects.all().count(), 0)でも良い
         self.assertFalse(Tweet.objects.filter(content="testpost1").exists())
+        # 受信箱からも取り除かれている
+        self.assertFalse(TimelineEntry.objects.exists())
         """
         self.assertFalse(Tweet.objects.filter(content=self.post["content"]).exists())
         が駄目なのはなぜか
@@ -230,23 +531,713 @@ class TestTweetDeleteView(TestCase):
         self.assertEqual(Tweet.objects.all().count(), 2)
 
 
+class TestRebuildTimelinesCommand(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        FriendShip.objects.create(follower=self.user1, following=self.user2)
+        self.post1 = Tweet.objects.create(user=self.user1, content="testpost1")
+        self.post2 = Tweet.objects.create(user=self.user2, content="testpost2")
+
+    def test_success_rebuild(self):
+        """
+        受信箱が壊れている状態から作り直す。
+        ・フォロー中のユーザと自分のツイートが受信箱に入っている
+        ・フォローしていないユーザのツイートは受信箱から消えている
+        """
+        stranger = CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+        stray = Tweet.objects.create(user=stranger, content="stray")
+        TimelineEntry.objects.create(owner=self.user1, tweet=stray, created_at=stray.created_at)
+
+        call_command("rebuild_timelines", "testuser1", stdout=StringIO())
+
+        self.assertQuerysetEqual(
+            TimelineEntry.objects.filter(owner=self.user1).order_by("tweet_id").values_list("tweet_id", flat=True),
+            [self.post1.pk, self.post2.pk],
+        )
+
+
 class TestFavoriteView(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.post = Tweet.objects.create(user=self.user2, content="testpost")
+        self.url = reverse("tweets:like", kwargs={"pk": self.post.pk})
+
     def test_success_post(self):
-        pass
+        """
+        いいねのリクエストを送信する。
+        ・Response Status Code: 302
+        ・ホームにリダイレクトしている
+        ・DBにデータが追加されている
+        ・いいね数が1増えている
+        """
+        response = self.client.post(self.url)
+
+        self.assertRedirects(response, reverse("tweets:home"), status_code=302, target_status_code=200)
+        self.assertTrue(Favorite.objects.filter(user=self.user1, tweet=self.post).exists())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.favorite_count, 1)
 
     def test_failure_post_with_not_exist_tweet(self):
-        pass
+        """
+        存在しないツイートにいいねのリクエストを送信する。
+        ・Response Status Code: 404
+        ・DBにデータが追加されていない
+        """
+        response = self.client.post(reverse("tweets:like", kwargs={"pk": 100}))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Favorite.objects.exists())
 
     def test_failure_post_with_favorited_tweet(self):
-        pass
+        """
+        いいね済みのツイートにいいねのリクエストを送信する。
+        ・DBにデータが追加されていない
+        ・いいね数が増えていない
+        """
+        self.client.post(self.url)
+        response = self.client.post(self.url)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Favorite.objects.count(), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.favorite_count, 1)
 
 
 class TestUnfavoriteView(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.post = Tweet.objects.create(user=self.user2, content="testpost")
+        self.url = reverse("tweets:unlike", kwargs={"pk": self.post.pk})
+        favorites.like(self.user1, self.post)
+
     def test_success_post(self):
-        pass
+        """
+        いいね取り消しのリクエストを送信する。
+        ・Response Status Code: 302
+        ・ホームにリダイレクトしている
+        ・DBのデータが削除されている
+        ・いいね数が0に戻っている
+        """
+        response = self.client.post(self.url)
+
+        self.assertRedirects(response, reverse("tweets:home"), status_code=302, target_status_code=200)
+        self.assertFalse(Favorite.objects.exists())
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.favorite_count, 0)
 
     def test_failure_post_with_not_exist_tweet(self):
-        pass
+        """
+        存在しないツイートにいいね取り消しのリクエストを送信する。
+        ・Response Status Code: 404
+        ・DBのデータが削除されていない
+        """
+        response = self.client.post(reverse("tweets:unlike", kwargs={"pk": 100}))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Favorite.objects.count(), 1)
 
     def test_failure_post_with_unfavorited_tweet(self):
-        pass
+        """
+        いいねしていないツイートにいいね取り消しのリクエストを送信する。
+        ・いいね数が減っていない
+        """
+        self.client.post(self.url)
+        response = self.client.post(self.url)
+
+        self.assertEqual(response.status_code, 302)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.favorite_count, 0)
+
+
+class TestFavoriteCounter(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.post = Tweet.objects.create(user=user, content="testpost")
+        # タイマーで書き込まれないようにflush_intervalを長くしておき、flush()を明示的に呼ぶ
+        self.counter = favorites.FavoriteCounter(hot_threshold=2, flush_interval=60)
+
+    def tearDown(self):
+        self.counter.flush()
+
+    def test_hot_tweet_is_buffered(self):
+        """
+        hot_thresholdを超えるいいねを送る。
+        ・hot_thresholdまではすぐに反映される
+        ・それ以降はflush()されるまでためられ、flush()で1回のUPDATEにまとめて反映される
+        """
+        for _ in range(5):
+            self.counter.add(self.post.pk, 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.favorite_count, 2)
+
+        with self.assertNumQueries(1):
+            self.counter.flush()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.favorite_count, 5)
+
+    def test_count_never_goes_negative(self):
+        """
+        いいね数より多く減らす。
+        ・いいね数は0より小さくならない
+        """
+        self.counter.add(self.post.pk, -1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.favorite_count, 0)
+
+
+class TestReconcileFavoriteCountsCommand(TestCase):
+    def test_success_reconcile(self):
+        """
+        いいね数がFavoriteとずれている状態でコマンドを実行する。
+        ・ずれていたツイートのいいね数がFavoriteの件数と一致する
+        """
+        user = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        post1 = Tweet.objects.create(user=user, content="testpost1", favorite_count=3)
+        post2 = Tweet.objects.create(user=user, content="testpost2")
+        Favorite.objects.create(user=user, tweet=post2)
+
+        call_command("reconcile_favorite_counts", stdout=StringIO())
+
+        post1.refresh_from_db()
+        post2.refresh_from_db()
+        self.assertEqual(post1.favorite_count, 0)
+        self.assertEqual(post2.favorite_count, 1)
+
+
+class TestTweetSearchView(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.url = reverse("tweets:search")
+
+    def search(self, query, **params):
+        response = self.client.get(self.url, {"q": query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [tweet.content for tweet in response.context["tweet_list"]]
+
+    def test_success_get_ranked(self):
+        """
+        検索語を多く含むツイートと少し含むツイートで検索する。
+        ・一致しないツイートは結果に含まれない
+        ・検索語を多く含むツイートが先に来る
+        """
+        Tweet.objects.create(user=self.user, content="django is nice")
+        Tweet.objects.create(user=self.user, content="django django django")
+        Tweet.objects.create(user=self.user, content="flask is nice")
+        self.assertEqual(self.search("django"), ["django django django", "django is nice"])
+
+    def test_success_recent_first_for_same_relevance(self):
+        """
+        同じ本文で投稿日時の違うツイートを検索する。
+        ・新しいツイートが先に来る
+        """
+        old = Tweet.objects.create(user=self.user, content="old django")
+        Tweet.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=365))
+        Tweet.objects.create(user=self.user, content="new django")
+        self.assertEqual(self.search("django"), ["new django", "old django"])
+
+    def test_success_japanese(self):
+        """
+        日本語(単語を空白で区切らない文)のツイートを部分文字列で検索する。
+        ・3文字以上の語はFTS5の索引で見つかる
+        ・3文字未満の語も見つかる
+        """
+        Tweet.objects.create(user=self.user, content="今日は良い天気ですね")
+        Tweet.objects.create(user=self.user, content="明日は雨らしい")
+        self.assertEqual(self.search("良い天気"), ["今日は良い天気ですね"])
+        self.assertEqual(self.search("天気"), ["今日は良い天気ですね"])
+        self.assertEqual(self.search("今日は 天気"), ["今日は良い天気ですね"])
+
+    def test_success_index_follows_update_and_delete(self):
+        """
+        ツイートの本文を変更・削除してから検索する。
+        ・変更後の本文で見つかり、変更前の本文では見つからない
+        ・削除したツイートは見つからない
+        """
+        post = Tweet.objects.create(user=self.user, content="before edit")
+        post.content = "after edit"
+        post.save()
+        self.assertEqual(self.search("before"), [])
+        self.assertEqual(self.search("after"), ["after edit"])
+
+        post.delete()
+        self.assertEqual(self.search("after"), [])
+
+    def test_success_special_characters(self):
+        """
+        FTS5やLIKEで特別な意味を持つ文字を含む語で検索する。
+        ・エラーにならず、文字どおりに一致するツイートだけが見つかる
+        """
+        Tweet.objects.create(user=self.user, content='say "hello" OR 100%_done')
+        Tweet.objects.create(user=self.user, content="100 done")
+        self.assertEqual(self.search('"hello" OR'), ['say "hello" OR 100%_done'])
+        self.assertEqual(self.search("%_"), ['say "hello" OR 100%_done'])
+
+    def test_success_pagination(self):
+        """
+        1ページの件数より多く一致する状態で検索する。
+        ・2ページ目に残りが表示され、次のページはない
+        """
+        for i in range(25):
+            Tweet.objects.create(user=self.user, content=f"django {i}")
+        response = self.client.get(self.url, {"q": "django"})
+        self.assertEqual(len(response.context["tweet_list"]), 20)
+        self.assertTrue(response.context["has_next"])
+        response = self.client.get(self.url, {"q": "django", "page": 2})
+        self.assertEqual(len(response.context["tweet_list"]), 5)
+        self.assertFalse(response.context["has_next"])
+
+    def test_success_like_fallback(self):
+        """
+        FTS5が使えない状態で検索する。
+        ・LIKEによる検索で、一致するツイートが新しい順に見つかる
+        """
+        Tweet.objects.create(user=self.user, content="django one")
+        Tweet.objects.create(user=self.user, content="django two")
+        Tweet.objects.create(user=self.user, content="flask")
+        with mock.patch("tweets.search.fts_available", return_value=False):
+            self.assertEqual(self.search("django"), ["django two", "django one"])
+
+    def test_failure_invalid_page(self):
+        """
+        不正なページ番号で検索する。
+        ・400エラーになる
+        """
+        for page in ("abc", 0, 51):
+            response = self.client.get(self.url, {"q": "django", "page": page})
+            self.assertEqual(response.status_code, 400)
+
+    def test_failure_not_logged_in(self):
+        """
+        ログアウトした状態で検索する。
+        ・ログイン画面にリダイレクトされる
+        """
+        self.client.logout()
+        response = self.client.get(self.url, {"q": "django"})
+        self.assertRedirects(response, f"{reverse('accounts:login')}?next={self.url}%3Fq%3Ddjango")
+
+
+class TestRebuildTweetSearchIndexCommand(TestCase):
+    def test_success_rebuild(self):
+        """
+        索引を壊した状態でコマンドを実行する。
+        ・すべてのツイートが再び検索で見つかる
+        """
+        user = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        for i in range(5):
+            Tweet.objects.create(user=user, content=f"django {i}")
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {search.FTS_TABLE}({search.FTS_TABLE}) VALUES ('delete-all')")
+        self.assertEqual(search.search_tweet_ids("django", 0, 10), [])
+
+        call_command("rebuild_tweet_search_index", "--batch-size", "2", stdout=StringIO())
+
+        self.assertEqual(len(search.search_tweet_ids("django", 0, 10)), 5)
+
+    def test_failure_rebuild_rolled_back(self):
+        """
+        2つめのバッチを読むところで失敗させてコマンドを実行する。
+        ・索引を消したところと1つめのバッチが取り消され、元の索引で全てのツイートが検索で見つかる
+        """
+        user = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        for i in range(5):
+            Tweet.objects.create(user=user, content=f"django {i}")
+        values_list = QuerySet.values_list
+        calls = []
+
+        def fail_on_second_batch(queryset, *fields, **kwargs):
+            calls.append(fields)
+            if len(calls) == 2:
+                raise DatabaseError("database is locked")
+            return values_list(queryset, *fields, **kwargs)
+
+        with mock.patch.object(QuerySet, "values_list", fail_on_second_batch):
+            with self.assertRaises(DatabaseError):
+                call_command("rebuild_tweet_search_index", "--batch-size", "2", stdout=StringIO())
+
+        self.assertEqual(len(search.search_tweet_ids("django", 0, 10)), 5)
+
+
+class TestDeferredIndexing(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+
+    def test_success_deferred(self):
+        """
+        deferred_indexingの中でツイートを入れる。
+        ・ブロックの中ではトリガーが外されず、入れたツイートはまだ索引にない
+        ・ブロックを抜けると入れたツイートが索引に入る
+        ・ブロックを抜けた後に入れたツイートはトリガーで索引に入る
+        """
+        with search.deferred_indexing():
+            Tweet.objects.create(user=self.user, content="django deferred")
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s",
+                    [f"{search.FTS_TABLE}_%"],
+                )
+                self.assertEqual(cursor.fetchone()[0], 3)
+            self.assertEqual(search.search_tweet_ids("deferred", 0, 10), [])
+        self.assertEqual(len(search.search_tweet_ids("deferred", 0, 10)), 1)
+
+        Tweet.objects.create(user=self.user, content="django after")
+        self.assertEqual(len(search.search_tweet_ids("django", 0, 10)), 2)
+
+    def test_failure_rollback(self):
+        """
+        deferred_indexingの中で例外が起きる。
+        ・入れたツイートは取り消される
+        ・その後に入れたツイートはトリガーで索引に入る
+        """
+        with self.assertRaises(ValueError), search.deferred_indexing():
+            Tweet.objects.create(user=self.user, content="django rollback")
+            raise ValueError
+        self.assertFalse(Tweet.objects.exists())
+
+        Tweet.objects.create(user=self.user, content="django after")
+        self.assertEqual(len(search.search_tweet_ids("django", 0, 10)), 1)
+
+
+class TestTweetFragments(TestCase):
+    def setUp(self):
+        caches[settings.TWEET_FRAGMENT_CACHE_ALIAS].clear()
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.post = Tweet.objects.create(user=self.user1, content="<b>testpost</b>")
+        self.url = reverse("tweets:home")
+
+    def test_success_render_once(self):
+        """
+        ホーム・プロフィール・検索の画面にアクセスする。
+        ・最初のホーム画面だけツイートの断片を描画し、以降はキャッシュから使う
+        ・ツイートの内容はエスケープされて表示される
+        """
+        response = self.client.get(self.url)
+        self.assertTemplateUsed(response, fragments.FRAGMENT_TEMPLATE)
+        self.assertContains(response, "&lt;b&gt;testpost&lt;/b&gt;")
+        self.assertContains(response, reverse("tweets:detail", kwargs={"pk": self.post.pk}))
+
+        for url, params in (
+            (self.url, {}),
+            (reverse("accounts:user_profile", kwargs={"username": "testuser1"}), {}),
+            (reverse("tweets:search"), {"q": "testpost"}),
+        ):
+            response = self.client.get(url, params)
+            self.assertTemplateNotUsed(response, fragments.FRAGMENT_TEMPLATE)
+            self.assertContains(response, "&lt;b&gt;testpost&lt;/b&gt;")
+
+    def test_success_get_many_per_page(self):
+        """
+        3件のツイートがあるホーム画面にアクセスする。
+        ・キャッシュの取り出しはget_many()の1回、保存はset_many()の1回
+        """
+        Tweet.objects.create(user=self.user1, content="testpost2")
+        Tweet.objects.create(user=self.user1, content="testpost3")
+        cache = caches[settings.TWEET_FRAGMENT_CACHE_ALIAS]
+        with mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many, mock.patch.object(
+            cache, "set_many", wraps=cache.set_many
+        ) as set_many:
+            self.client.get(self.url)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(len(get_many.call_args.args[0]), 3)
+        self.assertEqual(set_many.call_count, 1)
+
+    def test_success_invalidate_on_delete(self):
+        """
+        断片をキャッシュした後でツイートを削除する。
+        ・キャッシュから消える
+        """
+        fragments.attach_html([self.post])
+        key = fragments._key(self.post.pk)
+        self.assertIsNotNone(caches[settings.TWEET_FRAGMENT_CACHE_ALIAS].get(key))
+        self.post.delete()
+        self.assertIsNone(caches[settings.TWEET_FRAGMENT_CACHE_ALIAS].get(key))
+
+    def test_success_invalidate_on_rename(self):
+        """
+        断片をキャッシュした後で投稿者のユーザ名を変える。
+        ・ホーム画面に新しいユーザ名が表示される
+        """
+        self.client.get(self.url)
+        self.user1.username = "renamed"
+        self.user1.save()
+        self.client.login(username="renamed", password="testpassword1")
+        response = self.client.get(self.url)
+        self.assertTemplateUsed(response, fragments.FRAGMENT_TEMPLATE)
+        self.assertContains(response, reverse("accounts:user_profile", kwargs={"username": "renamed"}))
+        self.assertNotContains(response, reverse("accounts:user_profile", kwargs={"username": "testuser1"}))
+
+
+class TestAsyncHomeView(AsyncViewsTestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.url = reverse("tweets:home")
+
+    def test_success_get(self):
+        """
+        非同期版のホーム画面にアクセスする。
+        ・URLには非同期版のビューが使われている
+        ・同期版と同じくページごとにツイートが新しい順で表示され、カーソルで次のページに進める
+        ・いいね済みのツイートにliked_by_meが付く
+        """
+        self.assertTrue(resolve(self.url).func.view_class.view_is_async)
+        tweets = [Tweet.objects.create(user=self.user2, content=f"testpost{i}") for i in range(25)]
+        Favorite.objects.create(user=self.user1, tweet=tweets[-1])
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "tweets/home.html")
+        tweet_list = response.context["tweet_list"]
+        self.assertEqual([tweet.pk for tweet in tweet_list], [tweet.pk for tweet in tweets[::-1][:20]])
+        self.assertTrue(tweet_list[0].liked_by_me)
+        self.assertFalse(tweet_list[1].liked_by_me)
+
+        response = self.client.get(self.url, {"cursor": response.context["page_obj"].next_cursor})
+        self.assertEqual([tweet.pk for tweet in response.context["tweet_list"]], [tweet.pk for tweet in tweets[4::-1]])
+        self.assertFalse(response.context["page_obj"].has_next())
+
+    def test_success_get_timeline(self):
+        """
+        非同期版のホーム画面でtimelineのフィードを表示する。
+        ・フォロー中のユーザのツイートだけが表示される
+        """
+        FriendShip.objects.follow(self.user1, self.user2)
+        followed = Tweet.objects.create(user=self.user2, content="followed")
+        timeline.fan_out_tweet(followed)
+        other = CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+        Tweet.objects.create(user=other, content="not followed")
+
+        response = self.client.get(self.url, {"feed": "timeline"})
+        self.assertEqual(list(response.context["tweet_list"]), [followed])
+
+    def test_failure_not_logged_in(self):
+        """
+        ログアウトした状態で非同期版のホーム画面にアクセスする。
+        ・ログイン画面にリダイレクトされる
+        """
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertRedirects(response, f"{reverse('accounts:login')}?next={self.url}")
+
+
+@cached_sessions
+class TestAsyncTweetDetailView(AsyncViewsTestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.client.login(username="testuser1", password="testpassword1")
+        self.post = Tweet.objects.create(user=self.user1, content="testpost")
+
+    def test_success_get(self):
+        """
+        非同期版のツイート詳細画面にアクセスする。
+        ・ツイートが表示され、ツイートと投稿者は1回のクエリでまとめて取得される
+        """
+        url = reverse("tweets:detail", kwargs={"pk": self.post.pk})
+        self.assertTrue(resolve(url).func.view_class.view_is_async)
+        # ログインユーザ, ツイートと投稿者(セッションはキャッシュから取れる)
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["tweet"], self.post)
+        self.assertContains(response, "testpost")
+
+    def test_failure_get_with_not_exist_tweet(self):
+        """
+        存在しないツイートの詳細画面にアクセスする。
+        ・404エラーになる
+        """
+        response = self.client.get(reverse("tweets:detail", kwargs={"pk": 100}))
+        self.assertEqual(response.status_code, 404)
+
+
+class TestLiveHub(TestCase):
+    async def test_success_drop_oldest(self):
+        """
+        キューの上限を超えてイベントを入れる。
+        ・古いものから捨てられ、捨てた数が数えられる
+        """
+        hub = live.Hub(queue_size=2)
+        subscription = hub.subscribe([1])
+        for tweet_id in range(3):
+            subscription.put({"id": tweet_id, "author_id": 1})
+        self.assertEqual(subscription.take_dropped(), 1)
+        self.assertEqual([subscription.queue.get_nowait()["id"] for _ in range(2)], [1, 2])
+        self.assertEqual(subscription.take_dropped(), 0)
+
+    async def test_success_dispatch_to_followers_only(self):
+        """
+        投稿者ごとにイベントを配る。
+        ・その投稿者を受け取る接続にだけ届く
+        ・接続を外すと届かなくなる
+        """
+        hub = live.Hub(queue_size=10)
+        follower = hub.subscribe([1, 2])
+        stranger = hub.subscribe([3])
+        self.assertEqual(hub.connection_count(), 2)
+
+        hub.dispatch({"id": 10, "author_id": 2})
+        event = await asyncio.wait_for(follower.queue.get(), 1)
+        self.assertEqual(event["id"], 10)
+        self.assertTrue(stranger.queue.empty())
+
+        hub.unsubscribe(follower)
+        hub.unsubscribe(stranger)
+        self.assertEqual(hub.connection_count(), 0)
+
+
+class TestUnixSocketBroker(TestCase):
+    def test_success_publish_to_all_processes(self):
+        """
+        同じディレクトリを使う2つのブローカー(2つのワーカープロセスの代わり)の片方からイベントを送る。
+        ・両方に届く
+        ・終了したプロセスが残したソケットは、送るときに片付けられる
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            stale.bind(os.path.join(directory, "stale.sock"))
+            stale.close()
+
+            brokers = [live.UnixSocketBroker(directory) for _ in range(2)]
+            received = [[] for _ in brokers]
+            arrived = [threading.Event() for _ in brokers]
+            for broker, events, event in zip(brokers, received, arrived):
+                broker.start(lambda data, events=events, event=event: (events.append(data), event.set()))
+
+            brokers[0].publish({"id": 1, "author_id": 2, "created_at": timezone.now()})
+
+            for events, event in zip(received, arrived):
+                self.assertTrue(event.wait(5))
+                self.assertEqual(events[0]["id"], 1)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            for broker in brokers:
+                broker.stop()
+            self.assertEqual(os.listdir(directory), [])
+
+
+class TestLiveTimelineApp(TestCase):
+    def setUp(self):
+        self.user1 = CustomUser.objects.create_user(username="testuser1", password="testpassword1")
+        self.user2 = CustomUser.objects.create_user(username="testuser2", password="testpassword2")
+        self.user3 = CustomUser.objects.create_user(username="testuser3", password="testpassword3")
+        FriendShip.objects.follow(self.user1, self.user2)
+        self.client.login(username="testuser1", password="testpassword1")
+        self.followed_tweet = Tweet.objects.create(user=self.user2, content="followed")
+        self.other_tweet = Tweet.objects.create(user=self.user3, content="not followed")
+
+    def scope(self, cookie=True, method="GET"):
+        headers = []
+        if cookie:
+            session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+            headers.append((b"cookie", f"{settings.SESSION_COOKIE_NAME}={session_key}".encode()))
+        return {"type": "http", "method": method, "path": settings.LIVE_TIMELINE_PATH, "headers": headers}
+
+    async def call(self, scope):
+        # ASGIサーバの代わりにアプリケーションを呼び出し、送られてきたメッセージをキューで受け取る
+        app = LiveTimelineApp(application=None, heartbeat_interval=60)
+        messages = asyncio.Queue()
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        task = asyncio.ensure_future(app(scope, receive, messages.put))
+        return task, messages, disconnected
+
+    async def test_success_stream_followed_tweets(self):
+        """
+        ログインした状態で接続し、フォロー中のユーザとフォローしていないユーザのツイートを配る。
+        ・event-streamとして接続できる
+        ・フォロー中のユーザのツイートだけが"tweet"イベントで届く
+        ・切断すると接続が片付けられる
+        """
+        task, messages, disconnected = await self.call(self.scope())
+        start = await asyncio.wait_for(messages.get(), 5)
+        self.assertEqual(start["status"], 200)
+        self.assertIn((b"content-type", b"text/event-stream; charset=utf-8"), start["headers"])
+        self.assertEqual((await asyncio.wait_for(messages.get(), 5))["body"], b"retry: 3000\n\n")
+
+        await sync_to_async(live.publish_tweet)(self.other_tweet)
+        await sync_to_async(live.publish_tweet)(self.followed_tweet)
+        body = (await asyncio.wait_for(messages.get(), 5))["body"].decode()
+        lines = body.splitlines()
+        self.assertEqual(lines[:2], ["event: tweet", f"id: {self.followed_tweet.pk}"])
+        data = json.loads(lines[2].removeprefix("data: "))
+        self.assertEqual(data["username"], "testuser2")
+        self.assertEqual(data["content"], "followed")
+
+        disconnected.set()
+        await asyncio.wait_for(task, 5)
+        self.assertTrue(messages.empty())
+        self.assertEqual(live.get_hub().connection_count(), 0)
+
+    async def test_failure_not_logged_in(self):
+        """
+        ログインしていない状態で接続する。
+        ・403エラーになる
+        """
+        task, messages, _ = await self.call(self.scope(cookie=False))
+        await asyncio.wait_for(task, 5)
+        self.assertEqual((await messages.get())["status"], 403)
+
+    async def test_failure_post(self):
+        """
+        POSTで接続する。
+        ・405エラーになる
+        """
+        task, messages, _ = await self.call(self.scope(method="POST"))
+        await asyncio.wait_for(task, 5)
+        self.assertEqual((await messages.get())["status"], 405)
+
+
+class TestBenchmarkViewsCommand(TestCase):
+    def setUp(self):
+        # テストではテスト用のデータベースをそのまま使う。回数の制限はbenchmark_database()と同じく切っておく
+        database = mock.patch(
+            "tweets.benchmark.benchmark_database",
+            lambda: override_settings(ALLOWED_HOSTS=[benchmark.HOST], RATE_LIMIT_ENABLED=False),
+        )
+        database.start()
+        self.addCleanup(database.stop)
+        self.output = tempfile.NamedTemporaryFile(suffix=".json")
+        self.addCleanup(self.output.close)
+
+    def run_command(self, *args):
+        options = ["--users", "60", "--tweets-per-user", "2", "--follows-per-user", "5"]
+        options += ["--iterations", "2", "--warmup", "0", "--memory-iterations", "1"]
+        call_command("benchmark_views", *options, *args, stdout=StringIO())
+
+    def test_success_write_json(self):
+        """
+        小さいデータでコマンドを実行する。
+        ・accounts/urls.pyとtweets/urls.pyのすべてのURLの結果がJSONに保存される
+        ・遅延・SQLの回数・ピークメモリが記録されている
+        """
+        self.run_command("--output", self.output.name)
+        with open(self.output.name) as f:
+            report = json.load(f)
+        results = report["results"]
+        url_names = {name.split("?")[0] for name in results}
+        self.assertEqual(url_names, route_names())
+        for result in results.values():
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+            self.assertGreater(result["queries"], 0)
+            self.assertGreater(result["peak_memory_kib"], 0)
+
+    def test_failure_regression(self):
+        """
+        前回の結果より遅い・SQLが多い状態で実行する。
+        ・悪化した項目を示してエラーになる
+        """
+        baseline = {"tweets:home": {"p95_ms": 0.0001, "peak_memory_kib": 1e9, "queries": 0}}
+        with open(self.output.name, "w") as f:
+            json.dump({"results": baseline}, f)
+        with self.assertRaisesMessage(CommandError, "tweets:home: p95_ms"):
+            self.run_command("--baseline", self.output.name)
@@ -0,0 +1,62 @@
+from django.db import transaction
+
+from accounts.models import FriendShip
+
+from .models import TimelineEntry, Tweet
+
+# 受信箱(TimelineEntry)の書き込み・削除をまとめたモジュール。
+# ビューや管理コマンドからはここの関数だけを呼び、TimelineEntryを直接触らないようにする。
+
+# bulk_createで1回のINSERTにまとめる行数
+BATCH_SIZE = 1000
+
+# フォロー時のさかのぼり(backfill)や再構築で受信箱に入れる、1ユーザあたりの最新ツイート数
+BACKFILL_LIMIT = 800
+
+
+def _bulk_insert(entries):
+    # 既に同じ(owner, tweet)がある場合はunique_timeline_entry制約で無視される
+    TimelineEntry.objects.bulk_create(entries, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def fan_out_tweet(tweet):
+    # 投稿者本人と、投稿者をフォローしている全員の受信箱にツイートを配る
+    follower_ids = FriendShip.objects.filter(following_id=tweet.user_id).values_list("follower_id", flat=True)
+    entries = [TimelineEntry(owner_id=tweet.user_id, tweet=tweet, created_at=tweet.created_at)]
+    with transaction.atomic():
+        for follower_id in follower_ids.iterator(chunk_size=BATCH_SIZE):
+            entries.append(TimelineEntry(owner_id=follower_id, tweet=tweet, created_at=tweet.created_at))
+            if len(entries) >= BATCH_SIZE:
+                _bulk_insert(entries)
+                entries = []
+        _bulk_insert(entries)
+
+
+def retract_tweet(tweet):
+    # 削除されたツイートを全員の受信箱から取り除く
+    TimelineEntry.objects.filter(tweet=tweet).delete()
+
+
+def backfill(owner_id, author_ids):
+    # フォローしたユーザの最新ツイートをさかのぼって受信箱に入れる
+    entries = []
+    for author_id in author_ids:
+        tweets = Tweet.objects.filter(user_id=author_id).order_by("-created_at", "-id")[:BACKFILL_LIMIT]
+        entries.extend(
+            TimelineEntry(owner_id=owner_id, tweet_id=tweet_id, created_at=created_at)
+            for tweet_id, created_at in tweets.values_list("id", "created_at")
+        )
+    _bulk_insert(entries)
+
+
+def purge(owner_id, author_ids):
+    # フォロー解除したユーザのツイートを受信箱から取り除く
+    TimelineEntry.objects.filter(owner_id=owner_id, tweet__user_id__in=author_ids).delete()
+
+
+def rebuild(owner_id):
+    # 受信箱を一度空にして、フォロー中のユーザと自分自身のツイートから作り直す
+    author_ids = list(FriendShip.objects.filter(follower_id=owner_id).values_list("following_id", flat=True))
+    with transaction.atomic():
+        TimelineEntry.objects.filter(owner_id=owner_id).delete()
+        backfill(owner_id, author_ids + [owner_id])
@@ -1,13 +1,26 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 app_name = "tweets"
+
+# ASGIで動かすときは、読み込みの多いビューを非同期版に差し替える
+if settings.ASYNC_VIEWS:
+    home_view = views.AsyncHomeView
+    detail_view = views.AsyncTweetDetailView
+else:
+    home_view = views.HomeView
+    detail_view = views.TweetDetailView
+
 urlpatterns = [
-    path("home/", views.HomeView.as_view(), name="home"),
+    path("home/", home_view.as_view(), name="home"),
     path("create/", views.TweetCreateView.as_view(), name="create"),
-    path("<int:pk>/", views.TweetDetailView.as_view(), name="detail"),
+    path("search/", views.TweetSearchView.as_view(), name="search"),
+    path("<int:pk>/", detail_view.as_view(), name="detail"),
     path("<int:pk>/delete/", views.TweetDeleteView.as_view(), name="delete"),
-    # path('<int:pk>/like/', views.LikeView, name='like'),
-    # path('<int:pk>/unlike/', views.UnlikeView, name='unlike'),
+    path("<int:pk>/like/", views.LikeView.as_view(), name="like"),
+    path("<int:pk>/unlike/", views.UnlikeView.as_view(), name="unlike"),
+    path("api/home/", views.HomeFeedJSONView.as_view(), name="api_home"),
+    path("api/users/<str:username>/", views.UserTweetsJSONView.as_view(), name="api_user_tweets"),
 ]
@@ -1,18 +1,101 @@
 # from django.shortcuts import render
+import json
+
+from django.contrib import messages
+from django.contrib.auth import get_user_model
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core.exceptions import BadRequest
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
 from django.urls import reverse_lazy
+from django.utils.http import url_has_allowed_host_and_scheme
+from django.views import View
 from django.views.generic import CreateView, DeleteView, DetailView, ListView
+from django.views.generic.base import TemplateView
+
+from accounts import recommendations
+from accounts.mixins import AsyncLoginRequiredMixin, aget_user
+from jobs.queue import enqueue
 
+from . import favorites, feeds, fragments, live, pagination, search, timeline
 from .forms import TweetForm
 from .models import Tweet
+from .pagination import KeysetPaginationMixin, encode_cursor, keyset_queryset
+from .tasks import fan_out_tweet
+
+CustomUser = get_user_model()
 
 
 # サインアップにおけるリダイレクト先の画面用のHomeView
-class HomeView(LoginRequiredMixin, ListView):
+# 全件を一度に取得すると重いので、(created_at, id)をカーソルにしてpaginate_by件ずつ表示する
+class HomeView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Tweet
     context_object_name = "tweet_list"
     template_name = "tweets/home.html"
-    queryset = model.objects.select_related("user").order_by("-created_at")
+    paginate_by = 20
+    # ?feed=...でフィードを切り替える。種類はtweets/feeds.pyのFEEDS
+    feed_kwarg = "feed"
+
+    def get_feed(self):
+        return feeds.validate_feed(self.request.GET.get(self.feed_kwarg, feeds.FEEDS[0]))
+
+    def get_keyset_fields(self):
+        return feeds.keyset_fields(self.get_feed())
+
+    def get_queryset(self):
+        return feeds.feed_queryset(self.get_feed(), self.request.user)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page, object_list, is_paginated = super().paginate_queryset(queryset, page_size)
+        if self.get_feed() == "timeline":
+            # テンプレートからは他のフィードと同じくTweetの一覧として扱えるようにする
+            page.object_list = object_list = [entry.tweet for entry in object_list]
+        return paginator, page, object_list, is_paginated
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["feed"] = self.get_feed()
+        # ページ内のツイートにいいね済みかどうかと、表示用のHTMLをまとめて付ける
+        favorites.mark_liked_by(self.request.user, context["tweet_list"])
+        fragments.attach_html(context["tweet_list"])
+        # おすすめユーザはrefresh_recommendationsコマンドで保存したものをインデックスで引くだけ
+        context["recommendation_list"] = list(recommendations.suggestions(self.request.user.pk))
+        return context
+
+
+class TweetSearchView(LoginRequiredMixin, TemplateView):
+    # ?q=検索語&page=ページ番号。OFFSETで深いページほど遅くなるので、max_pageページまでに制限する
+    template_name = "tweets/search.html"
+    paginate_by = 20
+    max_page = 50
+
+    def get_page_number(self):
+        try:
+            page_number = int(self.request.GET.get("page", 1))
+        except ValueError:
+            raise BadRequest("Invalid page.")
+        if not 1 <= page_number <= self.max_page:
+            raise BadRequest("Invalid page.")
+        return page_number
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.get("q", "").strip()
+        page_number = self.get_page_number()
+        tweet_list, has_next = search.search(query, page_number, self.paginate_by) if query else ([], False)
+        context.update(
+            {
+                "query": query,
+                "tweet_list": fragments.attach_html(tweet_list),
+                "page_number": page_number,
+                "has_next": has_next and page_number < self.max_page,
+            }
+        )
+        return context
 
 
 class TweetCreateView(LoginRequiredMixin, CreateView):
@@ -24,7 +107,14 @@ class TweetCreateView(LoginRequiredMixin, CreateView):
     def form_valid(self, form):
         # 現在ログインしているユーザーを代入
         form.instance.user = self.request.user
-        return super().form_valid(form)
+        with transaction.atomic():
+            response = super().form_valid(form)
+            # 投稿者とフォロワーの受信箱に配るのは、フォロワーが多いと重いのでワーカーで行う
+            enqueue(fan_out_tweet, tweet_id=self.object.pk)
+            # 接続中のフォロワーにSSEで知らせる。コミットされなかったツイートは知らせない
+            tweet = self.object
+            transaction.on_commit(lambda: live.publish_tweet(tweet))
+        return response
 
 
 class TweetDetailView(LoginRequiredMixin, DetailView):
@@ -43,3 +133,165 @@ class TweetDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         current_user = self.request.user
         tweet_user = self.get_object().user  # Tweetモデルのuser属性を得る
         return current_user == tweet_user
+
+    def form_valid(self, form):
+        with transaction.atomic():
+            # 受信箱から取り除いてからツイート本体を削除する
+            timeline.retract_tweet(self.object)
+            return super().form_valid(form)
+
+
+class FavoriteRedirectMixin:
+    # いいね・いいね取り消し後は、フォームで送られたnext(元の画面)に戻す。なければホーム画面
+    def get_success_url(self):
+        next_url = self.request.POST.get("next")
+        if next_url and url_has_allowed_host_and_scheme(next_url, allowed_hosts={self.request.get_host()}):
+            return next_url
+        return reverse_lazy("tweets:home")
+
+
+class LikeView(LoginRequiredMixin, FavoriteRedirectMixin, View):
+    def post(self, request, *args, **kwargs):
+        tweet = get_object_or_404(Tweet, pk=self.kwargs["pk"])
+        if favorites.like(request.user, tweet):
+            messages.success(request, "いいねしました。")
+        else:
+            messages.warning(request, "すでにいいねしています。")
+        return HttpResponseRedirect(self.get_success_url())
+
+
+class UnlikeView(LoginRequiredMixin, FavoriteRedirectMixin, View):
+    def post(self, request, *args, **kwargs):
+        tweet = get_object_or_404(Tweet, pk=self.kwargs["pk"])
+        if favorites.unlike(request.user, tweet):
+            messages.success(request, "いいねを取り消しました。")
+        else:
+            messages.warning(request, "いいねしていません。")
+        return HttpResponseRedirect(self.get_success_url())
+
+
+def stream_json(rows, projection, limit, chunk_size):
+    """
+    rows(projectionのフィールドのタプル)から、{"tweets": [...], "next_cursor": ...}のJSONを少しずつ返すジェネレータ。
+    rowsにiterator()を渡せばchunk_size件ずつDBから読み、読んだ分だけ文字列にして返すので、件数が多くてもメモリ使用量は増えない。
+    """
+    keys = [key for key, _ in projection]
+
+    yield '{"tweets": ['
+    separator = ""
+    chunk = []
+    last = None
+    has_next = False
+    for i, row in enumerate(rows):
+        # limit + 1件目があれば次のページがある
+        if i == limit:
+            has_next = True
+            break
+        last = dict(zip(keys, row))
+        chunk.append(json.dumps(last, cls=DjangoJSONEncoder, ensure_ascii=False))
+        if len(chunk) >= chunk_size:
+            yield separator + ",".join(chunk)
+            separator = ","
+            chunk = []
+    if chunk:
+        yield separator + ",".join(chunk)
+
+    next_cursor = encode_cursor(last["created_at"], last["id"]) if has_next else None
+    yield '], "next_cursor": ' + json.dumps(next_cursor) + "}"
+
+
+class TweetStreamView(LoginRequiredMixin, View):
+    """
+    ツイートの一覧をJSONで返すAPIの共通部分。HTMLの画面と同じ?cursor=...でページングでき、?limit=...で件数を指定できる。
+    get_source()で(queryset, カーソルのフィールド, 返すフィールド)を返す。
+    """
+
+    # APIなのでログイン画面へリダイレクトせず403を返す
+    raise_exception = True
+    chunk_size = 500
+    default_limit = HomeView.paginate_by
+    max_limit = 10000
+
+    def get_limit(self):
+        try:
+            limit = int(self.request.GET.get("limit", self.default_limit))
+        except ValueError:
+            raise BadRequest("Invalid limit.")
+        if not 1 <= limit <= self.max_limit:
+            raise BadRequest("Invalid limit.")
+        return limit
+
+    def get_source(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        queryset, fields, projection = self.get_source()
+        # カーソルやlimitが不正な場合は、レスポンスを返し始める前に400にする
+        queryset = keyset_queryset(queryset, request.GET.get("cursor"), fields)
+        limit = self.get_limit()
+        rows = queryset.values_list(*[field for _, field in projection])[: limit + 1]
+        if isinstance(request, ASGIRequest):
+            # Django 4.1のASGIHandlerはStreamingHttpResponseのジェネレータをイベントループで回すので、
+            # そこではDBを読めない(SynchronousOnlyOperation)。ビューを実行しているスレッドで読み終えてから返す
+            rows = list(rows)
+        else:
+            rows = rows.iterator(chunk_size=self.chunk_size)
+        return StreamingHttpResponse(
+            stream_json(rows, projection, limit, self.chunk_size), content_type="application/json"
+        )
+
+
+class HomeFeedJSONView(TweetStreamView):
+    # ホーム画面と同じ?feed=...を受け付ける
+    def get_source(self):
+        feed = feeds.validate_feed(self.request.GET.get("feed", feeds.FEEDS[0]))
+        return feeds.feed_queryset(feed, self.request.user), feeds.keyset_fields(feed), feeds.feed_projection(feed)
+
+
+class UserTweetsJSONView(TweetStreamView):
+    def get_source(self):
+        user = get_object_or_404(CustomUser, username=self.kwargs["username"])
+        return Tweet.objects.filter(user=user), ("created_at", "id"), feeds.TWEET_PROJECTION
+
+
+# ここから下はASGIで動かすときの非同期版のビュー(settings.ASYNC_VIEWSがTrueのときにurls.pyで使われる)。
+# 表示内容は同期版と同じで、DBへの問い合わせを非同期ORM(aget()・async for)で行う。
+
+
+class AsyncHomeView(AsyncLoginRequiredMixin, View):
+    template_name = "tweets/home.html"
+    paginate_by = HomeView.paginate_by
+    feed_kwarg = HomeView.feed_kwarg
+
+    async def get(self, request, *args, **kwargs):
+        user = await aget_user(request)
+        feed = feeds.validate_feed(request.GET.get(self.feed_kwarg, feeds.FEEDS[0]))
+        queryset = feeds.feed_queryset(feed, user)
+        paginator = pagination.KeysetPaginator(queryset, self.paginate_by, fields=feeds.keyset_fields(feed))
+        page = await paginator.apage(request.GET.get(KeysetPaginationMixin.cursor_kwarg))
+        if feed == "timeline":
+            page.object_list = [entry.tweet for entry in page.object_list]
+        tweet_list = await favorites.amark_liked_by(user, page.object_list)
+        await fragments.aattach_html(tweet_list)
+        context = {
+            "feed": feed,
+            "recommendation_list": [recommendation async for recommendation in recommendations.suggestions(user.pk)],
+            "tweet_list": tweet_list,
+            "object_list": tweet_list,
+            "paginator": paginator,
+            "page_obj": page,
+            "is_paginated": page.has_next(),
+        }
+        return TemplateResponse(request, self.template_name, context)
+
+
+class AsyncTweetDetailView(AsyncLoginRequiredMixin, View):
+    template_name = "tweets/tweet_detail.html"
+
+    async def get(self, request, *args, **kwargs):
+        # テンプレートでtweet.userを表示するので一緒に取得しておく
+        try:
+            tweet = await Tweet.objects.select_related("user").aget(pk=self.kwargs["pk"])
+        except Tweet.DoesNotExist:
+            raise Http404("No tweet found matching the query")
+        return TemplateResponse(request, self.template_name, {"tweet": tweet, "object": tweet})